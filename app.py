@@ -7,17 +7,54 @@
 Warbler app - Flask setup and config, routes, and views.
 """
 
+import json
+import sys
 import os
+import time
+from datetime import date, timedelta
 
-from flask import Flask, url_for, render_template, request, flash, redirect, session, g
+import click
+from flask.cli import AppGroup
+
+from flask import (Flask, url_for, render_template, request, flash, redirect, session, g, abort,
+                   jsonify, Response, stream_with_context, stream_template, send_file,
+                   get_flashed_messages)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from models import (db, connect_db, User, Message, ArchivedMessage, ArchivedLike, Like, Follow,
+                    MessageTag, Mention)
+from pagination import decode_cursor, paginate
+from suggestions import refresh_suggestions, get_suggestions, discard_suggestion, start_refresher
+from trending import TrendingTracker, recent_like_counts
+from purge import purge_user
+from archive import archive_messages, archived_messages
+from export import FORMATS as EXPORT_FORMATS, export_lines
+from ingest import IngestError, import_messages
+import maintenance
+from partitioning import is_partitioned, partition_messages, create_partitions, add_months
+from jobs import JobQueue, DatabaseBackend
+from pubsub import Broker
+from tags import index_messages, linkify
+from recent import RecentMessagesCache
+from timeline import (merge_timeline, hybrid_timeline, push_messages, fill_timelines, drop_author,
+                      rebuild_timelines)
+from compression import Compressor
+from followgraph import FollowGraph
+from availability import TakenNames
+from prefixindex import PrefixIndex
+from ratelimit import RateLimiter
+from likebuffer import LikeBuffer, insert_likes, delete_likes
+from pagecache import PageCache
+from thumbnails import DiskLRUCache, Thumbnailer, ThumbnailError, is_remote, source_version
 
 
 CURR_USER_KEY = "curr_user"
+SIGNUP_FORM_KEY = "signup_form"
+
+# Rows fetched per round-trip when a streamed page reads its list as it renders
+USERS_YIELD_PER = 100
 
 app = Flask(__name__)
 
@@ -29,8 +66,265 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# "Who to follow" suggestions: how many are stored per user, and how often (in seconds) the
+# background refresher recomputes them when running the dev server.
+app.config['SUGGESTIONS_PER_USER'] = 10
+app.config['SUGGESTIONS_REFRESH_SECONDS'] = int(
+    os.environ.get('SUGGESTIONS_REFRESH_SECONDS', 15 * 60))
+
+# Trending warbles: likes are counted over a rolling window (in seconds) split into buckets,
+# decayed with the given half-life, and the ranking is recomputed at most every REFRESH seconds.
+app.config['TRENDING_WINDOW_SECONDS'] = int(
+    os.environ.get('TRENDING_WINDOW_SECONDS', 24 * 60 * 60))
+app.config['TRENDING_BUCKET_SECONDS'] = int(os.environ.get('TRENDING_BUCKET_SECONDS', 5 * 60))
+app.config['TRENDING_HALF_LIFE_SECONDS'] = int(
+    os.environ.get('TRENDING_HALF_LIFE_SECONDS', 6 * 60 * 60))
+app.config['TRENDING_REFRESH_SECONDS'] = int(os.environ.get('TRENDING_REFRESH_SECONDS', 60))
+# ... and reseeded from the likes table this often, to take in other processes' likes
+app.config['TRENDING_RELOAD_SECONDS'] = int(os.environ.get('TRENDING_RELOAD_SECONDS', 15 * 60))
+
+# Background jobs (see jobs.py): backend is "thread", "database" or "inline"; JOBS_WORKERS is the
+# number of worker threads in this process (0 with the database backend means only
+# `flask jobs-worker` processes run jobs).
+app.config['JOBS_BACKEND'] = os.environ.get('JOBS_BACKEND', 'thread')
+app.config['JOBS_WORKERS'] = int(os.environ.get('JOBS_WORKERS', 4))
+app.config['JOBS_MAX_ATTEMPTS'] = 3
+app.config['JOBS_RETRY_DELAY'] = 1.0
+app.config['JOBS_POLL_INTERVAL'] = 1.0
+# A database job still running after this many seconds is presumed abandoned and run again
+app.config['JOBS_LEASE_SECONDS'] = int(os.environ.get('JOBS_LEASE_SECONDS', 5 * 60))
+
+# Deleted accounts are purged in the background, this many rows per transaction
+app.config['USER_PURGE_BATCH_SIZE'] = 1000
+
+# Live timeline: how long (in seconds) one event stream stays open before the browser reconnects,
+# and how often a keepalive comment is sent while it is idle.
+app.config['TIMELINE_STREAM_SECONDS'] = 5 * 60
+app.config['TIMELINE_HEARTBEAT_SECONDS'] = 15
+
+# Thumbnails of remote user images: on-disk cache location and size limit, the sizes (in pixels)
+# generated for each kind of image, and how long browsers may cache them.
+app.config['THUMBNAIL_CACHE_DIR'] = os.environ.get(
+    'THUMBNAIL_CACHE_DIR', os.path.join(app.instance_path, 'thumbnails'))
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = int(
+    os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['THUMBNAIL_SIZES'] = {"avatar": (48, 96, 200), "header": (400,)}
+app.config['THUMBNAIL_MAX_AGE'] = 365 * 24 * 60 * 60
+# Source images that can't be fetched (or aren't on a public address) aren't tried again for
+# this many seconds
+app.config['THUMBNAIL_FAILURE_TTL'] = 5 * 60
+
+# Home and profile timelines only show messages from the last TIMELINE_MAX_AGE_DAYS days, if set
+# (with a partitioned messages table, this lets Postgres skip older partitions entirely).
+app.config['TIMELINE_MAX_AGE_DAYS'] = (
+    int(os.environ['TIMELINE_MAX_AGE_DAYS']) if os.environ.get('TIMELINE_MAX_AGE_DAYS') else None)
+
+# Messages older than this many days are moved to the archive table by `flask archive-messages`,
+# this many per transaction
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+app.config['ARCHIVE_BATCH_SIZE'] = 1000
+
+# Bulk message imports: most messages accepted per request, and rows per INSERT statement
+app.config['IMPORT_MAX_MESSAGES'] = 10_000
+app.config['IMPORT_CHUNK_SIZE'] = 1000
+
+# Rows (or users) per transaction in `flask maintenance` commands
+app.config['MAINTENANCE_BATCH_SIZE'] = 1000
+
+# Monthly partitions of messages (if partitioned) are created this many months ahead
+app.config['MESSAGE_PARTITION_MONTHS_AHEAD'] = 3
+
+# Profile pages: newest message IDs are cached for up to RECENT_CACHE_MAX_AUTHORS authors, each
+# entry for at most RECENT_CACHE_TTL seconds (the cache is per process).
+app.config['RECENT_CACHE_PER_AUTHOR'] = 100
+app.config['RECENT_CACHE_MAX_AUTHORS'] = int(os.environ.get('RECENT_CACHE_MAX_AUTHORS', 10_000))
+app.config['RECENT_CACHE_TTL'] = 60
+
+# How the home timeline is assembled: "sql" (one query), "merge" (k-way merge of the followed
+# authors' cached newest messages) or "hybrid" (see below); compare them with
+# `flask benchmark-timeline`.
+app.config['TIMELINE_ENGINE'] = os.environ.get('TIMELINE_ENGINE', 'sql')
+
+# Hybrid timelines: messages by authors with at most TIMELINE_FANOUT_MAX_FOLLOWERS followers are
+# pushed into their followers' timelines as they are posted; more popular authors' messages are
+# pulled in when a timeline is read. A new follow pushes the author's newest
+# TIMELINE_FANOUT_BACKFILL messages. Run `flask maintenance recompute timelines` after switching
+# to "hybrid" or changing the threshold; compare thresholds with `flask benchmark-fanout`.
+app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = int(
+    os.environ.get('TIMELINE_FANOUT_MAX_FOLLOWERS', 10_000))
+app.config['TIMELINE_FANOUT_BACKFILL'] = 100
+
+# Optional in-memory index of the follows graph (see followgraph.py) for follow checks, follow
+# counts and followee lists; each process rebuilds its copy every FOLLOW_GRAPH_MAX_AGE seconds.
+app.config['FOLLOW_GRAPH_ENABLED'] = os.environ.get('FOLLOW_GRAPH_ENABLED', '0') == '1'
+app.config['FOLLOW_GRAPH_MAX_AGE'] = 300
+
+# Signup and profile edits check whether a username or email is taken before hashing a password,
+# through per-process Bloom filters (see availability.py), rebuilt every AVAILABILITY_MAX_AGE
+# seconds
+app.config['AVAILABILITY_ERROR_RATE'] = 0.01
+app.config['AVAILABILITY_MAX_AGE'] = 60 * 60
+
+# Search-box autocomplete: at most AUTOCOMPLETE_LIMIT usernames per prefix, from a per-process
+# index (see prefixindex.py) rebuilt every AUTOCOMPLETE_MAX_AGE seconds
+app.config['AUTOCOMPLETE_LIMIT'] = 10
+app.config['AUTOCOMPLETE_MAX_AGE'] = 300
+
+# Write quotas, per user and kind of write: (burst, refill rate in writes per second). Over quota,
+# a write gets a 429. RATELIMIT_BACKEND is "memory" (per process) or "database" (shared).
+# "availability" limits username/email lookups, per user or (logged out) per client address.
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+app.config['RATELIMIT_BACKEND'] = os.environ.get('RATELIMIT_BACKEND', 'memory')
+app.config['RATELIMITS'] = {
+    "messages": (30, 60 / 3600),
+    "likes": (100, 600 / 3600),
+    "follows": (50, 200 / 3600),
+    "imports": (5, 10 / 3600),
+    "availability": (30, 120 / 3600),
+}
+
+# Write-behind likes: if enabled, likes and unlikes are acknowledged at once and written in
+# batches every LIKE_BUFFER_FLUSH_SECONDS (see likebuffer.py), or sooner once
+# LIKE_BUFFER_MAX_PENDING events are waiting.
+app.config['LIKE_BUFFER_ENABLED'] = os.environ.get('LIKE_BUFFER_ENABLED', '0') == '1'
+app.config['LIKE_BUFFER_FLUSH_SECONDS'] = float(os.environ.get('LIKE_BUFFER_FLUSH_SECONDS', 1.0))
+app.config['LIKE_BUFFER_MAX_PENDING'] = 10_000
+
+# Full-page cache for logged-out visitors (see pagecache.py): a page is served from the cache for
+# PAGE_CACHE_TTL seconds, then for up to PAGE_CACHE_STALE_SECONDS more while it is rendered again
+# in the background. Writes drop the pages they affect right away.
+app.config['PAGE_CACHE_ENABLED'] = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+app.config['PAGE_CACHE_TTL'] = int(os.environ.get('PAGE_CACHE_TTL', 30))
+app.config['PAGE_CACHE_STALE_SECONDS'] = int(os.environ.get('PAGE_CACHE_STALE_SECONDS', 5 * 60))
+app.config['PAGE_CACHE_MAX_ENTRIES'] = 1000
+
+# Streamed pages (see stream_page) are sent in chunks of about this many bytes
+app.config['STREAM_CHUNK_SIZE'] = 8 * 1024
+
+# Page sizes for cursor-paginated lists
+app.config['LIKES_PER_PAGE'] = 50
+app.config['FEED_PER_PAGE'] = 50
+app.config['FOLLOWS_PER_PAGE'] = 60
+
+# Response compression: text responses of at least COMPRESS_MIN_SIZE bytes are sent brotli- or
+# gzip-compressed, as negotiated with the client.
+app.config['COMPRESS_ENABLED'] = os.environ.get('COMPRESS_ENABLED', '1') == '1'
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+
+# Serve /debug/metrics (per-process counters, see debug_metrics) outside debug mode too
+app.config['METRICS_ENDPOINT_ENABLED'] = os.environ.get('METRICS_ENDPOINT_ENABLED', '0') == '1'
+
+# Created before the debug toolbar, so compression runs after the toolbar has edited the page
+compressor = Compressor(app)
 toolbar = DebugToolbarExtension(app)
 
+# Drop the whitespace around block tags that would otherwise be sent with every page
+app.jinja_env.trim_blocks = True
+app.jinja_env.lstrip_blocks = True
+app.jinja_env.filters['linkify'] = linkify
+
+# Before any other before_request hook, so over-quota writes are refused before any database work
+limiter = RateLimiter(app, identity=lambda: session.get(CURR_USER_KEY))
+jobs = JobQueue(app)
+broker = Broker()
+follow_graph = FollowGraph(app, max_age=app.config['FOLLOW_GRAPH_MAX_AGE'])
+taken_names = TakenNames(error_rate=app.config['AVAILABILITY_ERROR_RATE'],
+                         max_age=app.config['AVAILABILITY_MAX_AGE'])
+username_index = PrefixIndex(app, max_age=app.config['AUTOCOMPLETE_MAX_AGE'])
+page_cache = PageCache(app, ttl=app.config['PAGE_CACHE_TTL'],
+                       stale=app.config['PAGE_CACHE_STALE_SECONDS'],
+                       max_entries=app.config['PAGE_CACHE_MAX_ENTRIES'])
+thumbnailer = Thumbnailer(DiskLRUCache(app.config['THUMBNAIL_CACHE_DIR'],
+                                       app.config['THUMBNAIL_CACHE_MAX_BYTES']),
+                          app.config['THUMBNAIL_SIZES'],
+                          failure_ttl=app.config['THUMBNAIL_FAILURE_TTL'])
+
+recent_cache = RecentMessagesCache(per_author=app.config['RECENT_CACHE_PER_AUTHOR'],
+                                   max_authors=app.config['RECENT_CACHE_MAX_AUTHORS'],
+                                   ttl=app.config['RECENT_CACHE_TTL'])
+
+trending = TrendingTracker(window=app.config['TRENDING_WINDOW_SECONDS'],
+                           bucket=app.config['TRENDING_BUCKET_SECONDS'],
+                           half_life=app.config['TRENDING_HALF_LIFE_SECONDS'],
+                           refresh=app.config['TRENDING_REFRESH_SECONDS'],
+                           loader=recent_like_counts,
+                           reload=app.config['TRENDING_RELOAD_SECONDS'])
+
+
+def record_flushed_likes(liked, unliked):
+    """
+    Count buffered likes and unlikes towards trending once they are written.
+    """
+
+    for (message_id, age) in liked:
+        trending.record_like(message_id, age=age)
+
+    for (message_id, age) in unliked:
+        trending.record_like(message_id, -1, age=age)
+
+
+like_buffer = LikeBuffer(app, interval=app.config['LIKE_BUFFER_FLUSH_SECONDS'],
+                         max_pending=app.config['LIKE_BUFFER_MAX_PENDING'],
+                         on_flush=record_flushed_likes)
+
+
+###################################################################################################
+# Background job tasks
+
+@jobs.task("purge_user")
+def purge_user_task(user_id):
+    """
+    Remove a deleted (deactivated) user's data in batches.
+    """
+
+    purge_user(user_id, app.config['USER_PURGE_BATCH_SIZE'])
+    follow_graph.expire()
+
+
+@jobs.task("refresh_suggestions")
+def refresh_suggestions_task(user_id):
+    """
+    Recompute one user's follow suggestions after their follows change.
+    """
+
+    refresh_suggestions(user_ids=[user_id], per_user=app.config['SUGGESTIONS_PER_USER'])
+    db.session.commit()
+
+
+@jobs.task("fan_out_message")
+def fan_out_message_task(author_id, message_id):
+    """
+    Push a new message into the author's followers' timelines.
+    """
+
+    push_messages(author_id, [message_id])
+    db.session.commit()
+
+
+@jobs.task("fan_out_author")
+def fan_out_author_task(author_id):
+    """
+    Push an author's newest messages into all of their followers' timelines (e.g. after an
+    import, or once they have few enough followers to be pushed again).
+    """
+
+    fill_timelines(app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'],
+                   app.config['TIMELINE_FANOUT_BACKFILL'],
+                   author_id=author_id)
+    db.session.commit()
+
+
+def pushes_messages(user):
+    """
+    Are `user`'s messages pushed into their followers' timelines (rather than pulled)?
+    """
+
+    return (app.config['TIMELINE_ENGINE'] == "hybrid" and
+            user.follower_count <= app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'])
+
 
 ###################################################################################################
 # User signup/login/logout
@@ -44,6 +338,11 @@ def add_user_to_g():
     if CURR_USER_KEY in session:
         g.user = db.session.get(User, session[CURR_USER_KEY])
 
+        # Deleted account still waiting to be purged
+        if g.user and not g.user.is_active:
+            do_logout()
+            g.user = None
+
     else:
         g.user = None
 
@@ -65,6 +364,157 @@ def do_logout():
         session.pop(CURR_USER_KEY)
 
 
+def get_cursor():
+    """
+    Get the pagination cursor from the 'before' querystring param, if any.
+
+    Responds with 400 Bad Request if the cursor is malformed.
+    """
+
+    cursor = request.args.get('before')
+
+    if not cursor:
+        return None
+
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+
+def stream_page(template_name, **context):
+    """
+    Render a template as a streamed response: the page is sent as it is rendered, in chunks of
+    about STREAM_CHUNK_SIZE bytes, so the first bytes go out before the whole page is built and
+    the full page is never held in memory. Lists passed in as query iterators (with yield_per) are
+    read from the database as they are rendered, too.
+    """
+
+    # The session cookie is sent before the page renders; take this request's flashed messages out
+    # of the session now, or they would be shown again on the next page
+    get_flashed_messages(with_categories=True)
+
+    return Response(chunked(stream_template(template_name, **context),
+                            app.config['STREAM_CHUNK_SIZE']))
+
+
+def chunked(strings, size):
+    """
+    Join an iterable of (small) strings into pieces of at least `size` characters (except the
+    last).
+    """
+
+    buffer = []
+    buffered = 0
+
+    for string in strings:
+        buffer.append(string)
+        buffered += len(string)
+
+        if buffered >= size:
+            yield "".join(buffer)
+            (buffer, buffered) = ([], 0)
+
+    if buffer:
+        yield "".join(buffer)
+
+
+def get_message_or_404(message_id):
+    """
+    Get a message by ID from the hot table or, failing that, the archive; abort with 404 if it
+    is in neither.
+    """
+
+    msg = db.session.get(Message, message_id)
+
+    if msg is None:
+        msg = db.get_or_404(ArchivedMessage, message_id)
+
+    return msg
+
+
+def recent_messages(author_ids, limit=100):
+    """
+    Get the `limit` most recent messages by any of `author_ids`, newest first.
+
+    Filters and sorts on the bare timestamp column, so that if messages is partitioned (see
+    partitioning.py) Postgres skips months older than TIMELINE_MAX_AGE_DAYS and reads the rest
+    newest first, stopping once it has `limit` rows.
+    """
+
+    query = Message.query.filter(Message.user_id.in_(author_ids))
+
+    if app.config['TIMELINE_MAX_AGE_DAYS'] is not None:
+        max_age = timedelta(days=app.config['TIMELINE_MAX_AGE_DAYS'])
+        query = query.filter(Message.timestamp >= db.func.now() - max_age)
+
+    return query.order_by(Message.timestamp.desc()).limit(limit).all()
+
+
+def author_messages(user_id, limit=100):
+    """
+    Get a user's `limit` most recent messages, newest first, through the recent-messages cache.
+
+    On a hit, the messages are fetched by primary key; if any of them have since been deleted or
+    archived (e.g. by another process), the entry is dropped and reloaded.
+    """
+
+    if app.config['TIMELINE_MAX_AGE_DAYS'] is not None:
+        return recent_messages([user_id], limit)
+
+    keys = recent_cache.get(user_id)
+
+    if keys is not None:
+        ids = [msg_id for (_, msg_id) in keys[:limit]]
+        by_id = {msg.id: msg for msg in Message.query.filter(Message.id.in_(ids))}
+
+        if len(by_id) == len(ids):
+            return [by_id[msg_id] for msg_id in ids]
+
+        recent_cache.invalidate(user_id)
+
+    messages = recent_messages([user_id], recent_cache.per_author)
+    recent_cache.put(user_id, [(msg.timestamp, msg.id) for msg in messages])
+    return messages[:limit]
+
+
+def home_timeline(author_ids, limit=100, user_id=None):
+    """
+    Get the `limit` most recent messages by any of `author_ids`, newest first, using the
+    TIMELINE_ENGINE: "sql" (one query over all the authors), "merge" (a heap merge of the
+    authors' cached newest messages) or "hybrid" (`user_id`'s pushed timeline entries merged with
+    the messages of popular authors and their own; see timeline.py).
+    """
+
+    engine = app.config['TIMELINE_ENGINE']
+
+    if engine not in ("merge", "hybrid") or app.config['TIMELINE_MAX_AGE_DAYS'] is not None:
+        return recent_messages(author_ids, limit)
+
+    if engine == "hybrid" and user_id is not None:
+        pulled_ids = db.session.scalars(
+            db.select(User.id)
+            .where(User.id.in_(author_ids))
+            .where(User.follower_count > app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'])).all()
+        entries = hybrid_timeline(user_id, {*pulled_ids, user_id}, recent_cache, limit)
+
+    else:
+        entries = merge_timeline(author_ids, recent_cache, limit)
+    ids = [msg_id for (_, msg_id, _) in entries]
+    by_id = {msg.id: msg for msg in Message.query.filter(Message.id.in_(ids))}
+
+    stale = {author_id for (_, msg_id, author_id) in entries if msg_id not in by_id}
+
+    if not stale:
+        return [by_id[msg_id] for (_, msg_id, _) in entries]
+
+    # Some cached messages were deleted or archived elsewhere; reload those authors next time
+    for author_id in stale:
+        recent_cache.invalidate(author_id)
+
+    return recent_messages(author_ids, limit)
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """
@@ -79,7 +529,17 @@ def signup():
 
     form = UserAddForm()
 
+    # Lets the form's availability hints check emails (see users_availability)
+    session[SIGNUP_FORM_KEY] = True
+
     if form.validate_on_submit():
+
+        # Most duplicates are caught here, before the password is hashed
+        if (taken_names.is_taken("username", form.username.data) or
+                taken_names.is_taken("email", form.email.data)):
+            flash("Username or email already taken", 'danger')
+            return render_template('users/signup.jinja2', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -94,6 +554,8 @@ def signup():
             flash("Username or email already taken", 'danger')
             return render_template('users/signup.jinja2', form=form)
 
+        taken_names.add(username=user.username, email=user.email)
+        username_index.add(user.id, user.username)
         do_login(user)
 
         return redirect(url_for("homepage"))
@@ -135,6 +597,33 @@ def logout():
     return redirect(url_for("login"))
 
 
+@app.route('/api/users/availability')
+@limiter.limit("availability", methods=("GET",), anonymous=True)
+def users_availability():
+    """
+    Check whether a username and/or email (given in the querystring) are free to use, for the
+    signup and profile forms. A logged-in user's own username and email count as free.
+
+    Emails are only checked for visitors who were shown the signup form, so this can't be used to
+    find out whether someone has an account; other emails are left out of the answer.
+
+    Returns e.g. {"username": true, "email": false}, with true meaning available.
+    """
+
+    fields = [field for field in ("username", "email") if request.args.get(field)]
+
+    if not fields:
+        return jsonify(error="Give a username and/or email to check."), 400
+
+    if not session.get(SIGNUP_FORM_KEY):
+        fields = [field for field in fields if field != "email"]
+
+    exclude_user_id = g.user.id if g.user else None
+
+    return jsonify({field: not taken_names.is_taken(field, request.args[field], exclude_user_id)
+                    for field in fields})
+
+
 ###################################################################################################
 # General user routes:
 
@@ -148,15 +637,36 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.query.filter_by(is_active=True)
+
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    # Rendered as the rows are read, however many users match
+    users = users.order_by(User.id).yield_per(USERS_YIELD_PER)
+
+    return stream_page('users/index.jinja2', users=users)
+
+
+@app.route('/api/users/autocomplete')
+def users_autocomplete():
+    """
+    Usernames starting with the 'q' param in querystring (ignoring case), alphabetically, for the
+    search box: {"users": [{"id": ..., "username": ...}, ...]}.
+    """
+
+    prefix = request.args.get('q', '').strip()
+
+    if not prefix:
+        return jsonify(users=[])
 
-    return render_template('users/index.jinja2', users=users)
+    matches = username_index.search(prefix, app.config['AUTOCOMPLETE_LIMIT'])
+    return jsonify(users=[{"id": user_id, "username": username}
+                          for (user_id, username) in matches])
 
 
 @app.route('/users/<int:user_id>')
+@page_cache.cached
 def users_show(user_id):
     """
     Show user profile.
@@ -164,17 +674,110 @@ def users_show(user_id):
 
     user = db.get_or_404(User, user_id)
 
-    # Snagging messages in order from the database; user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    if not user.is_active:
+        abort(404)
+
+    page_cache.tag(f"user:{user_id}")
+
+    # Snagging messages in order; user.messages won't be in order by default
+    messages = author_messages(user_id)
+
+    # Older history lives in the archive; only look there if the hot table runs out
+    if len(messages) < 100 and app.config['TIMELINE_MAX_AGE_DAYS'] is None:
+        messages += archived_messages(user_id,
+                                      100 - len(messages),
+                                      before=messages[-1].timestamp if messages else None)
 
     return render_template('users/show.jinja2', user=user, messages=messages)
 
 
+@app.route('/users/<int:user_id>/<any(avatar, header):kind>/<int:size>')
+def user_thumbnail(user_id, kind, size):
+    """
+    Serve a thumbnail of a user's avatar or header image.
+
+    URLs carry a version of the source image (see thumbnail_url), so responses can be cached by
+    browsers indefinitely. Falls back to redirecting to the source image.
+    """
+
+    user = db.get_or_404(User, user_id)
+    src = user.image_url if kind == "avatar" else user.header_image_url
+
+    if size not in app.config['THUMBNAIL_SIZES'][kind]:
+        abort(404)
+
+    if not is_remote(src):
+        return redirect(src)
+
+    try:
+        path = thumbnailer.get(src, kind, size)
+    except ThumbnailError:
+        app.logger.warning("Could not make thumbnail of %s", src)
+        return redirect(src)
+
+    resp = send_file(path, max_age=app.config['THUMBNAIL_MAX_AGE'])
+    resp.cache_control.immutable = True
+    return resp
+
+
+@app.template_global()
+def thumbnail_url(user, kind, size):
+    """
+    Get the URL to use for a `size` pixel version of a user's avatar or header image.
+
+    Local (static) images are used as they are.
+    """
+
+    src = user.image_url if kind == "avatar" else user.header_image_url
+
+    if not is_remote(src):
+        return src
+
+    return url_for('user_thumbnail', user_id=user.id, kind=kind, size=size,
+                   v=source_version(src))
+
+
+def render_follow_list(user, template, followers):
+    """
+    Render one page of a user's followers (or followees), most recently followed first.
+
+    With a 'partial' param in querystring, renders just the page's user cards (for infinite
+    scroll) instead of the whole page.
+    """
+
+    if followers:
+        (own_col, other_col) = (Follow.user_being_followed_id, Follow.user_following_id)
+    else:
+        (own_col, other_col) = (Follow.user_following_id, Follow.user_being_followed_id)
+
+    query = (db.session
+             .query(User, Follow.created_at, other_col)
+             .join(Follow, other_col == User.id)
+             .filter(own_col == user.id)
+             .filter(User.is_active))
+
+    (rows, next_cursor) = paginate(query, Follow.created_at, other_col,
+                                   get_cursor(), app.config['FOLLOWS_PER_PAGE'])
+    users = [card_user for (card_user, _, _) in rows]
+
+    # Which of this page's users the viewer follows, from the follows index or primary key
+    if app.config['FOLLOW_GRAPH_ENABLED']:
+        following_ids = {card_user.id for card_user in users
+                         if follow_graph.is_following(g.user.id, card_user.id)}
+
+    else:
+        following_ids = set(db.session.scalars(
+            db.select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == g.user.id)
+            .where(Follow.user_being_followed_id.in_([card_user.id for card_user in users]))))
+
+    if request.args.get('partial'):
+        template = 'users/_user_cards.jinja2'
+
+    return render_template(template, user=user, users=users, following_ids=following_ids,
+                           next_cursor=next_cursor)
+
+
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """
@@ -186,7 +789,7 @@ def show_following(user_id):
         return redirect(url_for("homepage"))
 
     user = db.get_or_404(User, user_id)
-    return render_template('users/following.jinja2', user=user)
+    return render_follow_list(user, 'users/following.jinja2', followers=False)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -200,7 +803,7 @@ def show_followers(user_id):
         return redirect(url_for("homepage"))
 
     user = db.get_or_404(User, user_id)
-    return render_template('users/followers.jinja2', user=user)
+    return render_follow_list(user, 'users/followers.jinja2', followers=True)
 
 
 @app.route("/users/<int:user_id>/likes")
@@ -214,11 +817,45 @@ def display_likes(user_id):
         return redirect(url_for("homepage"))
 
     user = db.get_or_404(User, user_id)
-    likes = user.likes
-    return render_template("users/likes.jinja2", user=user, likes=likes)
+
+    # Likes of archived messages were archived with them
+    all_likes = (db.select(Like.message_id, Like.liked_at)
+                 .where(Like.user_id == user_id)
+                 .union_all(db.select(ArchivedLike.message_id, ArchivedLike.liked_at)
+                            .where(ArchivedLike.user_id == user_id))
+                 .subquery())
+
+    query = db.session.query(all_likes.c.liked_at, all_likes.c.message_id)
+
+    # Users see their own buffered likes and unlikes. Pending likes are newer than any written
+    # ones, so they go at the top of the first page.
+    pending = like_buffer.pending_for(user_id) if app.config['LIKE_BUFFER_ENABLED'] else {}
+    unliked_ids = [message_id for (message_id, (liked, _)) in pending.items() if not liked]
+
+    if unliked_ids:
+        query = query.filter(all_likes.c.message_id.notin_(unliked_ids))
+
+    cursor = get_cursor()
+    (rows, next_cursor) = paginate(query, all_likes.c.liked_at, all_likes.c.message_id,
+                                   cursor, app.config['LIKES_PER_PAGE'])
+    liked_ids = [message_id for (_, message_id) in rows]
+
+    if cursor is None:
+        pending_ids = [message_id for (_, message_id)
+                       in sorted(((at, message_id) for (message_id, (is_like, at))
+                                  in pending.items() if is_like), reverse=True)]
+        liked_ids = [message_id for message_id in pending_ids
+                     if message_id not in liked_ids] + liked_ids
+
+    messages = {msg.id: msg for table in (Message, ArchivedMessage)
+                for msg in db.session.scalars(db.select(table).where(table.id.in_(liked_ids)))}
+    likes = [messages[message_id] for message_id in liked_ids if message_id in messages]
+
+    return render_template("users/likes.jinja2", user=user, likes=likes, next_cursor=next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@limiter.limit("follows")
 def add_follow(follow_id):
     """
     Add a follow for the currently-logged-in user.
@@ -235,8 +872,26 @@ def add_follow(follow_id):
         return redirect(url_for("homepage"))
 
     followed_user = db.get_or_404(User, follow_id)
+
+    # Already following (e.g. a double-submitted form): nothing to do, and nothing to count twice
+    if db.session.get(Follow, (follow_id, g.user.id)) is not None:
+        return redirect(url_for("show_following", user_id=g.user.id))
+
     g.user.following.append(followed_user)
+    followed_user.follower_count = User.follower_count + 1
+    discard_suggestion(g.user.id, followed_user.id)
+    db.session.flush()
+
+    if pushes_messages(followed_user):
+        fill_timelines(app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'],
+                       app.config['TIMELINE_FANOUT_BACKFILL'],
+                       user_ids=[g.user.id],
+                       author_id=followed_user.id)
+
     db.session.commit()
+    follow_graph.add(g.user.id, followed_user.id)
+    page_cache.invalidate(f"user:{g.user.id}", f"user:{followed_user.id}")
+    jobs.enqueue("refresh_suggestions", user_id=g.user.id)
 
     return redirect(url_for("show_following", user_id=g.user.id))
 
@@ -259,12 +914,24 @@ def stop_following(follow_id):
         db.session.rollback()
         return redirect(url_for("show_following", user_id=g.user.id))
 
+    followed_user.follower_count = User.follower_count - 1
+    drop_author(g.user.id, followed_user.id)
     db.session.commit()
+    follow_graph.remove(g.user.id, followed_user.id)
+    page_cache.invalidate(f"user:{g.user.id}", f"user:{followed_user.id}")
+    jobs.enqueue("refresh_suggestions", user_id=g.user.id)
+
+    # Just dropped back to the threshold: their messages are pushed again from now on, so push
+    # the ones the remaining followers have been pulling
+    if (app.config['TIMELINE_ENGINE'] == "hybrid" and
+            followed_user.follower_count == app.config['TIMELINE_FANOUT_MAX_FOLLOWERS']):
+        jobs.enqueue("fan_out_author", author_id=followed_user.id)
 
     return redirect(url_for("show_following", user_id=g.user.id))
 
 
 @app.route("/users/add_like/<int:msg_id>", methods=["POST"])
+@limiter.limit("likes")
 def add_like(msg_id):
     """
     Like a message for the currently-logged-in user.
@@ -276,14 +943,25 @@ def add_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for("homepage"))
 
-    message = db.session.get(Message, msg_id)
+    author_id = db.session.scalar(db.select(Message.user_id).where(Message.id == msg_id))
+
+    if author_id is None:
+        abort(404)
 
-    if message.user_id == g.user.id:
+    if author_id == g.user.id:
         flash("You cannot like your own messages!")
         return redirect(url_for("homepage"))
 
-    g.user.likes.append(message)
-    db.session.commit()
+    # The user's profile shows their likes count
+    page_cache.invalidate(f"user:{g.user.id}")
+
+    if app.config['LIKE_BUFFER_ENABLED']:
+        like_buffer.like(g.user.id, msg_id)
+
+    # Insert the like directly, rather than loading all of the user's likes to append to them
+    elif insert_likes([(g.user.id, msg_id, 0.0)]):
+        db.session.commit()
+        trending.record_like(msg_id)
 
     return redirect(url_for("display_likes", user_id=g.user.id))
 
@@ -298,15 +976,18 @@ def remove_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for("homepage"))
 
-    message = db.session.get(Message, msg_id)
+    page_cache.invalidate(f"user:{g.user.id}")
 
-    try:
-        g.user.likes.remove(message)
-    except ValueError:
-        db.session.rollback()
-        return redirect(url_for("display_likes", user_id=g.user.id))
+    if app.config['LIKE_BUFFER_ENABLED']:
+        like_buffer.unlike(g.user.id, msg_id)
 
-    db.session.commit()
+    else:
+        removed = delete_likes([(g.user.id, msg_id)])
+        db.session.commit()
+
+        # Only a like that still counts towards trending is taken back from it
+        for (_, age) in removed:
+            trending.record_like(msg_id, -1, age=age)
 
     return redirect(url_for("display_likes", user_id=g.user.id))
 
@@ -327,11 +1008,18 @@ def profile():
 
     if form.validate_on_submit():
 
+        # Check for a taken username or email first, which is cheaper than checking the password
+        if (taken_names.is_taken("username", form.username.data, exclude_user_id=user.id) or
+                taken_names.is_taken("email", form.email.data, exclude_user_id=user.id)):
+            flash("Username or email already taken", 'danger')
+            return render_template("/users/edit.jinja2", form=form)
+
         # Check if password is correct
         if not User.authenticate(user.username, form.password.data):
             flash("Password incorrect.", category="danger")
             return redirect(url_for("homepage"))
 
+        old_username = user.username
         user.username = form.username.data
         user.email = form.email.data
         user.image_url = form.image_url.data or User.image_url.server_default.arg
@@ -348,16 +1036,47 @@ def profile():
             flash("Username or email already taken", 'danger')
             return render_template("/users/edit.jinja2", form=form)
 
+        taken_names.add(username=user.username, email=user.email)
+        username_index.rename(user.id, old_username, user.username)
+        page_cache.invalidate(f"user:{user.id}")
         flash("User updated!", category="success")
         return redirect(url_for("users_show", user_id=user.id))
 
     return render_template("/users/edit.jinja2", form=form)
 
 
+@app.route('/users/export')
+def export_user():
+    """
+    Download the logged-in user's messages, likes and follows.
+
+    Takes a 'format' param in querystring: "jsonl" (JSON Lines, the default) or "csv". The file is
+    streamed as it is read from the database.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect(url_for("homepage"))
+
+    format = request.args.get('format', 'jsonl')
+
+    if format not in EXPORT_FORMATS:
+        abort(400)
+
+    filename = f"warbler-{g.user.username}.{format}"
+
+    return Response(stream_with_context(export_lines(g.user.id, format)),
+                    mimetype=EXPORT_FORMATS[format],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
     """
     Delete user.
+
+    The account is deactivated immediately; its messages, likes and follows are purged in
+    bounded batches after the response, so the request stays fast and holds no long locks.
     """
 
     if not g.user:
@@ -365,9 +1084,15 @@ def delete_user():
         return redirect(url_for("homepage"))
 
     do_logout()
+    (user_id, username) = (g.user.id, g.user.username)
 
-    db.session.delete(g.user)
+    # Deactivate now (a single-row update); the user's data is purged in batches afterwards
+    g.user.is_active = False
     db.session.commit()
+    username_index.remove(user_id, username)
+    page_cache.invalidate(f"user:{user_id}")
+
+    jobs.enqueue("purge_user", idempotency_key=f"purge_user:{user_id}", user_id=user_id)
 
     return redirect(url_for("signup"))
 
@@ -376,6 +1101,7 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@limiter.limit("messages")
 def messages_add():
     """
     Add a message:
@@ -392,37 +1118,173 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+
+        # Index hashtags and mentions now, so their feeds never have to scan message text
+        db.session.flush()
+        index_messages([msg])
+
         db.session.commit()
+        broker.publish(g.user.id, msg.id)
+        recent_cache.add(g.user.id, msg.timestamp, msg.id)
+        page_cache.invalidate(f"user:{g.user.id}")
+
+        # Fan out on write, unless the author has too many followers (they are pulled instead)
+        if pushes_messages(g.user):
+            jobs.enqueue("fan_out_message", author_id=g.user.id, message_id=msg.id)
 
         return redirect(url_for("users_show", user_id=g.user.id))
 
     return render_template('messages/new.jinja2', form=form)
 
 
+@app.route('/api/messages/import', methods=["POST"])
+@limiter.limit("imports")
+def messages_import():
+    """
+    Import a batch of the logged-in user's messages, e.g. history from another platform.
+
+    Takes a JSON body {"messages": [{"text": ..., "timestamp": ...}, ...]}, where timestamps are
+    optional ISO 8601 strings. Either every message is imported or, if any is invalid, none are.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    records = (request.get_json(silent=True) or {}).get("messages")
+
+    if not isinstance(records, list):
+        return jsonify(error='Expected a JSON object with a "messages" list.'), 400
+
+    if len(records) > app.config['IMPORT_MAX_MESSAGES']:
+        return jsonify(error=f"At most {app.config['IMPORT_MAX_MESSAGES']} messages per "
+                             "import."), 413
+
+    try:
+        imported = import_messages(g.user.id, records, app.config['IMPORT_CHUNK_SIZE'])
+
+    except IngestError as exc:
+        db.session.rollback()
+        return jsonify(error=str(exc),
+                       errors=[{"index": i, "error": reason} for (i, reason) in exc.errors]), 400
+
+    db.session.commit()
+
+    # Imported messages may be newer than some cached ones, or older; either way, reload
+    recent_cache.invalidate(g.user.id)
+    page_cache.invalidate(f"user:{g.user.id}")
+
+    if pushes_messages(g.user):
+        jobs.enqueue("fan_out_author", author_id=g.user.id)
+
+    return jsonify(imported=imported), 201
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@page_cache.cached
 def messages_show(message_id):
     """
-    Show a message.
+    Show a message (which may have been archived).
     """
 
-    msg = db.session.get(Message, message_id)
+    msg = get_message_or_404(message_id)
+
+    if not msg.user.is_active:
+        abort(404)
+
+    page_cache.tag(f"message:{message_id}", f"user:{msg.user_id}")
+
     return render_template('messages/show.jinja2', message=msg)
 
 
+@app.route('/messages/trending')
+def messages_trending():
+    """
+    Show recent messages ranked by time-decayed like counts.
+    """
+
+    ranking = trending.top(limit=100)
+    since = db.func.now() - timedelta(seconds=app.config['TRENDING_WINDOW_SECONDS'])
+
+    found = (Message
+             .query
+             .filter(Message.id.in_([msg_id for (msg_id, _) in ranking]))
+             .filter(Message.timestamp >= since)
+             .all())
+
+    msgs_by_id = {msg.id: msg for msg in found}
+    messages = [msgs_by_id[msg_id] for (msg_id, _) in ranking if msg_id in msgs_by_id]
+
+    return render_template('messages/feed.jinja2', messages=messages,
+                           title="Trending Warbles",
+                           empty_text="Nothing is trending right now")
+
+
+@app.route('/tags/<tag>')
+def tag_feed(tag):
+    """
+    Show messages with a given hashtag, newest first, a page at a time.
+    """
+
+    tag = tag.lower()
+    query = (db.session
+             .query(Message, MessageTag.timestamp, MessageTag.message_id)
+             .join(MessageTag, MessageTag.message_id == Message.id)
+             .filter(MessageTag.tag == tag))
+
+    (rows, next_cursor) = paginate(query, MessageTag.timestamp, MessageTag.message_id,
+                                   get_cursor(), app.config['FEED_PER_PAGE'])
+    messages = [msg for (msg, _, _) in rows]
+
+    next_url = next_cursor and url_for('tag_feed', tag=tag, before=next_cursor)
+
+    return render_template('messages/feed.jinja2', messages=messages, next_url=next_url,
+                           title=f"#{tag}",
+                           empty_text="No warbles with this tag yet")
+
+
+@app.route('/users/mentions')
+def mentions_feed():
+    """
+    Show messages that @mention the currently-logged-in user, newest first.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect(url_for("homepage"))
+
+    query = (db.session
+             .query(Message, Mention.timestamp, Mention.message_id)
+             .join(Mention, Mention.message_id == Message.id)
+             .filter(Mention.user_id == g.user.id))
+
+    (rows, next_cursor) = paginate(query, Mention.timestamp, Mention.message_id,
+                                   get_cursor(), app.config['FEED_PER_PAGE'])
+    messages = [msg for (msg, _, _) in rows]
+
+    next_url = next_cursor and url_for('mentions_feed', before=next_cursor)
+
+    return render_template('messages/feed.jinja2', messages=messages, next_url=next_url,
+                           title="Mentions",
+                           empty_text="Nobody has mentioned you yet")
+
+
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """
     Delete a message.
     """
 
-    msg = db.session.get(Message, message_id)
+    msg = get_message_or_404(message_id)
 
-    if not g.user or g.user is not msg.user:
+    if not g.user or g.user.id != msg.user_id:
         flash("Access unauthorized.", "danger")
         return redirect(url_for("homepage"))
 
     db.session.delete(msg)
     db.session.commit()
+    trending.forget_message(message_id)
+    recent_cache.invalidate(g.user.id)
+    page_cache.invalidate(f"message:{message_id}", f"user:{g.user.id}")
 
     return redirect(url_for("users_show", user_id=g.user.id))
 
@@ -431,6 +1293,7 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 @app.route('/')
+@page_cache.cached
 def homepage():
     """
     Show homepage:
@@ -440,21 +1303,183 @@ def homepage():
     """
 
     if g.user:
-        following = [f.id for f in g.user.following]
-        messages = (Message
-                    .query
-                    .filter((Message.user == g.user) | (Message.user_id.in_(following)))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        likes = g.user.likes
+        messages = home_timeline(followee_ids(g.user.id) + [g.user.id], user_id=g.user.id)
+
+        # Index-only lookup on the likes primary key, for just the messages on the page
+        liked_ids = set(db.session.scalars(
+            db.select(Like.message_id)
+            .where(Like.user_id == g.user.id)
+            .where(Like.message_id.in_([msg.id for msg in messages]))))
+
+        if app.config['LIKE_BUFFER_ENABLED']:
+            liked_ids = like_buffer.overlay(g.user.id, liked_ids)
 
-        return render_template('home.jinja2', messages=messages, likes=likes)
+        suggestions = get_suggestions(g.user.id)
+
+        return stream_page('home.jinja2', messages=messages, liked_ids=liked_ids,
+                           suggestions=suggestions)
 
     else:
         return render_template('home-anon.jinja2')
 
 
+###################################################################################################
+# Live timeline updates
+
+def followee_ids(user_id):
+    """
+    Get the IDs of the users that `user_id` follows.
+    """
+
+    if app.config['FOLLOW_GRAPH_ENABLED']:
+        return follow_graph.following_ids(user_id)
+
+    return db.session.scalars(db.select(Follow.user_being_followed_id)
+                              .where(Follow.user_following_id == user_id)).all()
+
+
+def timeline_since(author_ids, since_id, limit=100):
+    """
+    Get up to `limit` of the newest messages by `author_ids` with an ID above `since_id`, oldest
+    first.
+    """
+
+    messages = (Message
+                .query
+                .filter(Message.user_id.in_(author_ids))
+                .filter(Message.id > since_id)
+                .order_by(Message.id.desc())
+                .limit(limit)
+                .all())
+
+    return messages[::-1]
+
+
+def timeline_fragment(msg):
+    """
+    Render a message as a timeline list item, for inserting into an open timeline.
+    """
+
+    return {"id": msg.id,
+            "html": render_template('messages/_timeline_item.jinja2', msg=msg, liked_ids=set())}
+
+
+@app.route('/api/timeline')
+def timeline_since_view():
+    """
+    Return the logged-in user's timeline messages newer than the 'since_id' param, as JSON.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    since_id = request.args.get('since_id', 0, type=int)
+    author_ids = followee_ids(g.user.id) + [g.user.id]
+    messages = timeline_since(author_ids, since_id)
+
+    return jsonify(messages=[timeline_fragment(msg) for msg in messages],
+                   last_id=messages[-1].id if messages else since_id)
+
+
+@app.route('/api/timeline/stream')
+def timeline_stream():
+    """
+    Stream new timeline messages for the logged-in user as Server-Sent Events.
+
+    Catches up from the Last-Event-ID header (or 'since_id' param) first, then pushes each new
+    message by a followed user as it is posted. The stream closes after TIMELINE_STREAM_SECONDS;
+    browsers reconnect automatically, resuming from the last event ID.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    since_id = request.headers.get('Last-Event-ID', type=int)
+
+    if since_id is None:
+        since_id = request.args.get('since_id', type=int)
+
+    user_id = g.user.id
+    author_ids = followee_ids(user_id) + [user_id]
+
+    def event(msg):
+        return f"id: {msg.id}\nevent: message\ndata: {json.dumps(timeline_fragment(msg))}\n\n"
+
+    def events():
+
+        # Subscribe before catching up, so nothing posted in between is missed
+        subscription = broker.subscribe(author_ids)
+        last_id = since_id or 0
+
+        try:
+            yield "retry: 5000\n\n"
+
+            if since_id is not None:
+                for msg in timeline_since(author_ids, since_id):
+                    last_id = msg.id
+                    yield event(msg)
+
+            # Don't hold a pooled connection while waiting
+            db.session.close()
+
+            deadline = time.monotonic() + app.config['TIMELINE_STREAM_SECONDS']
+
+            while (remaining := deadline - time.monotonic()) > 0:
+                message_id = subscription.get(
+                    timeout=min(app.config['TIMELINE_HEARTBEAT_SECONDS'], remaining))
+
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    yield "event: resync\ndata: {}\n\n"
+
+                if message_id is None:
+                    yield ": keepalive\n\n"
+                    continue
+
+                if message_id <= last_id:
+                    continue
+
+                msg = db.session.get(Message, message_id)
+
+                if msg is not None:
+                    last_id = msg.id
+                    yield event(msg)
+
+                db.session.close()
+
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(stream_with_context(events()),
+                    mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+###################################################################################################
+# Process metrics
+
+@app.route('/debug/metrics')
+def debug_metrics():
+    """
+    Dump this process's counters as JSON: bytes sent per endpoint before and after compression,
+    and the hit, miss and error counts of the job queue, caches, rate limiter and like buffer.
+
+    Only served in debug mode or with METRICS_ENDPOINT_ENABLED; the counters are per process, so
+    each worker answers for itself.
+    """
+
+    if not (app.debug or app.config['METRICS_ENDPOINT_ENABLED']):
+        abort(404)
+
+    # Copied first, as other threads may be counting while the response is built
+    return jsonify(compression=dict(compressor.stats),
+                   jobs=dict(jobs.metrics),
+                   recent_messages=dict(recent_cache.metrics),
+                   rate_limits=dict(limiter.metrics),
+                   like_buffer=dict(like_buffer.metrics),
+                   page_cache=dict(page_cache.metrics))
+
+
 ###################################################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -465,9 +1490,13 @@ def homepage():
 @app.after_request
 def add_header(req):
     """
-    Add non-caching headers on every request.
+    Add non-caching headers on every request, unless the response sets its own max-age (e.g.
+    thumbnails).
     """
 
+    if req.cache_control.max_age:
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
@@ -475,6 +1504,330 @@ def add_header(req):
     return req
 
 
+###################################################################################################
+# CLI commands
+
+@app.cli.command("refresh-suggestions")
+def refresh_suggestions_command():
+    """
+    Recompute "who to follow" suggestions for all users (run periodically, e.g. from cron).
+    """
+
+    connect_db(app)
+    refresh_suggestions(per_user=app.config['SUGGESTIONS_PER_USER'])
+    db.session.commit()
+
+
+@app.cli.command("archive-messages")
+def archive_messages_command():
+    """
+    Move messages older than ARCHIVE_AFTER_DAYS into the archive (run periodically, e.g. nightly).
+    """
+
+    connect_db(app)
+
+    cutoff = db.func.now() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+    archived = archive_messages(cutoff, app.config['ARCHIVE_BATCH_SIZE'])
+
+    click.echo(f"Archived {archived} messages.")
+
+
+@app.cli.command("export-user")
+@click.argument("username")
+@click.option("--format", type=click.Choice(list(EXPORT_FORMATS)), default="jsonl")
+@click.option("--output", type=click.File("w"), default=sys.stdout,
+              help="File to write to (default: standard output).")
+def export_user_command(username, format, output):
+    """
+    Export a user's messages, likes and follows.
+    """
+
+    connect_db(app)
+
+    user = User.query.filter_by(username=username).first()
+
+    if user is None:
+        raise click.ClickException(f"No such user: {username}")
+
+    for line in export_lines(user.id, format):
+        output.write(line)
+
+
+@app.cli.command("import-messages")
+@click.argument("username")
+@click.argument("file", type=click.File("r"))
+def import_messages_command(username, file):
+    """
+    Import messages for a user from a JSON Lines file.
+
+    Each line is an object with "text" and (optionally) "timestamp"; files from `flask export-user`
+    work too, as only their "message" records are imported.
+    """
+
+    connect_db(app)
+
+    user = User.query.filter_by(username=username).first()
+
+    if user is None:
+        raise click.ClickException(f"No such user: {username}")
+
+    records = [record for record in map(json.loads, filter(str.strip, file))
+               if record.get("type", "message") == "message"]
+
+    try:
+        imported = import_messages(user.id, records, app.config['IMPORT_CHUNK_SIZE'])
+
+    except IngestError as exc:
+        db.session.rollback()
+        details = "\n".join(f"  message {i + 1}: {reason}" for (i, reason) in exc.errors)
+        raise click.ClickException(f"{exc}, nothing imported:\n{details}")
+
+    db.session.commit()
+    click.echo(f"Imported {imported} messages.")
+
+
+@app.cli.command("partition-messages")
+def partition_messages_command():
+    """
+    Convert the messages table into one partitioned by month (see partitioning.py).
+    """
+
+    connect_db(app)
+    partition_messages(months_ahead=app.config['MESSAGE_PARTITION_MONTHS_AHEAD'])
+    db.session.commit()
+
+
+@app.cli.command("create-message-partitions")
+def create_message_partitions_command():
+    """
+    Create message partitions for the coming months (run periodically, e.g. from cron).
+    """
+
+    connect_db(app)
+
+    if not is_partitioned():
+        click.echo("The messages table is not partitioned; nothing to do.")
+        return
+
+    today = date.today()
+    created = create_partitions(today,
+                                add_months(today, app.config['MESSAGE_PARTITION_MONTHS_AHEAD']))
+    db.session.commit()
+
+    click.echo(f"Created partitions: {', '.join(created)}" if created else "No partitions needed.")
+
+
+@app.cli.command("benchmark-timeline")
+@click.argument("username")
+@click.option("--runs", type=click.IntRange(min=1), default=20, show_default=True)
+def benchmark_timeline_command(username, runs):
+    """
+    Time building a user's home timeline with each TIMELINE_ENGINE.
+    """
+
+    connect_db(app)
+
+    user = User.query.filter_by(username=username).first()
+
+    if user is None:
+        raise click.ClickException(f"No such user: {username}")
+
+    author_ids = followee_ids(user.id) + [user.id]
+    results = {}
+
+    for engine in ("sql", "merge"):
+        app.config['TIMELINE_ENGINE'] = engine
+        recent_cache.clear()
+        timings = []
+
+        for _ in range(runs + 1):
+            db.session.expunge_all()
+            started = time.perf_counter()
+            messages = home_timeline(author_ids)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        results[engine] = [msg.id for msg in messages]
+
+        # The first run fills the cache (for "merge"), so report it separately
+        (first, warm) = (timings[0], sorted(timings[1:]))
+        click.echo(f"{engine:>5}: first {first:7.2f} ms, median {warm[len(warm) // 2]:7.2f} ms, "
+                   f"max {warm[-1]:7.2f} ms ({len(author_ids)} authors, {len(messages)} messages)")
+
+    if results["sql"] != results["merge"]:
+        raise click.ClickException("The engines returned different timelines.")
+
+
+@app.cli.command("benchmark-fanout")
+@click.argument("username")
+@click.option("--runs", type=click.IntRange(min=1), default=20, show_default=True)
+def benchmark_fanout_command(username, runs):
+    """
+    Compare hybrid timelines at both extremes of TIMELINE_FANOUT_MAX_FOLLOWERS (pull everything,
+    push everything) and at its configured value: write amplification (timeline entries written
+    per message posted, site-wide) and the time to read the user's home timeline.
+
+    The user's timeline entries are rebuilt for each threshold, then rolled back.
+    """
+
+    connect_db(app)
+
+    user = User.query.filter_by(username=username).first()
+
+    if user is None:
+        raise click.ClickException(f"No such user: {username}")
+
+    author_ids = followee_ids(user.id) + [user.id]
+    expected = [msg.id for msg in recent_messages(author_ids)]
+    configured = app.config['TIMELINE_FANOUT_MAX_FOLLOWERS']
+    most_followers = db.session.scalar(db.select(db.func.max(User.follower_count)))
+
+    app.config['TIMELINE_ENGINE'] = "hybrid"
+
+    for (label, threshold) in (("pull all", -1),
+                               ("configured", configured),
+                               ("push all", most_followers)):
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = threshold
+
+        rows_per_message = db.session.scalar(
+            db.select(db.func.avg(db.case((User.follower_count <= threshold,
+                                           User.follower_count),
+                                          else_=0)))
+            .select_from(Message)
+            .join(User, User.id == Message.user_id)) or 0
+        pulled = db.session.scalar(db.select(db.func.count())
+                                   .where(User.id.in_(author_ids))
+                                   .where(User.follower_count > threshold))
+
+        rebuild_timelines([user.id], threshold, app.config['TIMELINE_FANOUT_BACKFILL'])
+        recent_cache.clear()
+        timings = []
+
+        for _ in range(runs + 1):
+            started = time.perf_counter()
+            messages = home_timeline(author_ids, user_id=user.id)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        (first, warm) = (timings[0], sorted(timings[1:]))
+        click.echo(f"{label:>10} (max {threshold} followers): "
+                   f"{float(rows_per_message):8.1f} rows written per message; "
+                   f"read first {first:7.2f} ms, median {warm[len(warm) // 2]:7.2f} ms, "
+                   f"max {warm[-1]:7.2f} ms ({pulled}/{len(author_ids)} authors pulled)")
+
+        if [msg.id for msg in messages] != expected:
+            db.session.rollback()
+            raise click.ClickException(f"The {label} timeline differs from the SQL engine's.")
+
+    db.session.rollback()
+
+
+@app.cli.command("jobs-worker")
+def jobs_worker_command():
+    """
+    Work jobs from the database-backed job queue until interrupted.
+    """
+
+    connect_db(app)
+    DatabaseBackend(jobs, workers=0, poll_interval=app.config['JOBS_POLL_INTERVAL'],
+                    lease=app.config['JOBS_LEASE_SECONDS']).run_worker()
+
+
+###################################################################################################
+# Maintenance CLI commands (see maintenance.py); interrupted commands resume where they left off
+
+maintenance_cli = AppGroup("maintenance", help="Maintenance commands for large datasets.")
+app.cli.add_command(maintenance_cli)
+
+batch_size_option = click.option("--batch-size", type=click.IntRange(min=1), default=None,
+                                 help="Rows per transaction (default: MAINTENANCE_BATCH_SIZE).")
+restart_option = click.option("--restart", is_flag=True,
+                              help="Start over instead of resuming from the last checkpoint.")
+tables_argument = click.argument("tables", nargs=-1, metavar="[TABLE]...",
+                                 type=click.Choice(maintenance.table_names()))
+
+
+@maintenance_cli.command("recompute")
+@click.argument("what",
+                type=click.Choice(["tags", "suggestions", "follower-counts", "timelines"]))
+@batch_size_option
+@restart_option
+def recompute_command(what, batch_size, restart):
+    """
+    Recompute derived data: the hashtag/mention indexes, "who to follow" suggestions, follower
+    counts, or hybrid timelines' pushed entries.
+    """
+
+    connect_db(app)
+    maintenance.recompute(what,
+                          batch_size or app.config['MAINTENANCE_BATCH_SIZE'],
+                          restart,
+                          click.echo,
+                          suggestions_per_user=app.config['SUGGESTIONS_PER_USER'],
+                          fanout_max_followers=app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'],
+                          fanout_backfill=app.config['TIMELINE_FANOUT_BACKFILL'])
+
+
+@maintenance_cli.command("vacuum")
+@tables_argument
+@click.option("--analyze-only", is_flag=True, help="Only update planner statistics.")
+def vacuum_command(tables, analyze_only):
+    """
+    VACUUM (ANALYZE) the given tables, or all tables.
+    """
+
+    connect_db(app)
+    maintenance.vacuum(list(tables), analyze_only, click.echo)
+
+
+@maintenance_cli.command("reindex")
+@tables_argument
+def reindex_command(tables):
+    """
+    Rebuild the indexes of the given tables, or all tables, without blocking writes.
+    """
+
+    connect_db(app)
+    maintenance.reindex(list(tables), click.echo)
+
+
+@maintenance_cli.command("check-orphans")
+@click.option("--delete", "delete_them", is_flag=True, help="Delete the orphaned rows found.")
+@batch_size_option
+def check_orphans_command(delete_them, batch_size):
+    """
+    Find follows, likes, tags and mentions that point at users or messages that don't exist.
+    """
+
+    connect_db(app)
+    found = maintenance.check_orphans(delete_them,
+                                      batch_size or app.config['MAINTENANCE_BATCH_SIZE'],
+                                      click.echo)
+
+    if any(found.values()) and not delete_them:
+        raise click.ClickException("Orphaned rows found; run again with --delete to remove them.")
+
+
+@maintenance_cli.command("generate-data")
+@click.option("--users", type=click.IntRange(min=1), default=1000, show_default=True)
+@click.option("--messages", type=click.IntRange(min=0), default=100, show_default=True,
+              help="Messages per user.")
+@click.option("--follows", type=click.IntRange(min=0), default=50, show_default=True,
+              help="Follows per user.")
+@click.option("--likes", type=click.IntRange(min=0), default=50, show_default=True,
+              help="Likes per user.")
+@batch_size_option
+@restart_option
+def generate_data_command(users, messages, follows, likes, batch_size, restart):
+    """
+    Add benchmark users ("bench1", ...; password "password") with messages, follows and likes.
+    """
+
+    connect_db(app)
+    maintenance.generate_data(users, messages, follows, likes,
+                              batch_size or app.config['MAINTENANCE_BATCH_SIZE'],
+                              restart,
+                              click.echo)
+
+
 ###################################################################################################
 # MAIN
 
@@ -485,4 +1838,10 @@ if __name__ == "__main__":
     with app.app_context():
         db.create_all()
 
-    app.run(host='127.0.0.1', port=5000, debug=True, threaded=False)
+    # The reloader runs this module twice: in a process that watches for changes, then in the
+    # server process it restarts (with WERKZEUG_RUN_MAIN set). Only the server refreshes.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_refresher(app, app.config['SUGGESTIONS_REFRESH_SECONDS'])
+
+    # Threaded, so open timeline streams don't block other requests
+    app.run(host='127.0.0.1', port=5000, debug=True, threaded=True)
@@ -0,0 +1,84 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Cold storage for old messages.
+
+Messages older than a cutoff are moved, in batches, from messages into archived_messages, keeping
+the hot table (and its indexes) down to recent history. Each batch is a single statement that
+deletes the rows from messages and inserts them into the archive, so a message is never in both
+tables or neither. The messages' likes are copied into archived_likes by the same statement,
+before the delete cascades to them; their tags, mentions and timeline entries are dropped. Reads
+fall back to the archive only when the hot table can't answer.
+"""
+
+from sqlalchemy import delete, func, insert, select
+
+from models import db, ArchivedLike, ArchivedMessage, Like, Message
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def archive_messages(cutoff, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Move every message posted before `cutoff` (a datetime or SQL expression) into the archive,
+    oldest first.
+
+    Commits after each batch of at most `batch_size` messages. Returns the number archived.
+    """
+
+    messages = Message.__table__.c
+    likes = Like.__table__.c
+    total = 0
+
+    while True:
+        batch = (select(messages.id)
+                 .where(messages.timestamp < cutoff)
+                 .order_by(messages.timestamp)
+                 .limit(batch_size)
+                 .with_for_update(skip_locked=True))
+
+        moved = (delete(Message.__table__)
+                 .where(messages.id.in_(batch))
+                 .returning(messages.id, messages.text, messages.timestamp, messages.user_id)
+                 .cte("moved"))
+
+        # Every part of the statement sees the same snapshot, so the likes are still there to count
+        like_count = (select(func.count())
+                      .where(likes.message_id == moved.c.id)
+                      .scalar_subquery())
+
+        # ... and to copy (the delete only cascades to them once the statement is done)
+        moved_likes = (insert(ArchivedLike)
+                       .from_select(["user_id", "message_id", "liked_at"],
+                                    select(likes.user_id, likes.message_id, likes.liked_at)
+                                    .join(moved, moved.c.id == likes.message_id))
+                       .cte("moved_likes"))
+
+        stmt = (insert(ArchivedMessage)
+                .from_select(["id", "text", "timestamp", "user_id", "like_count"],
+                             select(moved.c.id, moved.c.text, moved.c.timestamp, moved.c.user_id,
+                                    like_count))
+                .add_cte(moved)
+                .add_cte(moved_likes))
+
+        result = db.session.execute(stmt)
+        db.session.commit()
+
+        total += result.rowcount
+
+        if result.rowcount < batch_size:
+            return total
+
+
+def archived_messages(user_id, limit, before=None):
+    """
+    Get up to `limit` of a user's archived messages, newest first (older than `before`, if given).
+    """
+
+    query = ArchivedMessage.query.filter(ArchivedMessage.user_id == user_id)
+
+    if before is not None:
+        query = query.filter(ArchivedMessage.timestamp < before)
+
+    return query.order_by(ArchivedMessage.timestamp.desc()).limit(limit).all()
@@ -0,0 +1,183 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Username and email availability checks, answered before a password is hashed.
+
+Each process keeps a Bloom filter of the usernames and of the emails in the users table. A filter
+never says "no" about a value it was given, so a miss means the value is free with no database
+round-trip; a hit may be a false positive (about `error_rate` of the time), so it is confirmed with
+a lookup on the column's unique index. The filters only grow: values freed by renames or deleted
+accounts stay in them, costing at most an extra lookup, until the next rebuild (every `max_age`
+seconds, or once more values have been added than the filters were sized for). The rebuild happens
+in whichever request first finds the filters stale, while other requests keep using the old ones.
+Values taken by other processes since the last rebuild are missed; the unique constraints still
+catch those.
+"""
+
+import math
+import threading
+import time
+from collections import Counter
+from hashlib import blake2b
+
+from sqlalchemy import select
+
+from models import db, User
+
+FIELDS = ("username", "email")
+MIN_CAPACITY = 1000
+YIELD_PER = 10_000
+
+
+class BloomFilter:
+    """
+    Set membership with false positives but no false negatives, in about 10 bits per value at a
+    1% error rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        """
+        The value's bit positions, by double hashing one 128-bit digest.
+        """
+
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        (h1, h2) = (int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little"))
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(value))
+
+
+class TakenNames:
+    """
+    Which usernames and emails are taken: a Bloom filter per column in front of its unique index.
+    """
+
+    def __init__(self, error_rate=0.01, max_age=3600, clock=time.monotonic):
+        self.error_rate = error_rate
+        self.max_age = max_age
+        self.clock = clock
+        self.metrics = Counter()
+
+        self._filters = None
+        self._built_at = None
+        self._building = False
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Build the filters from the users table, sized for twice the current number of users.
+        """
+
+        with self._lock:
+            self._building = True
+            self._pending = []
+
+        try:
+            capacity = max(MIN_CAPACITY, 2 * db.session.scalar(select(db.func.count(User.id))))
+            filters = {field: BloomFilter(capacity, self.error_rate) for field in FIELDS}
+
+            rows = db.session.execute(select(User.username, User.email)
+                                      .execution_options(yield_per=YIELD_PER))
+
+            for (username, email) in rows:
+                filters["username"].add(username)
+                filters["email"].add(email)
+
+        finally:
+            with self._lock:
+                self._building = False
+
+        with self._lock:
+            # Values added while the table was being read may have been missed
+            for (field, value) in self._pending:
+                filters[field].add(value)
+
+            self._filters = filters
+            self._built_at = self.clock()
+            self._pending = []
+
+        self.metrics["loads"] += 1
+
+    def expire(self):
+        """
+        Rebuild on next use (e.g. after users were added or renamed in bulk).
+        """
+
+        with self._lock:
+            self._built_at = None
+
+    def add(self, **values):
+        """
+        Record newly taken values, e.g. add(username="bob", email="bob@example.com").
+        """
+
+        with self._lock:
+            if self._building:
+                self._pending.extend(values.items())
+
+            if self._filters is None:
+                return
+
+            for (field, value) in values.items():
+                self._filters[field].add(value)
+
+                # Past capacity the error rate climbs; rebuild at a bigger size on next use
+                if self._filters[field].count > self._filters[field].capacity:
+                    self._built_at = None
+
+    def is_taken(self, field, value, exclude_user_id=None):
+        """
+        Is `value` some user's `field` ("username" or "email")? A user's own value doesn't count
+        as taken for them if their ID is given as `exclude_user_id`.
+        """
+
+        if value not in self._snapshot()[field]:
+            self.metrics["filter_misses"] += 1
+            return False
+
+        self.metrics["index_lookups"] += 1
+
+        column = getattr(User, field)
+        query = select(User.id).where(column == value)
+
+        if exclude_user_id is not None:
+            query = query.where(User.id != exclude_user_id)
+
+        return db.session.scalar(select(query.exists()))
+
+    def _snapshot(self):
+        """
+        The current filters, rebuilding them first if they are missing or stale (and no other
+        thread is already at it).
+        """
+
+        with self._lock:
+            stale = self._built_at is None or self.clock() - self._built_at >= self.max_age
+            rebuild = stale and not self._building
+            filters = self._filters
+
+        if rebuild or filters is None:
+            self.load()
+
+            with self._lock:
+                filters = self._filters
+
+        return filters
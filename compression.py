@@ -0,0 +1,228 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Response compression, negotiated from the Accept-Encoding header.
+
+Text responses at or above a size threshold are compressed with brotli (if the Brotli package is
+installed and the client accepts it) or gzip. Streamed text responses (e.g. streamed pages) are
+compressed as they are sent, each chunk flushed through the compressor so the client can render it
+right away; other streams (e.g. the timeline event stream) and file responses are passed through
+untouched. Raw and on-the-wire byte counts are kept per endpoint, so the effect of compression and
+template changes can be measured.
+"""
+
+import gzip
+import threading
+import zlib
+from collections import Counter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import request
+
+COMPRESSIBLE_MIMETYPES = frozenset([
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+])
+
+
+def parse_accept_encoding(header):
+    """
+    Map each encoding in an Accept-Encoding header to its quality value.
+    """
+
+    accepted = {}
+
+    for part in (header or "").split(","):
+        (coding, *params) = [item.strip() for item in part.split(";")]
+
+        if not coding:
+            continue
+
+        quality = 1.0
+
+        for param in params:
+            (name, _, value) = param.partition("=")
+
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        accepted[coding.lower()] = quality
+
+    return accepted
+
+
+def choose_encoding(header, available):
+    """
+    Pick the first of `available` encodings the client accepts (with a non-zero quality), or None.
+    """
+
+    accepted = parse_accept_encoding(header)
+
+    for coding in available:
+        if accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+
+    return None
+
+
+class Compressor:
+    """
+    Compresses responses of `app` in an after_request hook and records bytes sent per endpoint.
+
+    Create it before any extension that rewrites response bodies (e.g. the debug toolbar):
+    after_request hooks run in reverse order of registration, so this one then runs last.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+        app.after_request(self.process_response)
+
+    @property
+    def encodings(self):
+        """
+        Encodings this server can produce, most preferred first.
+        """
+
+        if brotli is not None:
+            return ("br", "gzip")
+
+        return ("gzip",)
+
+    def compress(self, data, coding):
+        if coding == "br":
+            return brotli.compress(data, quality=self.app.config['COMPRESS_BROTLI_QUALITY'])
+
+        return gzip.compress(data, compresslevel=self.app.config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+    def compressor(self, coding):
+        """
+        Incremental version of `compress`: (process, flush, finish) functions of a new compressor.
+        """
+
+        if coding == "br":
+            compressor = brotli.Compressor(quality=self.app.config['COMPRESS_BROTLI_QUALITY'])
+            return (compressor.process, compressor.flush, compressor.finish)
+
+        # wbits 16 + MAX_WBITS writes a gzip (rather than zlib) header and trailer
+        compressor = zlib.compressobj(self.app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return (compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush)
+
+    def compress_stream(self, chunks, coding, endpoint):
+        """
+        Compress an iterable of byte strings, yielding each chunk's compressed bytes as soon as
+        it has been processed.
+        """
+
+        (process, flush, finish) = self.compressor(coding)
+
+        for chunk in chunks:
+            data = process(chunk) + flush()
+            self.record(endpoint, "raw_bytes", len(chunk))
+            self.record(endpoint, "wire_bytes", len(data))
+            yield data
+
+        data = finish()
+        self.record(endpoint, "wire_bytes", len(data))
+        yield data
+
+    def process_response(self, response):
+        endpoint = request.endpoint or "<unmatched>"
+
+        if response.is_streamed and not response.direct_passthrough:
+            return self.process_stream(response, endpoint)
+
+        if response.direct_passthrough:
+            self.record(endpoint, "streamed")
+            return response
+
+        data = response.get_data()
+
+        if self.should_compress(response, data):
+            response.vary.add("Accept-Encoding")
+            coding = choose_encoding(request.headers.get("Accept-Encoding"), self.encodings)
+
+            if coding is not None:
+                compressed = self.compress(data, coding)
+
+                response.set_data(compressed)
+                response.headers["Content-Encoding"] = coding
+
+                # The uncompressed ETag no longer identifies this representation
+                if "ETag" in response.headers:
+                    (etag, weak) = response.get_etag()
+                    response.set_etag(f"{etag}-{coding}", weak)
+
+                self.record(endpoint, "compressed")
+
+        self.record(endpoint, "responses")
+        self.record(endpoint, "raw_bytes", len(data))
+        self.record(endpoint, "wire_bytes", response.content_length or 0)
+        return response
+
+    def process_stream(self, response, endpoint):
+        """
+        Compress a streamed text response on the fly (its size isn't known up front, so there's
+        no threshold).
+        """
+
+        self.record(endpoint, "streamed")
+
+        if not self.should_compress(response):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        coding = choose_encoding(request.headers.get("Accept-Encoding"), self.encodings)
+
+        if coding is None:
+            return response
+
+        # Closing the response must still close the original iterable (e.g. to end the request
+        # context of a stream_with_context generator)
+        original = response.response
+
+        if hasattr(original, "close"):
+            response.call_on_close(original.close)
+
+        response.response = self.compress_stream(response.iter_encoded(), coding, endpoint)
+        response.headers["Content-Encoding"] = coding
+        self.record(endpoint, "compressed")
+        return response
+
+    def should_compress(self, response, data=None):
+        """
+        Whether `response` (whose body is `data`, or is streamed if None) should be compressed.
+        """
+
+        return (self.app.config['COMPRESS_ENABLED']
+                and response.status_code >= 200
+                and response.status_code not in (204, 206, 304)
+                and request.method != "HEAD"
+                and response.mimetype in COMPRESSIBLE_MIMETYPES
+                and "Content-Encoding" not in response.headers
+                and (data is None or len(data) >= self.app.config['COMPRESS_MIN_SIZE']))
+
+    def record(self, endpoint, event, amount=1):
+        """
+        Add `amount` to the `event` counter, both overall and for `endpoint`.
+        """
+
+        with self._lock:
+            self.stats[event] += amount
+            self.stats[f"{endpoint}.{event}"] += amount
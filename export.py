@@ -0,0 +1,115 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Streaming export of a user's account data (messages, likes and follows).
+
+Rows are read with server-side cursors (yield_per), as plain column tuples rather than ORM objects,
+and written out one line at a time, so memory use stays constant however big the account is.
+Every record has the same fields, in FIELDS order, so the same rows serve both JSON Lines and CSV.
+"""
+
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+from models import db, ArchivedLike, ArchivedMessage, Follow, Like, Message, User
+
+FIELDS = ("type", "id", "user_id", "username", "text", "timestamp")
+FORMATS = {
+    "jsonl": "application/x-ndjson",
+    "csv": "text/csv",
+}
+YIELD_PER = 1000
+
+
+def stream(stmt):
+    """
+    Execute `stmt`, fetching its rows from a server-side cursor YIELD_PER at a time.
+    """
+
+    return db.session.execute(stmt.execution_options(yield_per=YIELD_PER))
+
+
+def export_records(user_id):
+    """
+    Generate a user's data as dicts with FIELDS as keys: their messages and the messages they like
+    (archived ones included), and the users they follow and are followed by.
+    """
+
+    for table in (Message, ArchivedMessage):
+        rows = stream(select(table.id, table.text, table.timestamp)
+                      .where(table.user_id == user_id)
+                      .order_by(table.timestamp))
+
+        for (msg_id, text, timestamp) in rows:
+            yield record("message", id=msg_id, user_id=user_id, text=text, timestamp=timestamp)
+
+    for (like, table) in ((Like, Message), (ArchivedLike, ArchivedMessage)):
+        rows = stream(select(table.id, table.user_id, User.username, table.text, like.liked_at)
+                      .select_from(like)
+                      .join(table, table.id == like.message_id)
+                      .join(User, User.id == table.user_id)
+                      .where(like.user_id == user_id)
+                      .order_by(like.liked_at))
+
+        for (msg_id, author_id, username, text, liked_at) in rows:
+            yield record("like", id=msg_id, user_id=author_id, username=username, text=text,
+                         timestamp=liked_at)
+
+    for (kind, own_col, other_col) in (
+            ("following", Follow.user_following_id, Follow.user_being_followed_id),
+            ("follower", Follow.user_being_followed_id, Follow.user_following_id)):
+
+        rows = stream(select(User.id, User.username)
+                      .join(Follow, other_col == User.id)
+                      .where(own_col == user_id)
+                      .order_by(User.id))
+
+        for (other_id, username) in rows:
+            yield record(kind, user_id=other_id, username=username)
+
+
+def record(kind, **fields):
+    row = dict.fromkeys(FIELDS)
+    row.update(fields, type=kind)
+
+    if row["timestamp"] is not None:
+        row["timestamp"] = row["timestamp"].isoformat()
+
+    return row
+
+
+def export_lines(user_id, format):
+    """
+    Generate a user's data as lines of text in `format` ("jsonl" or "csv").
+    """
+
+    if format not in FORMATS:
+        raise ValueError(f"Unknown export format: {format}")
+
+    records = export_records(user_id)
+
+    if format == "jsonl":
+        for row in records:
+            yield json.dumps(row) + "\n"
+
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, FIELDS)
+
+    def line(write, *args):
+        write(*args)
+        text = buffer.getvalue()
+
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(writer.writeheader)
+
+    for row in records:
+        yield line(writer.writerow, row)
@@ -0,0 +1,326 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Compact in-memory index of the follows graph, for membership and adjacency questions ("does A
+follow B?", "how many followers does B have?", "whom does A follow?") without loading User rows.
+
+The graph is held in CSR (compressed sparse row) form, once per direction: `targets` is one array
+of 4-byte user IDs holding every user's neighbours, sorted, back to back, and `offsets[user_id]` is
+where that user's run starts. A degree is a subtraction, a neighbour list is a slice and a
+membership test is a binary search, at about 8 bytes per follow (both directions) plus 16 bytes
+per user ID.
+
+The arrays are rebuilt from the follows table (see `load`) and never modified. Follows added or
+removed in this process since the last build are kept in a small overlay of sets, consulted on
+every lookup. The index is per process, so it is rebuilt every `max_age` seconds to pick up other
+processes' changes. Only the very first build happens in a request; after that, the request that
+finds the index stale starts a rebuild in a background thread, and every request keeps using the
+old arrays until it is done.
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from models import db, Follow, User
+
+YIELD_PER = 1000
+
+
+def load_groups(source_col, target_col):
+    """
+    Stream (source ID, sorted target IDs) for every source in follows, aggregated in the database
+    so Python handles one row per user rather than one per follow.
+    """
+
+    targets = db.func.array_agg(aggregate_order_by(target_col, target_col))
+
+    return db.session.execute(select(source_col, targets)
+                              .group_by(source_col)
+                              .order_by(source_col)
+                              .execution_options(yield_per=YIELD_PER))
+
+
+class Adjacency:
+    """
+    One direction of the graph in CSR form: each source ID's sorted target IDs.
+    """
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def from_groups(cls, groups, size):
+        """
+        Build from (source, sorted target IDs) groups, with every ID below `size`.
+        """
+
+        offsets = array('q', bytes(8 * (size + 1)))
+        targets = array('i')
+
+        for (source, source_targets) in groups:
+            offsets[source + 1] = len(source_targets)
+            targets.extend(source_targets)
+
+        for i in range(1, size + 1):
+            offsets[i] += offsets[i - 1]
+
+        return cls(offsets, targets)
+
+    def bounds(self, source):
+        if not 0 <= source < len(self.offsets) - 1:
+            return (0, 0)
+
+        return (self.offsets[source], self.offsets[source + 1])
+
+    def degree(self, source):
+        (start, end) = self.bounds(source)
+        return end - start
+
+    def neighbours(self, source):
+        (start, end) = self.bounds(source)
+        return self.targets[start:end]
+
+    def contains(self, source, target):
+        (start, end) = self.bounds(source)
+        i = bisect_left(self.targets, target, start, end)
+        return i < end and self.targets[i] == target
+
+    @property
+    def nbytes(self):
+        return (self.offsets.itemsize * len(self.offsets) +
+                self.targets.itemsize * len(self.targets))
+
+
+class Overlay:
+    """
+    Edges added to or removed from an Adjacency since it was built.
+
+    `added` only holds edges missing from the arrays, and `removed` only edges present in them, so
+    degrees can be adjusted by the sets' sizes.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.added = defaultdict(set)
+        self.removed = defaultdict(set)
+
+    def add(self, source, target):
+        if target in self.removed[source]:
+            self.removed[source].discard(target)
+        elif not self.base.contains(source, target):
+            self.added[source].add(target)
+
+    def remove(self, source, target):
+        if target in self.added[source]:
+            self.added[source].discard(target)
+        elif self.base.contains(source, target):
+            self.removed[source].add(target)
+
+    def contains(self, source, target):
+        if target in self.added.get(source, ()):
+            return True
+
+        if target in self.removed.get(source, ()):
+            return False
+
+        return self.base.contains(source, target)
+
+    def degree(self, source):
+        return (self.base.degree(source) +
+                len(self.added.get(source, ())) -
+                len(self.removed.get(source, ())))
+
+    def neighbours(self, source):
+        """
+        The source's target IDs, sorted.
+        """
+
+        targets = self.base.neighbours(source)
+        (added, removed) = (self.added.get(source), self.removed.get(source))
+
+        if not added and not removed:
+            return targets.tolist()
+
+        return sorted({*targets} - (removed or set()) | (added or set()))
+
+
+class FollowGraph:
+    """
+    Process-wide follows index for `app`, registered as app.extensions['follow_graph'].
+    """
+
+    def __init__(self, app, max_age=300, clock=time.monotonic):
+        self.app = app
+        self.max_age = max_age
+        self.clock = clock
+
+        self._following = None
+        self._followers = None
+        self._built_at = None
+        self._building = False
+        self._pending = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+        app.extensions['follow_graph'] = self
+
+    def is_following(self, follower_id, followed_id):
+        return self._snapshot()[0].contains(follower_id, followed_id)
+
+    def following_count(self, user_id):
+        return self._snapshot()[0].degree(user_id)
+
+    def follower_count(self, user_id):
+        return self._snapshot()[1].degree(user_id)
+
+    def following_ids(self, user_id):
+        """
+        IDs of the users `user_id` follows, ascending.
+        """
+
+        return self._snapshot()[0].neighbours(user_id)
+
+    def follower_ids(self, user_id):
+        """
+        IDs of the users following `user_id`, ascending.
+        """
+
+        return self._snapshot()[1].neighbours(user_id)
+
+    def add(self, follower_id, followed_id):
+        """
+        Record a follow committed by this process.
+        """
+
+        self._patch("add", follower_id, followed_id)
+
+    def remove(self, follower_id, followed_id):
+        """
+        Record an unfollow committed by this process.
+        """
+
+        self._patch("remove", follower_id, followed_id)
+
+    def expire(self):
+        """
+        Rebuild on next use, in the background (e.g. after follows were deleted in bulk).
+        """
+
+        with self._lock:
+            self._built_at = None
+
+    def _patch(self, op, follower_id, followed_id):
+        with self._lock:
+            if self._following is not None:
+                getattr(self._following, op)(follower_id, followed_id)
+                getattr(self._followers, op)(followed_id, follower_id)
+
+            # A build in progress may or may not have seen this change; replay it afterwards
+            if self._building:
+                self._pending.append((op, follower_id, followed_id))
+
+    def load(self):
+        """
+        Build the arrays from the follows table, one query per direction.
+        """
+
+        with self._lock:
+            self._building = True
+            self._pending = []
+
+        self._build()
+
+    def _build(self):
+        """
+        Build the arrays, once `_building` is set, and swap them in.
+        """
+
+        try:
+            size = (db.session.scalar(select(db.func.max(User.id))) or 0) + 1
+
+            following = Adjacency.from_groups(load_groups(Follow.user_following_id,
+                                                          Follow.user_being_followed_id), size)
+            followers = Adjacency.from_groups(load_groups(Follow.user_being_followed_id,
+                                                          Follow.user_following_id), size)
+
+        finally:
+            with self._lock:
+                self._building = False
+
+        with self._lock:
+            self._following = Overlay(following)
+            self._followers = Overlay(followers)
+            self._built_at = self.clock()
+
+            for (op, follower_id, followed_id) in self._pending:
+                getattr(self._following, op)(follower_id, followed_id)
+                getattr(self._followers, op)(followed_id, follower_id)
+
+            self._pending = []
+
+    def _snapshot(self):
+        """
+        The current (following, followers) overlays: built first if there are none yet, or else
+        rebuilt in the background if they are stale (and no other thread is already at it).
+        """
+
+        with self._lock:
+            snapshot = (self._following, self._followers)
+            stale = self._built_at is None or self.clock() - self._built_at >= self.max_age
+            rebuild = stale and not self._building and snapshot[0] is not None
+
+            if rebuild:
+                self._building = True
+                self._pending = []
+                self._thread = threading.Thread(target=self._build_in_background,
+                                                name="follow-graph", daemon=True)
+                self._thread.start()
+
+        if snapshot[0] is None:
+            self.load()
+
+            with self._lock:
+                snapshot = (self._following, self._followers)
+
+        return snapshot
+
+    def _build_in_background(self):
+        with self.app.app_context():
+            try:
+                self._build()
+            except Exception:
+                self.app.logger.exception("Rebuilding the follows index failed")
+
+    def wait(self):
+        """
+        Wait for a background rebuild under way, if any.
+        """
+
+        with self._lock:
+            thread = self._thread
+
+        if thread is not None:
+            thread.join()
+
+    @property
+    def stats(self):
+        """
+        Size of the index: users, follows and bytes of arrays.
+        """
+
+        with self._lock:
+            if self._following is None:
+                return {"users": 0, "follows": 0, "bytes": 0}
+
+            base = self._followers.base
+            return {"users": len(base.offsets) - 1,
+                    "follows": len(base.targets),
+                    "bytes": base.nbytes + self._following.base.nbytes}
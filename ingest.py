@@ -0,0 +1,119 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Bulk import of a user's historical messages (e.g. when migrating from another platform).
+
+The whole batch is validated up front, so an import either goes in completely or not at all. Valid
+messages are then inserted with multi-row INSERT ... RETURNING statements, a chunk at a time, and
+each chunk's hashtags and mentions are indexed together.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, insert, select
+
+from models import db, Message
+from tags import index_messages
+
+MAX_LENGTH = Message.__table__.c.text.type.length
+DEFAULT_CHUNK_SIZE = 1000
+MAX_ERRORS = 100
+
+# How far past the database's clock a timestamp may be (imported messages sort by timestamp, so a
+# future one would sit at the top of timelines until that time came)
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+
+class IngestError(ValueError):
+    """
+    A batch of messages failed validation; `errors` lists (index, reason) for the bad ones.
+    """
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid message(s)")
+        self.errors = errors
+
+
+def parse_timestamp(value):
+    """
+    Parse an ISO 8601 timestamp. Timezone-aware ones are converted to (naive) UTC.
+    """
+
+    timestamp = datetime.fromisoformat(value)
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return timestamp
+
+
+def validate_messages(records, now):
+    """
+    Check a batch of {"text": ..., "timestamp": ... (optional)} records. Timestamps may not be
+    more than MAX_CLOCK_SKEW after `now` (the database's current local time).
+
+    Returns the cleaned rows ("text" and "timestamp", which is None if not given). Raises
+    IngestError listing (at most MAX_ERRORS) invalid records.
+    """
+
+    rows = []
+    errors = []
+
+    for (i, record) in enumerate(records):
+        text = record.get("text") if isinstance(record, dict) else None
+        timestamp = record.get("timestamp") if isinstance(record, dict) else None
+
+        if not isinstance(text, str) or not text.strip():
+            errors.append((i, "Text is required."))
+            continue
+
+        if len(text) > MAX_LENGTH:
+            errors.append((i, f"Text is longer than {MAX_LENGTH} characters."))
+            continue
+
+        if timestamp is not None:
+            try:
+                timestamp = parse_timestamp(timestamp)
+            except (TypeError, ValueError):
+                errors.append((i, "Timestamp is not an ISO 8601 date and time."))
+                continue
+
+            if timestamp > now + MAX_CLOCK_SKEW:
+                errors.append((i, "Timestamp is in the future."))
+                continue
+
+        rows.append({"text": text, "timestamp": timestamp})
+
+    if errors:
+        raise IngestError(errors[:MAX_ERRORS])
+
+    return rows
+
+
+def import_messages(user_id, records, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Validate and insert a batch of messages for a user, keeping any timestamps given.
+
+    Messages without a timestamp get the current time. Returns the number of messages imported.
+    Does not commit; the caller owns the transaction.
+    """
+
+    # What the column's server default would have given, so every row has the same keys
+    now = db.session.scalar(select(func.localtimestamp()))
+    rows = validate_messages(records, now)
+
+    if not rows:
+        return 0
+
+    for row in rows:
+        row["user_id"] = user_id
+        row["timestamp"] = row["timestamp"] or now
+
+    stmt = insert(Message).returning(Message.id, Message.text, Message.timestamp)
+
+    for start in range(0, len(rows), chunk_size):
+        inserted = db.session.execute(stmt, rows[start:start + chunk_size]).all()
+        index_messages(inserted)
+
+    return len(rows)
@@ -0,0 +1,377 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Small background job queue.
+
+Tasks are plain functions registered by name with JobQueue.task; views call JobQueue.enqueue and
+return without waiting. Each job runs inside its own app context, is retried with exponential
+backoff if it raises, and can carry an idempotency key so the same job is never queued twice.
+
+Backends (chosen with the JOBS_BACKEND config key):
+
+- "thread": a thread pool in this process (the default)
+- "database": the jobs table, worked by in-process threads and/or `flask jobs-worker`; survives
+  restarts and needs no external broker. A claimed job is leased to its worker for `lease`
+  seconds; if the worker dies, the job is claimed again once the lease runs out (so a job that
+  outlives its lease may run twice)
+- "inline": run immediately, in the caller's thread (for tests and CLI commands)
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Job
+
+
+class Task:
+    """
+    A registered task: the function to run and its retry policy.
+    """
+
+    def __init__(self, name, fn, max_attempts, retry_delay):
+        self.name = name
+        self.fn = fn
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def backoff(self, attempt):
+        """
+        Seconds to wait before retrying after failed attempt number `attempt` (1-based).
+        """
+
+        return self.retry_delay * 2 ** (attempt - 1)
+
+
+class RecentKeys:
+    """
+    Bounded, thread-safe set of recently-seen idempotency keys (oldest forgotten first).
+    """
+
+    def __init__(self, maxsize=10_000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """
+        Remember `key`. Returns False if it was already known.
+        """
+
+        with self._lock:
+            if key in self._keys:
+                return False
+
+            self._keys[key] = True
+
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+            return True
+
+
+class InlineBackend:
+    """
+    Run jobs immediately in the calling thread, retrying without waiting.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.keys = RecentKeys()
+
+    def enqueue(self, name, kwargs, idempotency_key):
+        if idempotency_key and not self.keys.add(idempotency_key):
+            return False
+
+        task = self.queue.tasks[name]
+        attempt = 1
+
+        while self.queue.run_job(name, kwargs) is not None:
+            if attempt >= task.max_attempts:
+                self.queue.record(name, "failed")
+                break
+
+            self.queue.record(name, "retried")
+            attempt += 1
+
+        return True
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class ThreadBackend:
+    """
+    Run jobs on a thread pool in this process. Queued jobs are lost if the process exits.
+    """
+
+    def __init__(self, queue, workers):
+        self.queue = queue
+        self.keys = RecentKeys()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="jobs")
+
+    def enqueue(self, name, kwargs, idempotency_key):
+        if idempotency_key and not self.keys.add(idempotency_key):
+            return False
+
+        self.executor.submit(self._run, name, kwargs, 1)
+        return True
+
+    def _run(self, name, kwargs, attempt):
+        if self.queue.run_job(name, kwargs) is None:
+            return
+
+        task = self.queue.tasks[name]
+
+        if attempt >= task.max_attempts:
+            self.queue.record(name, "failed")
+            return
+
+        self.queue.record(name, "retried")
+        timer = threading.Timer(task.backoff(attempt),
+                                self.executor.submit, (self._run, name, kwargs, attempt + 1))
+        timer.daemon = True
+        timer.start()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class DatabaseBackend:
+    """
+    Persist jobs in the jobs table; workers claim them with SELECT ... FOR UPDATE SKIP LOCKED, so
+    any number of worker threads/processes can share the queue.
+    """
+
+    def __init__(self, queue, workers, poll_interval, lease=300):
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._stop = threading.Event()
+        self._threads = []
+
+        for i in range(workers):
+            thread = threading.Thread(target=self.run_worker, name=f"jobs-db-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, name, kwargs, idempotency_key):
+        """
+        Insert the job row and commit (so call this after the request's own commit).
+        """
+
+        stmt = (insert(Job)
+                .values(name=name, payload=kwargs, idempotency_key=idempotency_key)
+                .on_conflict_do_nothing(index_elements=["idempotency_key"]))
+
+        result = db.session.execute(stmt)
+        db.session.commit()
+        return result.rowcount == 1
+
+    def work_once(self):
+        """
+        Claim and run one due job, if there is one. Returns True if a job was run.
+
+        Must be called inside an app context.
+        """
+
+        # Due queued jobs, and running jobs whose worker died (their lease ran out)
+        claimable = or_(and_(Job.status == "queued", Job.run_at <= func.now()),
+                        and_(Job.status == "running", Job.locked_until < func.now()))
+
+        job = db.session.scalars(select(Job)
+                                 .where(claimable)
+                                 .order_by(Job.run_at, Job.id)
+                                 .limit(1)
+                                 .with_for_update(skip_locked=True)).first()
+
+        if job is None:
+            db.session.rollback()
+            return False
+
+        task = self.queue.tasks.get(job.name)
+
+        if job.status == "running":
+            self.queue.record(job.name, "reclaimed")
+
+            # Don't let a job that keeps killing its worker be retried forever
+            if task is None or job.attempts >= task.max_attempts:
+                self.queue.record(job.name, "failed")
+                job.status = "failed"
+                job.last_error = "Worker stopped while running the job"
+                job.locked_until = None
+                db.session.commit()
+                return True
+
+        job.status = "running"
+        job.attempts += 1
+        job.locked_until = func.now() + timedelta(seconds=self.lease)
+        db.session.commit()
+
+        error = self.queue.run_job(job.name, job.payload)
+        job.locked_until = None
+
+        if error is None:
+            job.status = "done"
+            job.last_error = None
+
+        elif task is not None and job.attempts < task.max_attempts:
+            self.queue.record(job.name, "retried")
+            job.status = "queued"
+            job.last_error = repr(error)
+            job.run_at = func.now() + timedelta(seconds=task.backoff(job.attempts))
+
+        else:
+            self.queue.record(job.name, "failed")
+            job.status = "failed"
+            job.last_error = repr(error)
+
+        db.session.commit()
+        return True
+
+    def run_worker(self):
+        """
+        Work jobs until shutdown, sleeping `poll_interval` seconds whenever the queue is empty.
+        """
+
+        while not self._stop.is_set():
+            with self.queue.app.app_context():
+                ran = self.work_once()
+
+            if not ran:
+                self._stop.wait(self.poll_interval)
+
+    def shutdown(self, wait=True):
+        self._stop.set()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class JobQueue:
+    """
+    Registry of tasks plus the backend that runs them, with simple counters for monitoring.
+
+    The backend is created from app config the first time it is needed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.tasks = {}
+        self.metrics = Counter()
+
+        self._backend = None
+        self._lock = threading.Lock()
+
+    def task(self, name, max_attempts=None, retry_delay=None):
+        """
+        Decorator: register a function as the task called `name`.
+
+        The function is called with the keyword arguments given to enqueue, which must be
+        JSON-serializable (for the database backend).
+        """
+
+        def decorator(fn):
+            self.tasks[name] = Task(
+                name,
+                fn,
+                max_attempts or self.app.config['JOBS_MAX_ATTEMPTS'],
+                self.app.config['JOBS_RETRY_DELAY'] if retry_delay is None else retry_delay,
+            )
+            return fn
+
+        return decorator
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                self._backend = self.make_backend(self.app.config['JOBS_BACKEND'])
+
+            return self._backend
+
+    def make_backend(self, kind, workers=None):
+        """
+        Build a backend of the given kind ("inline", "thread" or "database").
+        """
+
+        workers = self.app.config['JOBS_WORKERS'] if workers is None else workers
+
+        if kind == "inline":
+            return InlineBackend(self)
+
+        if kind == "thread":
+            return ThreadBackend(self, workers)
+
+        if kind == "database":
+            return DatabaseBackend(self, workers, self.app.config['JOBS_POLL_INTERVAL'],
+                                   self.app.config['JOBS_LEASE_SECONDS'])
+
+        raise ValueError(f"Unknown job backend: {kind}")
+
+    def enqueue(self, name, idempotency_key=None, **kwargs):
+        """
+        Queue task `name` to run with `kwargs`.
+
+        Returns False (and queues nothing) if a job with the same idempotency key was already
+        queued.
+        """
+
+        if name not in self.tasks:
+            raise KeyError(f"Unknown task: {name}")
+
+        queued = self.backend.enqueue(name, kwargs, idempotency_key)
+        self.record(name, "enqueued" if queued else "deduplicated")
+        return queued
+
+    def run_job(self, name, kwargs):
+        """
+        Run one attempt of a job in a fresh app context.
+
+        Returns None on success, or the exception the task raised.
+        """
+
+        task = self.tasks[name]
+        started = time.perf_counter()
+
+        with self.app.app_context():
+            try:
+                task.fn(**kwargs)
+
+            except Exception as exc:
+                db.session.rollback()
+                self.app.logger.exception("Job %s failed", name)
+                self.record(name, "errors")
+                return exc
+
+            finally:
+                self.record(name, "seconds", time.perf_counter() - started)
+
+        self.record(name, "succeeded")
+        return None
+
+    def record(self, name, event, amount=1):
+        """
+        Add `amount` to the `event` counter, both overall and for task `name`.
+        """
+
+        with self._lock:
+            self.metrics[event] += amount
+            self.metrics[f"{name}.{event}"] += amount
+
+    def shutdown(self, wait=True):
+        """
+        Stop the backend (finishing running jobs if `wait`).
+        """
+
+        with self._lock:
+            if self._backend is not None:
+                self._backend.shutdown(wait)
+                self._backend = None
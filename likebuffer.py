@@ -0,0 +1,241 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Write-behind buffer for likes and unlikes.
+
+A like or unlike is acknowledged as soon as it is recorded here; nothing is written to the database
+in the request. Events are coalesced per (user, message), so only the latest state survives (a
+like, unlike, like in quick succession is one like), and a flusher thread writes everything pending
+every `interval` seconds in two batched statements: an INSERT ... ON CONFLICT DO NOTHING for likes
+and a DELETE for unlikes. Likes of messages or by users that were deleted in the meantime are
+dropped by the INSERT's joins.
+
+Until a flush has committed them, the buffer is the source of truth for its own users' pending
+events (including those being written): `overlay` and `pending_for` let their pages reflect them
+(read-your-writes). `liked_at` is on the database clock, like every other timestamp: each event
+records when it happened on a monotonic clock, and the flush writes it as that long before the
+database's `localtimestamp`. The buffer is per process, so another process only sees a like once
+it is flushed, and pending events are lost if the process is killed (they are flushed on a normal
+exit).
+"""
+
+import atexit
+import threading
+import time
+from collections import Counter, defaultdict
+
+from sqlalchemy import Float, Integer, column, delete, func, literal, select, tuple_, values
+from sqlalchemy.dialects.postgresql import INTERVAL, insert
+
+from models import db, Like, Message, User
+
+BATCH_SIZE = 1000
+
+
+class LikeBuffer:
+    """
+    Pending like (True) or unlike (False) events, by user ID and then message ID. Registered as
+    app.extensions['like_buffer'].
+
+    `on_flush(liked, unliked)`, if given, is called after each flush with the (message ID, age)
+    of each like actually added or removed, `age` being how many seconds ago it was liked.
+    """
+
+    def __init__(self, app, interval=1.0, max_pending=10_000, on_flush=None,
+                 clock=time.monotonic):
+        self.app = app
+        self.interval = interval
+        self.max_pending = max_pending
+        self.on_flush = on_flush
+        self.clock = clock
+        self.metrics = Counter()
+
+        self._pending = defaultdict(dict)
+        self._inflight = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+        app.extensions['like_buffer'] = self
+
+    def like(self, user_id, message_id):
+        self._record(user_id, message_id, True)
+
+    def unlike(self, user_id, message_id):
+        self._record(user_id, message_id, False)
+
+    def _record(self, user_id, message_id, liked):
+        with self._lock:
+            events = self._pending[user_id]
+            self._count += message_id not in events
+            events[message_id] = (liked, self.clock())
+            full = self._count >= self.max_pending
+
+        self.metrics["liked" if liked else "unliked"] += 1
+        self.start()
+
+        # Don't let a burst grow the buffer without bound; flush now rather than on schedule
+        if full:
+            self._wake.set()
+
+    def pending_for(self, user_id):
+        """
+        The user's pending events, including any being flushed: {message ID: (liked?, when)},
+        `when` being on the buffer's clock.
+        """
+
+        with self._lock:
+            return {**self._inflight.get(user_id, {}), **self._pending.get(user_id, {})}
+
+    def overlay(self, user_id, liked_ids):
+        """
+        The set of message IDs the user has liked, given the (flushed) `liked_ids`.
+        """
+
+        liked_ids = set(liked_ids)
+
+        for (message_id, (liked, _)) in self.pending_for(user_id).items():
+            if liked:
+                liked_ids.add(message_id)
+            else:
+                liked_ids.discard(message_id)
+
+        return liked_ids
+
+    def flush(self):
+        """
+        Write all pending events to the likes table. Returns the numbers of likes added and
+        removed. Commits.
+
+        If the write fails, the events are put back (behind any newer ones) for the next flush.
+        """
+
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            (batch, self._pending, self._count) = (self._pending, defaultdict(dict), 0)
+            self._inflight = batch
+            now = self.clock()
+
+        if not batch:
+            return (0, 0)
+
+        events = [(user_id, message_id, liked, at)
+                  for (user_id, user_events) in batch.items()
+                  for (message_id, (liked, at)) in user_events.items()]
+        likes = [(user_id, message_id, now - at)
+                 for (user_id, message_id, liked, at) in events if liked]
+        unlikes = [(user_id, message_id) for (user_id, message_id, liked, _) in events
+                   if not liked]
+
+        try:
+            liked = []
+            unliked = []
+
+            for i in range(0, len(likes), BATCH_SIZE):
+                liked += insert_likes(likes[i:i + BATCH_SIZE])
+
+            for i in range(0, len(unlikes), BATCH_SIZE):
+                unliked += delete_likes(unlikes[i:i + BATCH_SIZE])
+
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+
+            with self._lock:
+                for (user_id, user_events) in batch.items():
+                    newer = self._pending[user_id]
+                    self._count += len(user_events.keys() - newer.keys())
+                    self._pending[user_id] = {**user_events, **newer}
+
+                self._inflight = {}
+
+            self.metrics["failed_flushes"] += 1
+            raise
+
+        with self._lock:
+            self._inflight = {}
+
+        self.metrics["flushes"] += 1
+        self.metrics["rows_written"] += len(liked) + len(unliked)
+
+        if self.on_flush is not None:
+            self.on_flush(liked, unliked)
+
+        return (len(liked), len(unliked))
+
+    def start(self):
+        """
+        Start the flusher thread, if it isn't running. Pending events are also flushed at exit.
+        """
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(target=self._run, name="like-buffer", daemon=True)
+
+        self._thread.start()
+        atexit.register(self._flush_logged)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._flush_logged()
+
+    def _flush_logged(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Flushing buffered likes failed")
+
+
+def insert_likes(rows):
+    """
+    Insert (user ID, message ID, seconds ago) rows, skipping existing likes and likes of users or
+    messages that no longer exist. Each like is dated that many seconds before the database's
+    current time. Returns the (message ID, age in seconds) of each like added. Does not commit.
+    """
+
+    pending = values(column("user_id", Integer), column("message_id", Integer),
+                     column("seconds_ago", Float), name="pending").data(rows)
+    liked_at = func.localtimestamp() - pending.c.seconds_ago * literal("1 second").cast(INTERVAL)
+
+    stmt = (insert(Like)
+            .from_select(["user_id", "message_id", "liked_at"],
+                         select(pending.c.user_id, pending.c.message_id, liked_at)
+                         .join(User, User.id == pending.c.user_id)
+                         .join(Message, Message.id == pending.c.message_id))
+            .on_conflict_do_nothing()
+            .returning(Like.message_id, like_age()))
+
+    return db.session.execute(stmt).all()
+
+
+def delete_likes(keys):
+    """
+    Delete the likes with the given (user ID, message ID) keys. Returns the (message ID, age in
+    seconds) of each like removed. Does not commit.
+    """
+
+    stmt = (delete(Like)
+            .where(tuple_(Like.user_id, Like.message_id).in_(keys))
+            .returning(Like.message_id, like_age()))
+
+    return db.session.execute(stmt).all()
+
+
+def like_age():
+    """
+    SQL expression: how many seconds ago a like was made, by the database's clock.
+    """
+
+    return func.extract("epoch", func.localtimestamp() - Like.liked_at).cast(Float)
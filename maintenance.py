@@ -0,0 +1,329 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Maintenance tasks for large datasets, run through `flask maintenance ...`.
+
+Long-running tasks work in batches, each committed together with a checkpoint (the last key done)
+in the maintenance_checkpoints table. An interrupted task picks up where it left off the next
+time it runs; pass restart=True to start over. Progress is reported through a `progress` callback
+(e.g. click.echo), one line per batch.
+"""
+
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, bcrypt, Checkpoint, Follow, Like, Mention, Message, MessageTag, User
+from purge import delete_in_batches
+from suggestions import refresh_suggestions
+from tags import index_messages
+from timeline import rebuild_timelines, recount_followers
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def no_progress(line):
+    pass
+
+
+###################################################################################################
+# Checkpoints
+
+def get_checkpoint(name):
+    """
+    The position saved for task `name`, or 0 if it has none.
+    """
+
+    checkpoint = db.session.get(Checkpoint, name)
+    return checkpoint.position if checkpoint is not None else 0
+
+
+def save_checkpoint(name, position):
+    """
+    Record `position` for task `name`. Does not commit.
+    """
+
+    db.session.execute(insert(Checkpoint)
+                       .values(name=name, position=position)
+                       .on_conflict_do_update(index_elements=["name"],
+                                              set_={"position": position,
+                                                    "updated_at": func.now()}))
+
+
+def clear_checkpoint(name):
+    """
+    Forget task `name`'s progress. Does not commit.
+    """
+
+    db.session.execute(delete(Checkpoint).where(Checkpoint.name == name))
+
+
+def run_in_batches(name, id_col, process, batch_size=DEFAULT_BATCH_SIZE, restart=False,
+                   progress=no_progress):
+    """
+    Call `process(ids)` on batches of `id_col` values, in ascending order, committing after each.
+
+    Resumes after the last checkpointed ID unless `restart`. Returns the number of IDs processed
+    in this run.
+    """
+
+    position = 0 if restart else get_checkpoint(name)
+    remaining = db.session.scalar(select(func.count()).where(id_col > position))
+    done = 0
+
+    if position:
+        progress(f"{name}: resuming after ID {position}")
+
+    while True:
+        ids = db.session.scalars(select(id_col)
+                                 .where(id_col > position)
+                                 .order_by(id_col)
+                                 .limit(batch_size)).all()
+
+        if not ids:
+            break
+
+        process(ids)
+
+        position = ids[-1]
+        save_checkpoint(name, position)
+        db.session.commit()
+
+        done += len(ids)
+        progress(f"{name}: {done}/{remaining}")
+
+    clear_checkpoint(name)
+    db.session.commit()
+    return done
+
+
+###################################################################################################
+# Recomputing derived data
+
+def rebuild_tags(message_ids):
+    """
+    Re-extract the hashtags and mentions of the given messages. Does not commit.
+    """
+
+    db.session.execute(delete(MessageTag).where(MessageTag.message_id.in_(message_ids)))
+    db.session.execute(delete(Mention).where(Mention.message_id.in_(message_ids)))
+
+    index_messages(db.session.execute(select(Message.id, Message.text, Message.timestamp)
+                                      .where(Message.id.in_(message_ids))).all())
+
+
+def recompute(what, batch_size=DEFAULT_BATCH_SIZE, restart=False, progress=no_progress,
+              suggestions_per_user=10, fanout_max_followers=10_000, fanout_backfill=100):
+    """
+    Recompute derived data: "tags" (the hashtag and mention indexes), "suggestions",
+    "follower-counts" or "timelines" (the pushed entries of hybrid timelines; see timeline.py).
+    """
+
+    if what == "tags":
+        return run_in_batches("recompute-tags", Message.id, rebuild_tags,
+                              batch_size, restart, progress)
+
+    if what == "suggestions":
+        return run_in_batches("recompute-suggestions", User.id,
+                              lambda ids: refresh_suggestions(ids, suggestions_per_user),
+                              batch_size, restart, progress)
+
+    if what == "follower-counts":
+        return run_in_batches("recompute-follower-counts", User.id, recount_followers,
+                              batch_size, restart, progress)
+
+    if what == "timelines":
+        return run_in_batches("recompute-timelines", User.id,
+                              lambda ids: rebuild_timelines(ids, fanout_max_followers,
+                                                            fanout_backfill),
+                              batch_size, restart, progress)
+
+    raise ValueError(f"Don't know how to recompute {what}")
+
+
+###################################################################################################
+# Vacuum, analyze and reindex
+
+def table_names():
+    """
+    Names of all of the app's tables.
+    """
+
+    return [table.name for table in db.metadata.sorted_tables]
+
+
+def run_each_table(statement, tables, progress=no_progress):
+    """
+    Run `statement` (with "{table}" in it) on each of `tables`, outside of a transaction.
+    """
+
+    unknown = set(tables) - set(table_names())
+
+    if unknown:
+        raise ValueError(f"Unknown table(s): {', '.join(sorted(unknown))}")
+
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for (i, table) in enumerate(tables, 1):
+            conn.execute(text(statement.format(table=table)))
+            progress(f"{i}/{len(tables)}: {statement.format(table=table)}")
+
+
+def vacuum(tables=None, analyze_only=False, progress=no_progress):
+    """
+    VACUUM (ANALYZE) the given tables, or all of them; just ANALYZE if `analyze_only`.
+    """
+
+    statement = "ANALYZE {table}" if analyze_only else "VACUUM (ANALYZE) {table}"
+    run_each_table(statement, tables or table_names(), progress)
+
+
+def reindex(tables=None, progress=no_progress):
+    """
+    Rebuild the indexes of the given tables (or all of them) without blocking writes.
+    """
+
+    run_each_table("REINDEX TABLE CONCURRENTLY {table}", tables or table_names(), progress)
+
+
+###################################################################################################
+# Orphaned rows
+
+def orphan_checks():
+    """
+    For each table checked: (key columns, condition matching its orphaned rows).
+
+    Foreign keys normally prevent orphans, but not once they are dropped (e.g. by partitioning) or
+    if rows were loaded with constraints disabled.
+    """
+
+    follows = Follow.__table__.c
+    likes = Like.__table__.c
+    tags = MessageTag.__table__.c
+    mentions = Mention.__table__.c
+
+    def missing(model, column):
+        return ~select(model.id).where(model.id == column).exists()
+
+    return {
+        "follows": ([follows.user_being_followed_id, follows.user_following_id],
+                    missing(User, follows.user_being_followed_id) |
+                    missing(User, follows.user_following_id)),
+        "likes": ([likes.user_id, likes.message_id],
+                  missing(User, likes.user_id) | missing(Message, likes.message_id)),
+        "message_tags": ([tags.tag, tags.message_id],
+                         missing(Message, tags.message_id)),
+        "mentions": ([mentions.user_id, mentions.message_id],
+                     missing(User, mentions.user_id) | missing(Message, mentions.message_id)),
+    }
+
+
+def check_orphans(delete_them=False, batch_size=DEFAULT_BATCH_SIZE, progress=no_progress):
+    """
+    Count orphaned rows in each checked table, deleting them in batches if `delete_them`.
+
+    Returns {table name: number of orphans found}.
+    """
+
+    found = {}
+
+    for (name, (key_cols, condition)) in orphan_checks().items():
+        table = key_cols[0].table
+        found[name] = db.session.scalar(select(func.count()).select_from(table).where(condition))
+        progress(f"{name}: {found[name]} orphaned rows")
+
+        if delete_them and found[name]:
+            deleted = delete_in_batches(table, key_cols, condition, batch_size)
+            progress(f"{name}: deleted {deleted} rows")
+
+    db.session.rollback()
+    return found
+
+
+###################################################################################################
+# Benchmark data
+
+def generate_data(users, messages_per_user, follows_per_user, likes_per_user,
+                  batch_size=DEFAULT_BATCH_SIZE, restart=False, progress=no_progress):
+    """
+    Add `users` benchmark users ("bench1", "bench2", ...; password "password"), each with
+    messages spread over the last year, follows of other benchmark users and likes of random
+    messages.
+
+    Users are added `batch_size` at a time; the checkpoint is the number of users added so far.
+    Returns the number added in this run.
+    """
+
+    name = "generate-data"
+    start = 0 if restart else get_checkpoint(name)
+    password = bcrypt.generate_password_hash("password").decode('UTF-8')
+
+    if start:
+        progress(f"{name}: resuming after {start} users")
+
+    for batch_start in range(start + 1, users + 1, batch_size):
+        batch_end = min(batch_start + batch_size - 1, users)
+
+        user_ids = db.session.scalars(text(
+            "INSERT INTO users (username, email, password) "
+            "SELECT 'bench' || i, 'bench' || i || '@example.com', :password "
+            "FROM generate_series(:start, :end) AS i "
+            "RETURNING id"),
+            {"password": password, "start": batch_start, "end": batch_end}).all()
+
+        messages = db.session.execute(text(
+            "INSERT INTO messages (text, timestamp, user_id) "
+            "SELECT 'Benchmark warble ' || n || ' #topic' || (n % 50), "
+            "       now() - random() * interval '365 days', u.id "
+            "FROM unnest(CAST(:ids AS integer[])) AS u(id) "
+            "CROSS JOIN generate_series(1, :count) AS n "
+            "RETURNING id, text, timestamp"),
+            {"ids": user_ids, "count": messages_per_user}).all()
+        index_messages(messages)
+
+        # Random targets among all benchmark users / messages so far (IDs are near-contiguous);
+        # picked in a subquery so random() runs once per row, not once per join comparison.
+        # The followed users' follower counts go up in the same statement.
+        db.session.execute(text(
+            "WITH added AS ("
+            "INSERT INTO follows (user_following_id, user_being_followed_id) "
+            "SELECT picks.user_id, f.id "
+            "FROM (SELECT u.id AS user_id, "
+            "             bounds.lo + floor(random() * (bounds.hi - bounds.lo + 1))::integer "
+            "               AS target "
+            "      FROM unnest(CAST(:ids AS integer[])) AS u(id) "
+            "      CROSS JOIN generate_series(1, :count) "
+            "      CROSS JOIN (SELECT min(id) AS lo, max(id) AS hi FROM users "
+            "                  WHERE username LIKE 'bench%') AS bounds) AS picks "
+            "JOIN users f ON f.id = picks.target "
+            "WHERE f.id <> picks.user_id "
+            "ON CONFLICT DO NOTHING "
+            "RETURNING user_being_followed_id) "
+            "UPDATE users SET follower_count = follower_count + added_count.n "
+            "FROM (SELECT user_being_followed_id AS id, count(*) AS n FROM added GROUP BY 1) "
+            "     AS added_count "
+            "WHERE users.id = added_count.id"),
+            {"ids": user_ids, "count": follows_per_user})
+
+        db.session.execute(text(
+            "INSERT INTO likes (user_id, message_id) "
+            "SELECT picks.user_id, m.id "
+            "FROM (SELECT u.id AS user_id, "
+            "             bounds.lo + floor(random() * (bounds.hi - bounds.lo + 1))::integer "
+            "               AS target "
+            "      FROM unnest(CAST(:ids AS integer[])) AS u(id) "
+            "      CROSS JOIN generate_series(1, :count) "
+            "      CROSS JOIN (SELECT min(id) AS lo, max(id) AS hi FROM messages) AS bounds) "
+            "     AS picks "
+            "JOIN messages m ON m.id = picks.target "
+            "WHERE m.user_id <> picks.user_id "
+            "ON CONFLICT DO NOTHING"),
+            {"ids": user_ids, "count": likes_per_user})
+
+        save_checkpoint(name, batch_end)
+        db.session.commit()
+
+        progress(f"{name}: {batch_end}/{users} users")
+
+    clear_checkpoint(name)
+    db.session.commit()
+    return max(users - start, 0)
@@ -5,6 +5,7 @@
 SQLAlchemy models for Warbler.
 """
 
+from flask import current_app
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
@@ -12,6 +13,28 @@ bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+def follow_graph():
+    """
+    The app's in-memory follows index (see followgraph.py), or None if it isn't enabled.
+    """
+
+    if not current_app.config.get('FOLLOW_GRAPH_ENABLED'):
+        return None
+
+    return current_app.extensions.get('follow_graph')
+
+
+def like_buffer():
+    """
+    The app's buffer of pending likes and unlikes (see likebuffer.py), or None if it isn't enabled.
+    """
+
+    if not current_app.config.get('LIKE_BUFFER_ENABLED'):
+        return None
+
+    return current_app.extensions.get('like_buffer')
+
+
 class Follow(db.Model):
     """
     Connection of a follower <-> followed_user.
@@ -33,30 +56,91 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+    )
+
+    # Followers / following lists, newest first
+    __table_args__ = (
+        db.Index('ix_follows_followed_created_at', 'user_being_followed_id', created_at.desc()),
+        db.Index('ix_follows_following_created_at', 'user_following_id', created_at.desc()),
+    )
+
+
+class FollowSuggestion(db.Model):
+    """
+    Precomputed "who to follow" suggestion for a user (friend-of-a-friend).
+
+    `score` is the number of users this user follows who also follow the suggested user. Rows are
+    rebuilt periodically from the follows graph (see suggestions.py), so reading a user's
+    suggestions is a single indexed lookup.
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+    )
+
+    __table_args__ = (
+        db.Index('ix_follow_suggestions_user_score', 'user_id', score.desc()),
+    )
+
 
 class Like(db.Model):
     """
     Mapping user likes to warbles (messages).
 
     One user can have many liked messages, and one message can be liked by many users.
+
+    The (user_id, message_id) primary key makes "has this user liked this message?" an index-only
+    lookup; the message_id index serves per-message like counts.
     """
 
     __tablename__ = 'likes'
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
-
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+        index=True,
+    )
+
+    liked_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_user_liked_at', 'user_id', liked_at.desc()),
     )
 
 
@@ -108,6 +192,21 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Cleared when the account is deleted; the user's data is then purged in the background
+    is_active = db.Column(
+        db.Boolean,
+        nullable=False,
+        server_default=db.true(),
+    )
+
+    # Kept up to date as follows are added and removed, so timelines can tell popular authors
+    # (whose messages are pulled at read time) from the rest without counting (see timeline.py)
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="0",
+    )
+
     messages = db.relationship('Message', back_populates="user")
 
     followers = db.relationship(
@@ -139,14 +238,84 @@ class User(db.Model):
         Is this user followed by `other_user`?
         """
 
+        graph = follow_graph()
+
+        if graph is not None:
+            return graph.is_following(other_user.id, self.id)
+
         found_user_list = [user for user in self.followers if user == other_user]
         return len(found_user_list) == 1
 
+    @property
+    def counts(self):
+        """
+        Numbers of this user's messages, followees, followers and likes.
+
+        Counted in the database, rather than by loading every related row (follows are taken from
+        the follows index instead, if enabled). Likes are counted as the likes page lists them:
+        archived likes included, and adjusted for the user's likes and unlikes still in the like
+        buffer.
+        """
+
+        def count(column):
+            return db.select(db.func.count()).where(column == self.id).scalar_subquery()
+
+        graph = follow_graph()
+
+        if graph is not None:
+            row = db.session.execute(db.select(
+                count(Message.user_id).label("messages"),
+                (count(Like.user_id) + count(ArchivedLike.user_id)).label("likes"),
+            )).one()
+
+            counts = {"messages": row.messages,
+                      "following": graph.following_count(self.id),
+                      "followers": graph.follower_count(self.id),
+                      "likes": row.likes}
+        else:
+            counts = db.session.execute(db.select(
+                count(Message.user_id).label("messages"),
+                count(Follow.user_following_id).label("following"),
+                count(Follow.user_being_followed_id).label("followers"),
+                (count(Like.user_id) + count(ArchivedLike.user_id)).label("likes"),
+            )).one()._asdict()
+
+        counts["likes"] += self.pending_likes_delta()
+
+        return counts
+
+    def pending_likes_delta(self):
+        """
+        How much this user's buffered likes and unlikes will change their like count once written.
+        """
+
+        buffer = like_buffer()
+        pending = buffer.pending_for(self.id) if buffer is not None else {}
+
+        if not pending:
+            return 0
+
+        written_ids = set(db.session.scalars(
+            db.select(Like.message_id)
+            .where(Like.user_id == self.id, Like.message_id.in_(pending))
+            .union_all(db.select(ArchivedLike.message_id)
+                       .where(ArchivedLike.user_id == self.id,
+                              ArchivedLike.message_id.in_(pending)))))
+
+        return sum((liked and message_id not in written_ids)
+                   - (not liked and message_id in written_ids)
+                   for (message_id, (liked, _)) in pending.items())
+
     def is_following(self, other_user):
         """
         Is this user following `other_user`?
         """
 
+        graph = follow_graph()
+
+        if graph is not None:
+            return graph.is_following(self.id, other_user.id)
+
         found_user_list = [user for user in self.following if user == other_user]
         return len(found_user_list) == 1
 
@@ -180,10 +349,11 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
-        If can't find matching user (or if password is wrong), returns False.
+        If can't find matching user (or if password is wrong, or the account has been deleted),
+        returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, is_active=True).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -226,6 +396,12 @@ class Message(db.Model):
 
     user = db.relationship('User', back_populates="messages")
 
+    archived = False
+
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', timestamp.desc()),
+    )
+
     def __repr__(self):
         """
         Return a string representation of a Message, which includes Message ID and the ID of the
@@ -235,10 +411,333 @@ class Message(db.Model):
         return f"<Message #{self.id}: User #{self.user_id}>"
 
 
+class ArchivedMessage(db.Model):
+    """
+    A message moved out of the messages table into cold storage (see archive.py).
+
+    Archived messages keep their original ID, so links to them keep working, and are read-only
+    history: their likes move to archived_likes with them, but their tags and mentions are
+    dropped.
+    """
+
+    __tablename__ = 'archived_messages'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="0",
+    )
+
+    archived_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+    )
+
+    user = db.relationship('User', viewonly=True)
+
+    archived = True
+
+    __table_args__ = (
+        db.Index('ix_archived_messages_user_timestamp', 'user_id', timestamp.desc()),
+    )
+
+    def __repr__(self):
+        return f"<ArchivedMessage #{self.id}: User #{self.user_id}>"
+
+
+class ArchivedLike(db.Model):
+    """
+    A like of an archived message, moved out of the likes table along with the message.
+    """
+
+    __tablename__ = 'archived_likes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('archived_messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    liked_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_archived_likes_user_liked_at', 'user_id', liked_at.desc()),
+    )
+
+
+class TimelineEntry(db.Model):
+    """
+    A message pushed into a follower's home timeline when it was posted (see timeline.py).
+
+    Only messages by authors with at most TIMELINE_FANOUT_MAX_FOLLOWERS followers are pushed;
+    those of more popular authors are pulled in when the timeline is read.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # Copied from the message, so a timeline page is read straight off the index
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp', 'user_id', timestamp.desc(),
+                 message_id.desc()),
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+
+class MessageTag(db.Model):
+    """
+    Inverted index from a hashtag to the messages that use it.
+
+    The (tag, timestamp, message_id) index serves a tag's feed, newest first, without scanning
+    message text.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    # Copied from the message (imported messages keep their own), so a feed page is read straight
+    # off the index
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_tags_tag_timestamp', 'tag', timestamp.desc(), message_id.desc()),
+    )
+
+
+class Mention(db.Model):
+    """
+    Inverted index from a user to the messages that @mention them.
+    """
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    # Copied from the message, like MessageTag.timestamp
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_mentions_user_timestamp', 'user_id', timestamp.desc(), message_id.desc()),
+    )
+
+
+class Job(db.Model):
+    """
+    A background job in the database-backed job queue (see jobs.py).
+
+    Jobs with the same (non-null) idempotency key are only ever queued once.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # One of: queued, running, done, failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        server_default="queued",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="0",
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+    )
+
+    # While running: when the worker's lease on the job runs out, after which another worker may
+    # claim it
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_queued_run_at', 'run_at', 'id', postgresql_where=(status == 'queued')),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} ({self.status})>"
+
+
+class Checkpoint(db.Model):
+    """
+    Progress of a resumable maintenance command (see maintenance.py): the last key it finished.
+    """
+
+    __tablename__ = 'maintenance_checkpoints'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    position = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+        onupdate=db.func.now(),
+    )
+
+    def __repr__(self):
+        return f"<Checkpoint {self.name}: {self.position}>"
+
+
+class RateLimitBucket(db.Model):
+    """
+    A token bucket for the shared rate limit store (see ratelimit.py), e.g. "messages:42".
+    """
+
+    __tablename__ = 'rate_limit_buckets'
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    tokens = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<RateLimitBucket {self.key}: {self.tokens:.2f}>"
+
+
 def connect_db(app):
     """
     Connect this database to provided Flask app.
+
+    Safe to call more than once (e.g. from CLI commands); later calls are no-ops.
     """
 
+    if 'sqlalchemy' in app.extensions:
+        return
+
     db.app = app
     db.init_app(app)
@@ -0,0 +1,246 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Full-page cache for logged-out visitors.
+
+A logged-out visitor's page depends only on its path, so the first rendering of a cached view is
+kept (body, status and mimetype, by path) and sent to every later anonymous visitor. An entry is
+fresh for `ttl` seconds and served as is. After that, for up to `stale` more seconds, it is still
+served right away while a background thread renders the page again (stale-while-revalidate), so no
+visitor waits on a render. Past that, it is rendered in the request like a miss.
+
+Views tag the pages they render with what they show (e.g. "user:12", "message:34"); writes then
+drop the affected pages by tag (`invalidate`), so visitors don't see stale pages in this process.
+The cache is per process, and other processes' writes are only picked up once entries expire.
+
+Requests from logged-in users, with a query string, or with flashed messages waiting to be shown
+are never served from the cache or stored in it. Only 200 responses are stored, before the
+compression hook runs, so each request is still compressed as it negotiates.
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from flask import Response, g, request, session
+from werkzeug.exceptions import HTTPException
+
+
+class PageCache:
+    """
+    Bounded LRU map of path -> rendered anonymous page, with an index of the paths by tag.
+    """
+
+    def __init__(self, app, ttl=30, stale=300, max_entries=1000, workers=2, clock=time.monotonic):
+        self.app = app
+        self.ttl = ttl
+        self.stale = stale
+        self.max_entries = max_entries
+        self.clock = clock
+        self.metrics = Counter()
+
+        self._entries = OrderedDict()
+        self._paths_by_tag = {}
+        self._generation = 0
+        self._refreshing = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="page-cache")
+
+    def cached(self, view):
+        """
+        Decorator: serve the view's anonymous responses from the cache. Put it under @app.route.
+        """
+
+        @wraps(view)
+        def wrapper(**kwargs):
+            if not self.cacheable():
+                return view(**kwargs)
+
+            path = request.path
+            (entry, state) = self.get(path)
+
+            if state == "fresh":
+                self.metrics["hits"] += 1
+                return self.respond(entry, "hit")
+
+            if state == "stale":
+                self.metrics["stale_hits"] += 1
+                self.revalidate(path)
+                return self.respond(entry, "stale")
+
+            response = self.render(view, kwargs)
+            response.headers["X-Cache"] = "miss"
+            return response
+
+        return wrapper
+
+    def cacheable(self):
+        return (self.app.config['PAGE_CACHE_ENABLED']
+                and request.method in ("GET", "HEAD")
+                and g.user is None
+                and not request.args
+                and "_flashes" not in session)
+
+    def tag(self, *tags):
+        """
+        Tag the page being rendered (e.g. tag("user:12")), to be dropped by invalidate(*tags).
+        """
+
+        g.setdefault("page_cache_tags", set()).update(tags)
+
+    def render(self, view, kwargs):
+        """
+        Run the view and store its response, if cacheable (or else drop any stored one).
+        """
+
+        with self._lock:
+            generation = self._generation
+
+        g.page_cache_tags = set()
+        response = self.app.make_response(view(**kwargs))
+
+        if response.status_code == 200 and not response.is_streamed:
+            self.put(request.path, response, g.page_cache_tags, generation)
+        else:
+            self.forget(request.path)
+
+        return response
+
+    def respond(self, entry, state):
+        (_, status, body, mimetype, _) = entry
+
+        response = Response(body, status=status, mimetype=mimetype)
+        response.headers["X-Cache"] = state
+        return response
+
+    def get(self, path):
+        """
+        The entry for `path` and how usable it is: "fresh", "stale" (serve it, but revalidate) or
+        "miss" (entry is None).
+        """
+
+        with self._lock:
+            entry = self._entries.get(path)
+
+            if entry is None:
+                self.metrics["misses"] += 1
+                return (None, "miss")
+
+            age = self.clock() - entry[0]
+
+            if age >= self.ttl + self.stale:
+                self._drop(path)
+                self.metrics["misses"] += 1
+                return (None, "miss")
+
+            self._entries.move_to_end(path)
+            return (entry, "fresh" if age < self.ttl else "stale")
+
+    def put(self, path, response, tags, generation):
+        """
+        Store a response rendered when the cache was at `generation`; if anything was invalidated
+        since, the response may already be out of date, so it isn't stored.
+        """
+
+        entry = (self.clock(), response.status_code, response.get_data(), response.mimetype,
+                 frozenset(tags))
+
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            self._drop(path)
+            self._entries[path] = entry
+
+            for tag in entry[4]:
+                self._paths_by_tag.setdefault(tag, set()).add(path)
+
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.metrics["evictions"] += 1
+
+    def invalidate(self, *tags):
+        """
+        Drop every page tagged with any of `tags`.
+        """
+
+        with self._lock:
+            self._generation += 1
+
+            for tag in tags:
+                for path in self._paths_by_tag.get(tag, set()).copy():
+                    self._drop(path)
+                    self.metrics["invalidations"] += 1
+
+    def forget(self, path):
+        with self._lock:
+            self._drop(path)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._paths_by_tag.clear()
+
+    def _drop(self, path):
+        entry = self._entries.pop(path, None)
+
+        if entry is None:
+            return
+
+        for tag in entry[4]:
+            paths = self._paths_by_tag[tag]
+            paths.discard(path)
+
+            if not paths:
+                del self._paths_by_tag[tag]
+
+    def revalidate(self, path):
+        """
+        Render `path` again in the background, unless that is already under way.
+        """
+
+        with self._lock:
+            if path in self._refreshing:
+                return
+
+            self._refreshing[path] = self._executor.submit(self.refresh, path)
+
+        self.metrics["revalidations"] += 1
+
+    def refresh(self, path):
+        """
+        Render `path` as a logged-out visitor would, and store the result (or drop the entry, if
+        the page is gone).
+        """
+
+        try:
+            with self.app.test_request_context(path):
+                g.user = None
+                view = self.app.view_functions[request.endpoint]
+
+                try:
+                    self.render(view.__wrapped__, request.view_args)
+                except HTTPException:
+                    self.forget(path)
+
+        except Exception:
+            self.app.logger.exception("Refreshing cached page %s failed", path)
+
+        finally:
+            with self._lock:
+                self._refreshing.pop(path, None)
+
+    def wait(self):
+        """
+        Wait for the background refreshes under way.
+        """
+
+        with self._lock:
+            futures = list(self._refreshing.values())
+
+        for future in futures:
+            future.result()
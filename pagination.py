@@ -0,0 +1,55 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Keyset (cursor) pagination helpers.
+
+A cursor names the last row of the previous page by its sort key - a (timestamp, id) pair - so the
+next page is an index range scan instead of an OFFSET that re-reads every earlier row.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(timestamp, row_id):
+    """
+    Build an opaque cursor string from a (timestamp, id) sort key.
+    """
+
+    return f"{timestamp.isoformat()}_{row_id}"
+
+
+def decode_cursor(cursor):
+    """
+    Parse a cursor made by encode_cursor back into a (timestamp, id) pair.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    (timestamp, _, row_id) = cursor.rpartition("_")
+    return (datetime.fromisoformat(timestamp), int(row_id))
+
+
+def paginate(query, timestamp_col, id_col, cursor, per_page):
+    """
+    Fetch one page of `query`, newest first, starting after `cursor` (or at the top if None).
+
+    The query's rows must include the sort key columns as their last two entries. Returns a list
+    of rows and the cursor for the next page (None on the last page).
+    """
+
+    if cursor is not None:
+        query = query.filter(tuple_(timestamp_col, id_col) < cursor)
+
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) <= per_page:
+        return (rows, None)
+
+    rows = rows[:per_page]
+    return (rows, encode_cursor(*rows[-1][-2:]))
@@ -0,0 +1,213 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Optional monthly range partitioning of the messages table (Postgres only).
+
+`flask partition-messages` converts the plain messages table into one partitioned by RANGE
+(timestamp), with a partition per month (plus a default partition for anything outside them), and
+copies the existing rows across. `flask create-message-partitions` then creates upcoming months'
+partitions ahead of time; run it from cron, e.g. weekly.
+
+Postgres requires a partitioned table's primary key to include the partition key, so the messages
+primary key becomes (id, timestamp) and message IDs stay unique through their sequence. Foreign
+keys can only reference a unique key, so the foreign keys from likes, message_tags, mentions and
+timeline_entries are replaced with a trigger that deletes their rows when a message is deleted.
+The trigger only knows the tables referencing messages at conversion time: once messages is
+partitioned, creating a table with a foreign key to messages.id (e.g. a new model, through
+`db.create_all()`) is refused with ReferencesPartitionedMessages. Create such a table without the
+foreign key and add its cascade to the messages_cascade_delete function by hand.
+
+None of these functions commit; the CLI commands do.
+"""
+
+from datetime import date
+
+from sqlalchemy import event, text
+
+from models import db, Message
+
+DEFAULT_PARTITION = "messages_default"
+
+
+class ReferencesPartitionedMessages(Exception):
+    """
+    A table with a foreign key to messages.id was to be created after messages was partitioned.
+    """
+
+
+IS_PARTITIONED = text(
+    "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+    "WHERE partrelid = to_regclass('messages'))")
+
+
+def is_partitioned():
+    """
+    Is the messages table partitioned?
+    """
+
+    return db.session.scalar(IS_PARTITIONED)
+
+
+@event.listens_for(db.metadata, "before_create")
+def refuse_new_references(metadata, connection, tables=(), **kwargs):
+    """
+    Before `create_all` creates `tables`, refuse to create any referencing messages.id if messages
+    is partitioned: Postgres would reject the foreign key, with a less helpful error.
+    """
+
+    referencing = [table.name for table in tables
+                   if any(fk.column.table.name == "messages" for fk in table.foreign_keys)]
+
+    if (referencing and connection.dialect.name == "postgresql"
+            and connection.scalar(IS_PARTITIONED)):
+        raise ReferencesPartitionedMessages(
+            f"Can't create {', '.join(referencing)}: messages is partitioned, so foreign keys to "
+            "messages.id aren't possible. Create the table without that foreign key and add its "
+            "cascade to messages_cascade_delete() (see partitioning.py).")
+
+
+def add_months(day, months):
+    """
+    The first day of the month `months` after the month of `day`.
+    """
+
+    (years, month) = divmod(day.month - 1 + months, 12)
+    return date(day.year + years, month + 1, 1)
+
+
+def month_partitions(start, end):
+    """
+    (name, from, to) of the month partitions covering `start` through `end` (both dates).
+    """
+
+    partitions = []
+    month = date(start.year, start.month, 1)
+
+    while month <= end:
+        following = add_months(month, 1)
+        partitions.append((f"messages_y{month.year}m{month.month:02d}", month, following))
+        month = following
+
+    return partitions
+
+
+def create_partitions(start, end):
+    """
+    Create any missing month partitions of messages covering `start` through `end`.
+
+    Postgres won't create a partition for rows the default partition already holds, so if it holds
+    any for the new months, it is detached while they are moved into their partitions, then
+    attached again. Returns the names of the partitions created.
+    """
+
+    session = db.session
+
+    existing = set(session.scalars(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('messages')")))
+
+    missing = [(name, start_day, end_day)
+               for (name, start_day, end_day) in month_partitions(start, end)
+               if name not in existing]
+
+    spilled = []
+
+    if DEFAULT_PARTITION in existing:
+        spilled = [(start_day, end_day) for (_, start_day, end_day) in missing
+                   if session.scalar(text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} "
+                                          "WHERE timestamp >= :start AND timestamp < :end)"),
+                                     {"start": start_day, "end": end_day})]
+
+    if spilled:
+        session.execute(text(f"ALTER TABLE messages DETACH PARTITION {DEFAULT_PARTITION}"))
+
+    for (name, start_day, end_day) in missing:
+        session.execute(text(
+            f"CREATE TABLE {name} PARTITION OF messages "
+            f"FOR VALUES FROM ('{start_day.isoformat()}') TO ('{end_day.isoformat()}')"))
+
+    if spilled:
+        # Detached, the default partition no longer has the cascade trigger, so deleting the rows
+        # from it leaves their likes etc. alone
+        for (start_day, end_day) in spilled:
+            session.execute(text(
+                f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+                "WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+                "INSERT INTO messages SELECT * FROM moved"),
+                {"start": start_day, "end": end_day})
+
+        session.execute(text(
+            f"ALTER TABLE messages ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+
+    return [name for (name, _, _) in missing]
+
+
+def partition_messages(months_ahead=3):
+    """
+    Convert messages into a table partitioned by month on timestamp, keeping all rows.
+
+    Partitions are created from the oldest message's month through `months_ahead` months after the
+    current one. Takes an exclusive lock on messages for the duration; run it during a quiet
+    period.
+    """
+
+    if is_partitioned():
+        raise ValueError("The messages table is already partitioned.")
+
+    session = db.session
+
+    # Foreign keys that point at messages.id (likes, message_tags, mentions, ...)
+    references = session.execute(text(
+        "SELECT con.conname, con.conrelid::regclass::text, att.attname "
+        "FROM pg_constraint con "
+        "JOIN pg_attribute att "
+        "  ON att.attrelid = con.conrelid AND att.attnum = con.conkey[1] "
+        "WHERE con.contype = 'f' AND con.confrelid = to_regclass('messages')")).all()
+
+    session.execute(text("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE"))
+
+    for (constraint, table, _) in references:
+        session.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{constraint}"'))
+
+    # Move the old table (and its index names) out of the way
+    session.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+
+    for index in session.scalars(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'messages_unpartitioned'")).all():
+        session.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index}_unpartitioned"'))
+
+    session.execute(text(
+        "CREATE TABLE messages "
+        "(LIKE messages_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        "PARTITION BY RANGE (timestamp)"))
+    session.execute(text("ALTER TABLE messages ADD PRIMARY KEY (id, timestamp)"))
+    session.execute(text(
+        "ALTER TABLE messages ADD FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE"))
+
+    for index in Message.__table__.indexes:
+        index.create(bind=session.connection())
+
+    oldest = session.scalar(text("SELECT min(timestamp) FROM messages_unpartitioned"))
+    today = session.scalar(text("SELECT current_date"))
+
+    create_partitions(min(oldest.date(), today) if oldest else today,
+                      add_months(today, months_ahead))
+    session.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF messages DEFAULT"))
+
+    session.execute(text("INSERT INTO messages SELECT * FROM messages_unpartitioned"))
+
+    # Keep the ID sequence when the old table is dropped
+    session.execute(text("ALTER SEQUENCE messages_id_seq OWNED BY messages.id"))
+    session.execute(text("DROP TABLE messages_unpartitioned"))
+
+    # Stand-in for the dropped ON DELETE CASCADE foreign keys
+    deletes = "".join(f"DELETE FROM {table} WHERE {column} = OLD.id; "
+                      for (_, table, column) in references)
+
+    session.execute(text(
+        "CREATE OR REPLACE FUNCTION messages_cascade_delete() RETURNS trigger "
+        f"LANGUAGE plpgsql AS $$ BEGIN {deletes}RETURN NULL; END $$"))
+    session.execute(text(
+        "CREATE TRIGGER messages_cascade_delete AFTER DELETE ON messages "
+        "FOR EACH ROW EXECUTE FUNCTION messages_cascade_delete()"))
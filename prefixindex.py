@@ -0,0 +1,203 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+In-memory prefix index of usernames, for search-box autocomplete.
+
+Usernames are kept in one list of (casefolded username, username, user ID) tuples, sorted. All the
+names starting with a prefix sit next to each other, from the position binary search gives for the
+prefix itself, so the first K matches cost O(log n + K) and never touch the database. Signups,
+renames and deletions in this process update the list in place (bisect.insort). The index is per
+process, so it is also rebuilt every `max_age` seconds to pick up other processes' changes. Only
+the very first build happens in a request; after that, the request that finds the index stale
+starts a rebuild in a background thread, and searches keep using the old list until it is done.
+Changes made during the rebuild are replayed onto the new list.
+"""
+
+import bisect
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import select
+
+from models import db, User
+
+YIELD_PER = 10_000
+
+
+def insert_entry(entries, entry):
+    """
+    Insert `entry` into the sorted list `entries`, unless it is already there.
+    """
+
+    i = bisect.bisect_left(entries, entry)
+
+    if i == len(entries) or entries[i] != entry:
+        entries.insert(i, entry)
+
+
+def delete_entry(entries, entry):
+    """
+    Delete `entry` from the sorted list `entries`, if it is there.
+    """
+
+    i = bisect.bisect_left(entries, entry)
+
+    if i < len(entries) and entries[i] == entry:
+        del entries[i]
+
+
+class PrefixIndex:
+    """
+    Sorted usernames of active users, searchable by case-insensitive prefix.
+    """
+
+    def __init__(self, app, max_age=300, clock=time.monotonic):
+        self.app = app
+        self.max_age = max_age
+        self.clock = clock
+        self.metrics = Counter()
+
+        self._entries = None
+        self._built_at = None
+        self._building = False
+        self._pending = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Build the index from the users table.
+        """
+
+        with self._lock:
+            self._building = True
+            self._pending = []
+
+        self._build()
+
+    def _build(self):
+        """
+        Build the list, once `_building` is set, and swap it in.
+        """
+
+        try:
+            rows = db.session.execute(select(User.username, User.id)
+                                      .where(User.is_active)
+                                      .execution_options(yield_per=YIELD_PER))
+            entries = sorted((username.casefold(), username, user_id)
+                             for (username, user_id) in rows)
+
+        finally:
+            with self._lock:
+                self._building = False
+
+        with self._lock:
+            # The build may or may not have seen changes made while it ran; replay them
+            for (change, entry) in self._pending:
+                change(entries, entry)
+
+            self._entries = entries
+            self._built_at = self.clock()
+            self._pending = []
+
+        self.metrics["loads"] += 1
+
+    def _build_in_background(self):
+        with self.app.app_context():
+            try:
+                self._build()
+            except Exception:
+                self.app.logger.exception("Rebuilding the username index failed")
+
+    def wait(self):
+        """
+        Wait for a background rebuild under way, if any.
+        """
+
+        with self._lock:
+            thread = self._thread
+
+        if thread is not None:
+            thread.join()
+
+    def expire(self):
+        """
+        Rebuild on next use, in the background.
+        """
+
+        with self._lock:
+            self._built_at = None
+
+    def _snapshot(self):
+        """
+        Make sure there is a list to search: built first if there is none yet, or else rebuilt in
+        the background if it is stale (and no other thread is already at it).
+        """
+
+        with self._lock:
+            stale = self._built_at is None or self.clock() - self._built_at >= self.max_age
+            rebuild = stale and not self._building and self._entries is not None
+
+            if rebuild:
+                self._building = True
+                self._pending = []
+                self._thread = threading.Thread(target=self._build_in_background,
+                                                name="username-index", daemon=True)
+                self._thread.start()
+
+            missing = self._entries is None
+
+        if missing:
+            self.load()
+
+    def search(self, prefix, limit=10):
+        """
+        Up to `limit` (user ID, username) pairs whose username starts with `prefix` (ignoring
+        case), in alphabetical order.
+        """
+
+        self._snapshot()
+
+        key = prefix.casefold()
+        matches = []
+
+        with self._lock:
+            for i in range(bisect.bisect_left(self._entries, (key,)), len(self._entries)):
+                (folded, username, user_id) = self._entries[i]
+
+                if not folded.startswith(key) or len(matches) == limit:
+                    break
+
+                matches.append((user_id, username))
+
+        self.metrics["searches"] += 1
+        return matches
+
+    def add(self, user_id, username):
+        """
+        Index a new (or renamed) user.
+        """
+
+        self._change(insert_entry, (username.casefold(), username, user_id))
+
+    def remove(self, user_id, username):
+        """
+        Drop a deleted (or renamed) user.
+        """
+
+        self._change(delete_entry, (username.casefold(), username, user_id))
+
+    def _change(self, change, entry):
+        with self._lock:
+            if self._entries is not None:
+                change(self._entries, entry)
+
+            if self._building:
+                self._pending.append((change, entry))
+
+    def rename(self, user_id, old_username, new_username):
+        if old_username != new_username:
+            self.remove(user_id, old_username)
+            self.add(user_id, new_username)
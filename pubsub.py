@@ -0,0 +1,89 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+In-process publish/subscribe, used to push new warbles to open timeline streams.
+
+Topics are arbitrary hashable keys (user IDs, for timelines). Each subscription has a bounded
+queue; if a slow subscriber's queue fills up, further events for it are dropped and the
+subscription is marked as overflowed, so the client knows to resync (e.g. with since_id).
+"""
+
+import queue
+import threading
+from collections import defaultdict
+
+
+class Subscription:
+    """
+    A subscriber's queue of events for a set of topics.
+    """
+
+    def __init__(self, topics, maxsize):
+        self.topics = frozenset(topics)
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """
+        Return the next event, or None if none arrives within `timeout` seconds.
+        """
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broker:
+    """
+    Routes published events to the subscriptions of their topic.
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics):
+        """
+        Start receiving events published to any of `topics`.
+        """
+
+        subscription = Subscription(topics, self.maxsize)
+
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscriptions[topic].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscriptions.get(topic)
+
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+
+                    if not subscribers:
+                        del self._subscriptions[topic]
+
+    def publish(self, topic, event):
+        """
+        Deliver `event` to every current subscriber of `topic`. Returns the number of subscribers.
+        """
+
+        with self._lock:
+            subscribers = list(self._subscriptions.get(topic, ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+        return len(subscribers)
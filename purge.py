@@ -0,0 +1,120 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Purging deleted accounts.
+
+Deleting an account only marks the user inactive; the user's follows, suggestions, likes, mentions,
+timeline entries and messages are then removed here in bounded batches, each in its own short
+transaction, so no single statement (including the ON DELETE CASCADE of the final user row) loads
+or locks a prolific account's entire history.
+"""
+
+from sqlalchemy import delete, select, tuple_
+
+from models import (db, ArchivedLike, ArchivedMessage, Follow, FollowSuggestion, Like, Mention,
+                    Message, MessageTag, TimelineEntry, User)
+from timeline import recount_followers
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def delete_in_batches(table, key_cols, condition, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Delete rows of `table` matching `condition`, at most `batch_size` rows per transaction.
+
+    `key_cols` identify a row (e.g. the primary key columns). Returns the number of rows deleted.
+    """
+
+    total = 0
+
+    while True:
+        batch = select(*key_cols).where(condition).limit(batch_size)
+        result = db.session.execute(delete(table).where(tuple_(*key_cols).in_(batch)))
+        db.session.commit()
+
+        total += result.rowcount
+
+        if result.rowcount < batch_size:
+            return total
+
+
+def purge_user(user_id, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Remove a (deactivated) user and all of their data, in batches.
+
+    Follows and follow suggestions go first so the user disappears from other users' timelines,
+    follow lists and "who to follow" right away (the users they followed then have their followers
+    recounted). Then the user's likes, their mentions and home timeline, and the mentions, tags and
+    timeline entries of their messages; messages (then archived messages) go last, each batch
+    also cascading to likes of those messages.
+    """
+
+    follows = Follow.__table__.c
+    suggestions = FollowSuggestion.__table__.c
+    likes = Like.__table__.c
+    archived_likes = ArchivedLike.__table__.c
+    mentions = Mention.__table__.c
+    tags = MessageTag.__table__.c
+    timeline = TimelineEntry.__table__.c
+    messages = Message.__table__.c
+    archived = ArchivedMessage.__table__.c
+
+    own_message_ids = select(messages.id).where(messages.user_id == user_id)
+
+    followed_ids = db.session.scalars(select(follows.user_being_followed_id)
+                                      .where(follows.user_following_id == user_id)).all()
+
+    delete_in_batches(Follow.__table__,
+                      [follows.user_being_followed_id, follows.user_following_id],
+                      (follows.user_following_id == user_id) |
+                      (follows.user_being_followed_id == user_id),
+                      batch_size)
+
+    for start in range(0, len(followed_ids), batch_size):
+        recount_followers(followed_ids[start:start + batch_size])
+        db.session.commit()
+
+    delete_in_batches(FollowSuggestion.__table__,
+                      [suggestions.user_id, suggestions.suggested_user_id],
+                      (suggestions.user_id == user_id) |
+                      (suggestions.suggested_user_id == user_id),
+                      batch_size)
+
+    delete_in_batches(Like.__table__,
+                      [likes.user_id, likes.message_id],
+                      likes.user_id == user_id,
+                      batch_size)
+
+    delete_in_batches(ArchivedLike.__table__,
+                      [archived_likes.user_id, archived_likes.message_id],
+                      archived_likes.user_id == user_id,
+                      batch_size)
+
+    delete_in_batches(Mention.__table__,
+                      [mentions.user_id, mentions.message_id],
+                      (mentions.user_id == user_id) | mentions.message_id.in_(own_message_ids),
+                      batch_size)
+
+    delete_in_batches(TimelineEntry.__table__,
+                      [timeline.user_id, timeline.message_id],
+                      (timeline.user_id == user_id) | timeline.message_id.in_(own_message_ids),
+                      batch_size)
+
+    delete_in_batches(MessageTag.__table__,
+                      [tags.tag, tags.message_id],
+                      tags.message_id.in_(own_message_ids),
+                      batch_size)
+
+    delete_in_batches(Message.__table__,
+                      [messages.id],
+                      messages.user_id == user_id,
+                      batch_size)
+
+    delete_in_batches(ArchivedMessage.__table__,
+                      [archived.id],
+                      archived.user_id == user_id,
+                      batch_size)
+
+    db.session.execute(delete(User.__table__).where(User.__table__.c.id == user_id))
+    db.session.commit()
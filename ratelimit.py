@@ -0,0 +1,212 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Per-user write quotas (token buckets).
+
+Each user has a bucket per kind of write ("messages", "likes", ...) holding up to `burst` tokens
+and refilled at `rate` tokens per second; a write takes one token, and a write that finds the
+bucket empty gets a 429 response with a Retry-After header. Views opt in with RateLimiter.limit.
+The check runs in a before_request hook registered ahead of the app's own, keyed on the user ID
+in the session cookie, so a rejected request costs no database work (with the memory store).
+Views that logged-out visitors may call (e.g. lookups that could be used to enumerate accounts)
+can also be limited per client address.
+
+Stores (chosen with the RATELIMIT_BACKEND config key):
+
+- "memory": a dict of buckets in this process (the default); each process enforces its own quota
+- "database": the rate_limit_buckets table, shared by all processes; one upsert per write
+"""
+
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from flask import Response, jsonify, request
+from sqlalchemy import extract, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, RateLimitBucket
+
+
+class MemoryStore:
+    """
+    Token buckets in a bounded dict; the least recently used are dropped first (a dropped bucket
+    just starts full again).
+    """
+
+    def __init__(self, max_keys=100_000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate):
+        """
+        Take a token from bucket `key`. Returns 0 if there was one, or else the number of seconds
+        until there will be.
+        """
+
+        with self._lock:
+            now = self.clock()
+            (tokens, updated_at) = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+                return (1 - tokens) / rate
+
+            self._buckets[key] = (tokens - 1, now)
+            self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+            return 0
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class DatabaseStore:
+    """
+    Token buckets in the rate_limit_buckets table: refill and take happen in one upsert, so
+    concurrent requests from any process can't spend the same token.
+    """
+
+    def take(self, key, burst, rate):
+        """
+        Take a token from bucket `key`. Returns 0 if there was one, or else the number of seconds
+        until there will be. Commits.
+        """
+
+        bucket = RateLimitBucket.__table__
+        now = func.clock_timestamp()
+        refilled = func.least(burst, bucket.c.tokens +
+                              extract("epoch", now - bucket.c.updated_at) * rate)
+
+        stmt = (insert(bucket)
+                .values(key=key, tokens=burst - 1, updated_at=now)
+                .on_conflict_do_update(index_elements=["key"],
+                                       set_={"tokens": refilled - 1, "updated_at": now},
+                                       where=refilled >= 1)
+                .returning(bucket.c.tokens))
+
+        taken = db.session.execute(stmt).first()
+
+        if taken is None:
+            tokens = db.session.scalar(select(refilled).where(bucket.c.key == key))
+
+        db.session.commit()
+        return 0 if taken is not None else (1 - tokens) / rate
+
+    def clear(self):
+        db.session.execute(RateLimitBucket.__table__.delete())
+        db.session.commit()
+
+
+class RateLimiter:
+    """
+    Checks the quotas of `app`'s rate-limited views. `identity` returns the ID to count a request
+    against (e.g. the logged-in user's, from the session), or None to let it through unchecked.
+
+    Create it before registering other before_request hooks, so over-quota requests are turned
+    away first.
+    """
+
+    def __init__(self, app, identity):
+        self.app = app
+        self.identity = identity
+        self.metrics = Counter()
+
+        self._store = None
+        self._lock = threading.Lock()
+
+        app.before_request(self.check)
+
+    @property
+    def store(self):
+        with self._lock:
+            if self._store is None:
+                self._store = self.make_store(self.app.config['RATELIMIT_BACKEND'])
+
+            return self._store
+
+    def make_store(self, kind):
+        """
+        Build a store of the given kind ("memory" or "database").
+        """
+
+        if kind == "memory":
+            return MemoryStore()
+
+        if kind == "database":
+            return DatabaseStore()
+
+        raise ValueError(f"Unknown rate limit backend: {kind}")
+
+    def limit(self, name, methods=("POST",), anonymous=False):
+        """
+        Decorator: count requests to a view with one of `methods` against quota `name` (a key of
+        RATELIMITS). Requests without an identity are let through, unless `anonymous` is set:
+        then they are counted per client address.
+        """
+
+        def decorator(fn):
+            fn.rate_limit = (name, frozenset(methods), anonymous)
+            return fn
+
+        return decorator
+
+    def check(self):
+        """
+        before_request hook: turn the request away with a 429 if it is over quota.
+        """
+
+        if not self.app.config['RATELIMIT_ENABLED']:
+            return None
+
+        limit = getattr(self.app.view_functions.get(request.endpoint), "rate_limit", None)
+
+        if limit is None or request.method not in limit[1]:
+            return None
+
+        (name, _, anonymous) = limit
+        key = self.identity()
+
+        if key is None:
+            if not anonymous:
+                return None
+
+            key = f"address:{request.remote_addr}"
+
+        (burst, rate) = self.app.config['RATELIMITS'][name]
+        retry_after = self.store.take(f"{name}:{key}", burst, rate)
+
+        if not retry_after:
+            self.metrics[f"{name}.allowed"] += 1
+            return None
+
+        self.metrics[f"{name}.limited"] += 1
+        return too_many_requests(math.ceil(retry_after))
+
+
+def too_many_requests(retry_after):
+    """
+    The 429 response: JSON for API endpoints, plain text otherwise.
+    """
+
+    message = f"Too many requests. Try again in {retry_after} seconds."
+
+    if request.path.startswith("/api/"):
+        response = jsonify(error=message)
+    else:
+        response = Response(message, mimetype="text/plain")
+
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
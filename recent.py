@@ -0,0 +1,93 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+In-memory cache of each author's newest messages, for profile pages and timeline merging.
+
+Each cached author has a ring buffer of the sort keys - (timestamp, id) pairs - of their newest
+messages, newest first: posting a message pushes its key on the front, and the oldest falls off
+the end. Authors are evicted least recently used once there are too many, and entries expire after
+`ttl` seconds, which bounds how stale another process's cache can get (each process has its own).
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+
+class RecentMessagesCache:
+    """
+    Bounded LRU map of author ID -> ring buffer of their newest `per_author` message keys.
+    """
+
+    def __init__(self, per_author=100, max_authors=10_000, ttl=60, clock=time.monotonic):
+        self.per_author = per_author
+        self.max_authors = max_authors
+        self.ttl = ttl
+        self.clock = clock
+        self.metrics = Counter()
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, author_id):
+        """
+        Return the author's newest (timestamp, id) keys, newest first, or None if they aren't
+        cached.
+        """
+
+        with self._lock:
+            entry = self._entries.get(author_id)
+
+            if entry is not None and self.clock() - entry[0] >= self.ttl:
+                del self._entries[author_id]
+                entry = None
+
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+
+            self._entries.move_to_end(author_id)
+            self.metrics["hits"] += 1
+            return list(entry[1])
+
+    def put(self, author_id, keys):
+        """
+        Cache the author's newest (timestamp, id) keys, newest first, as just read from the
+        database.
+        """
+
+        with self._lock:
+            self._entries[author_id] = (self.clock(),
+                                        deque(keys[:self.per_author], maxlen=self.per_author))
+            self._entries.move_to_end(author_id)
+
+            while len(self._entries) > self.max_authors:
+                self._entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+    def add(self, author_id, timestamp, message_id):
+        """
+        Record a new message by the author (only if they are cached; otherwise the next read
+        loads it from the database anyway).
+        """
+
+        with self._lock:
+            entry = self._entries.get(author_id)
+
+            if entry is not None:
+                entry[1].appendleft((timestamp, message_id))
+
+    def invalidate(self, author_id):
+        """
+        Forget the author's entry, e.g. after one of their messages is deleted (its slot can't be
+        refilled without going back to the database) or older messages are imported.
+        """
+
+        with self._lock:
+            if self._entries.pop(author_id, None) is not None:
+                self.metrics["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,49 @@
+// Ioana A Mititean
+// Unit 26: Warbler (Twitter Clone)
+
+// Search-box autocomplete: as the user types, fetch usernames starting with what they have typed
+// and offer them through the box's <datalist>. Requests are made at most once per DELAY ms, and
+// a response that arrives after a newer one has been asked for is ignored.
+
+(function () {
+  const DELAY = 150;
+  const input = document.querySelector("#search[data-autocomplete-url]");
+
+  if (!input) {
+    return;
+  }
+
+  const list = document.getElementById(input.getAttribute("list"));
+  let timer = null;
+  let latest = 0;
+
+  input.addEventListener("input", () => {
+    clearTimeout(timer);
+    timer = setTimeout(suggest, DELAY);
+  });
+
+  async function suggest() {
+    const prefix = input.value.trim();
+    const request = ++latest;
+
+    if (!prefix) {
+      list.replaceChildren();
+      return;
+    }
+
+    try {
+      const resp = await fetch(
+        `${input.dataset.autocompleteUrl}?q=${encodeURIComponent(prefix)}`,
+        { credentials: "same-origin" });
+
+      if (!resp.ok || request !== latest) {
+        return;
+      }
+
+      const { users } = await resp.json();
+      list.replaceChildren(...users.map((user) => new Option(user.username)));
+    } catch (err) {
+      // No suggestions; the search form still works
+    }
+  }
+})();
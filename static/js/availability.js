@@ -0,0 +1,47 @@
+// Ioana A Mititean
+// Unit 26: Warbler (Twitter Clone)
+
+// Username/email availability hints: when the username or email field of a form with a
+// data-availability-url changes, ask the server whether the value is free and mark the field
+// invalid (with a note under it) if it is taken. The server checks again on submit.
+
+(function () {
+  const form = document.querySelector("form[data-availability-url]");
+
+  if (!form) {
+    return;
+  }
+
+  for (const name of ["username", "email"]) {
+    const field = form.elements[name];
+
+    if (!field) {
+      continue;
+    }
+
+    const note = document.createElement("div");
+    note.className = "invalid-feedback";
+    note.textContent = `That ${name} is already taken.`;
+    field.after(note);
+
+    field.addEventListener("change", async () => {
+      field.classList.remove("is-invalid");
+
+      if (!field.value) {
+        return;
+      }
+
+      const url = `${form.dataset.availabilityUrl}?${name}=${encodeURIComponent(field.value)}`;
+
+      try {
+        const resp = await fetch(url, { credentials: "same-origin" });
+
+        if (resp.ok && (await resp.json())[name] === false) {
+          field.classList.add("is-invalid");
+        }
+      } catch (err) {
+        // No hint; the server still checks on submit
+      }
+    });
+  }
+})();
@@ -0,0 +1,54 @@
+// Ioana A Mititean
+// Unit 26: Warbler (Twitter Clone)
+
+// Infinite scroll for paginated lists: when the "More" link at the end of a [data-infinite-scroll]
+// container comes into view, fetch the next page as a fragment (its data-partial-url) and append
+// it. Without IntersectionObserver, "More" stays an ordinary link to the next page.
+
+(function () {
+  const container = document.querySelector("[data-infinite-scroll]");
+
+  if (!container || !window.IntersectionObserver) {
+    return;
+  }
+
+  let loading = false;
+
+  const observer = new IntersectionObserver(async (entries) => {
+    const entry = entries.find((e) => e.isIntersecting);
+
+    if (!entry || loading) {
+      return;
+    }
+
+    loading = true;
+    const link = entry.target;
+    observer.unobserve(link);
+
+    try {
+      const resp = await fetch(link.dataset.partialUrl, { credentials: "same-origin" });
+
+      if (!resp.ok) {
+        throw new Error(`HTTP ${resp.status}`);
+      }
+
+      link.closest(".load-more").remove();
+      container.insertAdjacentHTML("beforeend", await resp.text());
+      watchMoreLink();
+    } catch (err) {
+      // Leave the plain link in place for the user to follow
+    } finally {
+      loading = false;
+    }
+  }, { rootMargin: "400px" });
+
+  function watchMoreLink() {
+    const link = container.querySelector(".load-more a[data-partial-url]");
+
+    if (link) {
+      observer.observe(link);
+    }
+  }
+
+  watchMoreLink();
+})();
@@ -0,0 +1,48 @@
+// Ioana A Mititean
+// Unit 26: Warbler (Twitter Clone)
+
+// Live timeline updates: new warbles from followed users are pushed over Server-Sent Events and
+// prepended to the timeline. Browsers without EventSource poll the since_id endpoint instead.
+
+(function () {
+  const timeline = document.getElementById("messages");
+  const POLL_MS = 30000;
+
+  if (!timeline) {
+    return;
+  }
+
+  function newestId() {
+    const first = timeline.querySelector("[data-message-id]");
+    return first ? Number(first.dataset.messageId) : 0;
+  }
+
+  function prepend(message) {
+    if (timeline.querySelector(`[data-message-id="${message.id}"]`)) {
+      return;
+    }
+
+    timeline.insertAdjacentHTML("afterbegin", message.html);
+  }
+
+  if (window.EventSource) {
+    const url = `${timeline.dataset.streamUrl}?since_id=${newestId()}`;
+    const stream = new EventSource(url);
+
+    stream.addEventListener("message", (evt) => prepend(JSON.parse(evt.data)));
+
+    // Server asks us to catch up (our queue overflowed): fetch what we missed
+    stream.addEventListener("resync", poll);
+  } else {
+    setInterval(poll, POLL_MS);
+  }
+
+  async function poll() {
+    const resp = await fetch(`${timeline.dataset.sinceUrl}?since_id=${newestId()}`);
+
+    if (resp.ok) {
+      const data = await resp.json();
+      data.messages.forEach(prepend);
+    }
+  }
+})();
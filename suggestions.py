@@ -0,0 +1,122 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+"Who to follow" suggestions computed from the follows graph.
+
+Suggestions are friends-of-friends, ranked by how many of a user's followees follow the suggested
+user. They are computed in one set-based statement and stored in the follow_suggestions table, so
+serving the suggestions widget is a single indexed read.
+"""
+
+import threading
+import time
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import aliased
+
+from models import db, Follow, FollowSuggestion, User
+
+DEFAULT_PER_USER = 10
+
+
+def refresh_suggestions(user_ids=None, per_user=DEFAULT_PER_USER):
+    """
+    Recompute stored suggestions for the users in `user_ids` (or for every user, if None).
+
+    Keeps the top `per_user` suggestions per user. Does not commit; the caller owns the
+    transaction.
+    """
+
+    followee = aliased(Follow)
+    second_hop = aliased(Follow)
+    already_following = aliased(Follow)
+
+    # Deleted accounts are hidden until they are purged; don't spend suggestion slots on them
+    candidate = aliased(User)
+
+    score = func.count().label("score")
+    ranked = (select(followee.user_following_id.label("user_id"),
+                     second_hop.user_being_followed_id.label("suggested_user_id"),
+                     score,
+                     func.row_number().over(
+                         partition_by=followee.user_following_id,
+                         order_by=(func.count().desc(), second_hop.user_being_followed_id)
+                     ).label("rank"))
+              .join(second_hop, second_hop.user_following_id == followee.user_being_followed_id)
+              .join(candidate, candidate.id == second_hop.user_being_followed_id)
+              .where(candidate.is_active)
+              .where(second_hop.user_being_followed_id != followee.user_following_id)
+              .where(~select(already_following)
+                     .where(already_following.user_following_id == followee.user_following_id)
+                     .where(already_following.user_being_followed_id ==
+                            second_hop.user_being_followed_id)
+                     .exists())
+              .group_by(followee.user_following_id, second_hop.user_being_followed_id))
+
+    clear = delete(FollowSuggestion)
+
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        ranked = ranked.where(followee.user_following_id.in_(user_ids))
+        clear = clear.where(FollowSuggestion.user_id.in_(user_ids))
+
+    ranked = ranked.subquery()
+    top = (select(ranked.c.user_id, ranked.c.suggested_user_id, ranked.c.score)
+           .where(ranked.c.rank <= per_user))
+
+    db.session.execute(clear)
+    db.session.execute(
+        insert(FollowSuggestion).from_select(["user_id", "suggested_user_id", "score"], top))
+
+
+def get_suggestions(user_id, limit=5):
+    """
+    Return up to `limit` suggested users for `user_id`, best first, leaving out any deleted since
+    the suggestions were computed.
+    """
+
+    return (User
+            .query
+            .join(FollowSuggestion, FollowSuggestion.suggested_user_id == User.id)
+            .filter(FollowSuggestion.user_id == user_id)
+            .filter(User.is_active)
+            .order_by(FollowSuggestion.score.desc(), User.id)
+            .limit(limit)
+            .all())
+
+
+def discard_suggestion(user_id, suggested_user_id):
+    """
+    Drop a single stored suggestion (e.g. once the user follows the suggested user).
+
+    Does not commit.
+    """
+
+    db.session.execute(delete(FollowSuggestion)
+                       .where(FollowSuggestion.user_id == user_id)
+                       .where(FollowSuggestion.suggested_user_id == suggested_user_id))
+
+
+def start_refresher(app, interval):
+    """
+    Start a daemon thread that recomputes all suggestions every `interval` seconds. A failed
+    refresh is logged, and tried again after the next interval.
+    """
+
+    def run():
+        while True:
+            with app.app_context():
+                try:
+                    refresh_suggestions(per_user=app.config['SUGGESTIONS_PER_USER'])
+                    db.session.commit()
+
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Refreshing follow suggestions failed")
+
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="suggestions-refresher", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,87 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Hashtag and @mention extraction.
+
+Messages are parsed once, when they are written, into the message_tags and mentions tables; tag
+and mention feeds then read those indexes instead of searching message text.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+from flask import url_for
+
+from models import db, MessageTag, Mention, User
+
+# The lookbehinds skip e.g. "a#b" and HTML entities like "&#39;" (linkify runs on escaped text)
+TAG_RE = re.compile(r"(?<![\w#&])#(\w{1,100})")
+MENTION_RE = re.compile(r"(?<![\w@])@(\w+)")
+TOKEN_RE = re.compile(f"{TAG_RE.pattern}|{MENTION_RE.pattern}")
+
+
+def extract_tags(text):
+    """
+    Get the distinct hashtags in `text`, lowercased, without the leading '#'.
+    """
+
+    return sorted({tag.lower() for tag in TAG_RE.findall(text)})
+
+
+def extract_mentions(text):
+    """
+    Get the distinct usernames @mentioned in `text`.
+    """
+
+    return sorted(set(MENTION_RE.findall(text)))
+
+
+def index_messages(messages):
+    """
+    Add index rows for the tags and mentions in each of `messages` (which must have IDs and
+    timestamps).
+
+    Mentions of unknown usernames are ignored. Does not commit.
+    """
+
+    tag_rows = []
+    mentioned = {}
+
+    for msg in messages:
+        tag_rows.extend({"tag": tag, "message_id": msg.id, "timestamp": msg.timestamp}
+                        for tag in extract_tags(msg.text))
+
+        for username in extract_mentions(msg.text):
+            mentioned.setdefault(username, []).append(msg)
+
+    if tag_rows:
+        db.session.execute(db.insert(MessageTag), tag_rows)
+
+    if mentioned:
+        users = db.session.execute(db.select(User.username, User.id)
+                                   .where(User.username.in_(list(mentioned)))
+                                   .where(User.is_active)).all()
+
+        mention_rows = [{"user_id": user_id, "message_id": msg.id, "timestamp": msg.timestamp}
+                        for (username, user_id) in users
+                        for msg in mentioned[username]]
+
+        if mention_rows:
+            db.session.execute(db.insert(Mention), mention_rows)
+
+
+def linkify(text):
+    """
+    Jinja filter: escape message text, linking #tags to their feeds and @mentions to user search.
+    """
+
+    def link(match):
+        (tag, username) = match.groups()
+
+        if tag is not None:
+            return f'<a href="{url_for("tag_feed", tag=tag.lower())}">#{tag}</a>'
+
+        return f'<a href="{url_for("list_users", q=username)}">@{username}</a>'
+
+    return Markup(TOKEN_RE.sub(link, str(escape(text))))
@@ -0,0 +1,183 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Username/email availability tests.
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import select
+
+from app import app, limiter, taken_names, CURR_USER_KEY
+from availability import BloomFilter
+from models import db, connect_db, User
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class BloomFilterTestCase(TestCase):
+    """
+    Test the filter's guarantees.
+    """
+
+    def test_no_false_negatives(self):
+        """
+        Test that every added value is found, and that few others are (at about the error rate).
+        """
+
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        self.assertTrue(all(f"user{i}" in bloom for i in range(1000)))
+        self.assertLess(sum(f"other{i}" in bloom for i in range(10_000)), 300)
+
+
+class AvailabilityViewTestCase(TestCase):
+    """
+    Test the availability endpoint and the checks before signup.
+    """
+
+    def setUp(self):
+        """
+        Add one user, and have the filters rebuilt.
+        """
+
+        with app.app_context():
+            User.query.delete()
+
+            user = User(email="taken@test.com", username="taken", password="HASHED")
+            db.session.add(user)
+            db.session.commit()
+
+            self.user_id = user.id
+
+        taken_names.expire()
+        self.client = app.test_client()
+        return super().setUp()
+
+    def test_availability(self):
+        """
+        Test that taken values are reported as such, and that free ones skip the database.
+        """
+
+        with self.client as c:
+            c.get("/signup")
+            resp = c.get("/api/users/availability",
+                         query_string={"username": "taken", "email": "free@test.com"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"username": False, "email": True})
+
+            misses = taken_names.metrics["filter_misses"]
+            resp = c.get("/api/users/availability", query_string={"username": "free"})
+
+            self.assertEqual(resp.json, {"username": True})
+            self.assertEqual(taken_names.metrics["filter_misses"], misses + 1)
+
+            self.assertEqual(c.get("/api/users/availability").status_code, 400)
+
+    def test_availability_email_needs_signup_form(self):
+        """
+        Test that emails are only checked for visitors shown the signup form, and that logged-out
+        lookups are rate limited per address.
+        """
+
+        (burst, _) = app.config['RATELIMITS']["availability"]
+        limiter.store.clear()
+
+        with self.client as c:
+            resp = c.get("/api/users/availability",
+                         query_string={"username": "free", "email": "taken@test.com"})
+            self.assertEqual(resp.json, {"username": True})
+
+            for _ in range(burst - 1):
+                c.get("/api/users/availability", query_string={"username": "free"})
+
+            resp = c.get("/api/users/availability", query_string={"username": "free"})
+            self.assertEqual(resp.status_code, 429)
+
+        limiter.store.clear()
+
+    def test_stale_filters_rebuilt_once(self):
+        """
+        Test that while one thread rebuilds stale filters, others keep using the old ones, and
+        that values added meanwhile make it into the new ones.
+        """
+
+        with app.app_context():
+            self.assertTrue(taken_names.is_taken("username", "taken"))
+            loads = taken_names.metrics["loads"]
+
+            taken_names.expire()
+            taken_names._building = True
+            self.assertTrue(taken_names.is_taken("username", "taken"))
+            self.assertEqual(taken_names.metrics["loads"], loads)
+            taken_names._building = False
+
+            def select_during_build(*columns):
+                taken_names.add(username="during")
+                return select(*columns)
+
+            with patch("availability.select", select_during_build):
+                taken_names.load()
+
+            # The table doesn't have it, but the filters do (confirmed by an index lookup)
+            misses = taken_names.metrics["filter_misses"]
+            self.assertFalse(taken_names.is_taken("username", "during"))
+            self.assertEqual(taken_names.metrics["filter_misses"], misses)
+
+    def test_availability_own_values(self):
+        """
+        Test that a logged-in user's own username is available to them.
+        """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get("/api/users/availability", query_string={"username": "taken"})
+            self.assertEqual(resp.json, {"username": True})
+
+    def test_signup_taken(self):
+        """
+        Test that signing up with a taken username is refused before any password is hashed.
+        """
+
+        with self.client as c:
+            resp = c.post("/signup", data={"username": "taken",
+                                           "email": "new@test.com",
+                                           "password": "password"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Username or email already taken", resp.get_data(as_text=True))
+
+        with app.app_context():
+            self.assertEqual(User.query.count(), 1)
+
+    def test_signup_adds_to_filter(self):
+        """
+        Test that a new user's username is taken as soon as they have signed up.
+        """
+
+        with self.client as c:
+            c.post("/signup", data={"username": "newbie",
+                                    "email": "newbie@test.com",
+                                    "password": "password"})
+
+        with app.app_context():
+            self.assertTrue(taken_names.is_taken("username", "newbie"))
+            self.assertTrue(taken_names.is_taken("email", "newbie@test.com"))
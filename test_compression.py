@@ -0,0 +1,179 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Response compression tests.
+"""
+
+import gzip
+from unittest import TestCase
+
+import brotli
+
+from app import app, CURR_USER_KEY, compressor
+from compression import parse_accept_encoding, choose_encoding
+from models import db, connect_db, User, Message
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class NegotiationTestCase(TestCase):
+    """
+    Test Accept-Encoding parsing and negotiation.
+    """
+
+    def test_parse_accept_encoding(self):
+        """
+        Test that codings are lowercased and given their quality values.
+        """
+
+        self.assertEqual(parse_accept_encoding("gzip, deflate;q=0.5, BR;q=0"),
+                         {"gzip": 1.0, "deflate": 0.5, "br": 0.0})
+        self.assertEqual(parse_accept_encoding(None), {})
+
+    def test_choose_encoding(self):
+        """
+        Test that the server's preference wins among accepted codings, and q=0 refuses one.
+        """
+
+        self.assertEqual(choose_encoding("gzip, br", ("br", "gzip")), "br")
+        self.assertEqual(choose_encoding("gzip, br;q=0", ("br", "gzip")), "gzip")
+        self.assertEqual(choose_encoding("*", ("br", "gzip")), "br")
+        self.assertIsNone(choose_encoding("identity", ("br", "gzip")))
+        self.assertIsNone(choose_encoding("", ("br", "gzip")))
+
+
+class CompressionViewTestCase(TestCase):
+    """
+    Test compression of real responses.
+    """
+
+    def setUp(self):
+        """
+        Create a user with a full page of messages on their home timeline.
+        """
+
+        with app.app_context():
+            User.query.delete()
+            Message.query.delete()
+
+            user = User.signup(username="testuser",
+                               email="test@test.com",
+                               password="testuser",
+                               image_url=None,
+                               location=None)
+            db.session.flush()
+
+            db.session.add_all(Message(text=f"Warble number {i} #test", user_id=user.id)
+                               for i in range(100))
+            db.session.commit()
+            self.user_id = user.id
+
+        self.client = app.test_client()
+        return super().setUp()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_home_page_compressed(self):
+        """
+        Test that the home page is brotli- or gzip-compressed as negotiated, and much smaller.
+        """
+
+        with self.client as c:
+            self.login(c)
+
+            # Streamed; read it in full before the next request pushes its own context
+            plain = c.get("/", buffered=True)
+            self.assertNotIn("Content-Encoding", plain.headers)
+            self.assertIn("Accept-Encoding", plain.headers["Vary"])
+
+            resp = c.get("/", headers={"Accept-Encoding": "gzip, deflate, br"})
+            self.assertEqual(resp.headers["Content-Encoding"], "br")
+            self.assertEqual(brotli.decompress(resp.data), plain.data)
+            self.assertLess(len(resp.data), len(plain.data) / 5)
+
+            resp = c.get("/", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+        self.assertGreater(compressor.stats["homepage.raw_bytes"],
+                           compressor.stats["homepage.wire_bytes"])
+        self.assertGreaterEqual(compressor.stats["homepage.compressed"], 2)
+
+    def test_metrics_endpoint(self):
+        """
+        Test that the counters are served only when enabled.
+        """
+
+        with self.client as c:
+            self.assertEqual(c.get("/debug/metrics").status_code, 404)
+            c.get("/users", buffered=True)
+
+            app.config['METRICS_ENDPOINT_ENABLED'] = True
+
+            try:
+                metrics = c.get("/debug/metrics").json
+            finally:
+                app.config['METRICS_ENDPOINT_ENABLED'] = False
+
+        self.assertGreater(metrics["compression"]["list_users.streamed"], 0)
+        self.assertEqual(set(metrics), {"compression", "jobs", "recent_messages", "rate_limits",
+                                        "like_buffer", "page_cache"})
+
+    def test_streamed_page_compressed(self):
+        """
+        Test that a streamed page is compressed as it is sent.
+        """
+
+        with self.client as c:
+            plain = c.get("/users", buffered=True)
+            resp = c.get("/users", headers={"Accept-Encoding": "gzip"}, buffered=True)
+
+            self.assertNotIn("Content-Length", resp.headers)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+    def test_small_and_streamed_not_compressed(self):
+        """
+        Test that responses under the size threshold and event streams are sent as-is.
+        """
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/timeline?since_id=0", headers={"Accept-Encoding": "gzip"})
+            self.assertIn("Content-Encoding", resp.headers)
+
+            resp = c.get(f"/api/timeline?since_id={2 ** 31 - 1}",
+                         headers={"Accept-Encoding": "gzip"})
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+            app.config['TIMELINE_STREAM_SECONDS'] = 0
+            try:
+                resp = c.get("/api/timeline/stream", headers={"Accept-Encoding": "gzip"})
+                self.assertNotIn("Content-Encoding", resp.headers)
+                self.assertIn("retry:", resp.get_data(as_text=True))
+            finally:
+                app.config['TIMELINE_STREAM_SECONDS'] = 5 * 60
+
+    def test_whitespace_trimmed(self):
+        """
+        Test that indented block tags don't leave whitespace-only lines behind.
+        """
+
+        with self.client as c:
+            self.login(c)
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertEqual([line for line in html.split("\n") if line and not line.strip()], [])
@@ -0,0 +1,171 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Follows index tests.
+"""
+
+from unittest import TestCase
+
+from app import app, follow_graph, CURR_USER_KEY
+from followgraph import Adjacency, Overlay
+from models import db, connect_db, User, Follow
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_BACKEND'] = 'inline'
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class AdjacencyTestCase(TestCase):
+    """
+    Test the CSR arrays and the overlay of changes on top of them.
+    """
+
+    def setUp(self):
+        # 1 -> 2, 1 -> 3, 2 -> 3, 4 -> 1
+        self.forward = Adjacency.from_groups([(1, [2, 3]), (2, [3]), (4, [1])], size=5)
+
+    def test_lookups(self):
+        """
+        Test degrees, neighbour lists and membership, including for IDs past the end.
+        """
+
+        self.assertEqual(self.forward.neighbours(1).tolist(), [2, 3])
+        self.assertEqual(self.forward.neighbours(4).tolist(), [1])
+        self.assertEqual(self.forward.degree(3), 0)
+        self.assertEqual(self.forward.degree(99), 0)
+        self.assertTrue(self.forward.contains(2, 3))
+        self.assertFalse(self.forward.contains(3, 2))
+        self.assertFalse(self.forward.contains(99, 1))
+
+    def test_overlay(self):
+        """
+        Test that added and removed edges are reflected without touching the arrays.
+        """
+
+        overlay = Overlay(self.forward)
+        overlay.add(1, 4)
+        overlay.add(1, 2)
+        overlay.remove(1, 3)
+        overlay.add(7, 1)
+
+        self.assertEqual(overlay.neighbours(1), [2, 4])
+        self.assertEqual(overlay.degree(1), 2)
+        self.assertFalse(overlay.contains(1, 3))
+        self.assertTrue(overlay.contains(7, 1))
+        self.assertEqual(self.forward.neighbours(1).tolist(), [2, 3])
+
+        overlay.add(1, 3)
+        overlay.remove(1, 4)
+        self.assertEqual(overlay.neighbours(1), [2, 3])
+        self.assertEqual(overlay.degree(1), 2)
+
+
+class FollowGraphTestCase(TestCase):
+    """
+    Test the index against the follows table, and the views that use it.
+    """
+
+    def setUp(self):
+        """
+        Add three users: user0 follows user1 and user2; user1 follows user2.
+        """
+
+        with app.app_context():
+            User.query.delete()
+
+            users = [User(email=f"user{i}@test.com", username=f"user{i}", password="HASHED")
+                     for i in range(3)]
+            db.session.add_all(users)
+            db.session.flush()
+
+            self.ids = [user.id for user in users]
+            db.session.add_all(Follow(user_following_id=self.ids[a],
+                                      user_being_followed_id=self.ids[b])
+                               for (a, b) in ((0, 1), (0, 2), (1, 2)))
+            db.session.commit()
+
+            follow_graph.load()
+
+        app.config['FOLLOW_GRAPH_ENABLED'] = True
+        self.client = app.test_client()
+        return super().setUp()
+
+    def tearDown(self):
+        app.config['FOLLOW_GRAPH_ENABLED'] = False
+        follow_graph.wait()
+        return super().tearDown()
+
+    def test_rebuild_in_background(self):
+        """
+        Test that a stale index keeps answering from the old arrays while it is rebuilt in the
+        background.
+        """
+
+        (user0, user1, user2) = self.ids
+
+        with app.app_context():
+            db.session.add(Follow(user_following_id=user2, user_being_followed_id=user0))
+            db.session.commit()
+
+            follow_graph.expire()
+            self.assertEqual(follow_graph.following_ids(user2), [])
+
+            follow_graph.wait()
+            self.assertEqual(follow_graph.following_ids(user2), [user0])
+
+    def test_load(self):
+        """
+        Test that the index matches the follows table.
+        """
+
+        (user0, user1, user2) = self.ids
+
+        with app.app_context():
+            self.assertEqual(follow_graph.following_ids(user0), [user1, user2])
+            self.assertEqual(follow_graph.follower_ids(user2), [user0, user1])
+            self.assertEqual(follow_graph.follower_count(user0), 0)
+            self.assertTrue(follow_graph.is_following(user1, user2))
+            self.assertFalse(follow_graph.is_following(user2, user1))
+
+            user = db.session.get(User, user2)
+            self.assertTrue(user.is_followed_by(db.session.get(User, user0)))
+            self.assertEqual(user.counts["followers"], 2)
+            self.assertEqual(user.counts["following"], 0)
+
+    def test_follow_views_patch_index(self):
+        """
+        Test that following and unfollowing through the views updates the index in place.
+        """
+
+        (user0, user1, user2) = self.ids
+
+        with app.app_context():
+            follow_graph.following_ids(user2)
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user2
+
+                c.post(f"/users/follow/{user0}")
+                self.assertEqual(follow_graph.following_ids(user2), [user0])
+                self.assertEqual(follow_graph.follower_count(user0), 1)
+
+                resp = c.get(f"/users/{user2}/followers")
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(f'action="/users/stop_following/{user0}"', html)
+                self.assertIn(f'action="/users/follow/{user1}"', html)
+
+                c.post(f"/users/stop_following/{user0}")
+                self.assertEqual(follow_graph.following_ids(user2), [])
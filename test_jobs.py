@@ -0,0 +1,188 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Background job queue tests for Warbler.
+"""
+
+import threading
+from datetime import timedelta
+from unittest import TestCase
+
+from app import app
+from models import db, connect_db, Job
+from jobs import JobQueue
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class JobQueueTestCase(TestCase):
+    """
+    Test job queue backends, retries, idempotency and metrics.
+    """
+
+    def setUp(self):
+        """
+        Create a job queue with a task that fails a given number of times before succeeding.
+        """
+
+        with app.app_context():
+            Job.query.delete()
+            db.session.commit()
+
+        self.queue = JobQueue(app)
+        self.calls = []
+        self.done = threading.Event()
+
+        @self.queue.task("flaky", max_attempts=3, retry_delay=0)
+        def flaky(value, failures=0):
+            self.calls.append(value)
+
+            if len(self.calls) <= failures:
+                raise RuntimeError("try again")
+
+            self.done.set()
+
+        return super().setUp()
+
+    def tearDown(self):
+        """
+        Stop any worker threads.
+        """
+
+        self.queue.shutdown()
+        return super().tearDown()
+
+    def test_inline_retries(self):
+        """
+        Test that a failing job is retried until it succeeds, and that metrics are recorded.
+        """
+
+        self.queue._backend = self.queue.make_backend("inline")
+
+        self.assertTrue(self.queue.enqueue("flaky", value="a", failures=2))
+        self.assertEqual(self.calls, ["a", "a", "a"])
+
+        self.assertEqual(self.queue.metrics["flaky.enqueued"], 1)
+        self.assertEqual(self.queue.metrics["flaky.retried"], 2)
+        self.assertEqual(self.queue.metrics["flaky.succeeded"], 1)
+        self.assertEqual(self.queue.metrics["failed"], 0)
+
+    def test_inline_gives_up(self):
+        """
+        Test that a job is attempted at most `max_attempts` times.
+        """
+
+        self.queue._backend = self.queue.make_backend("inline")
+
+        self.queue.enqueue("flaky", value="b", failures=10)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.queue.metrics["flaky.failed"], 1)
+
+    def test_idempotency_key(self):
+        """
+        Test that a job with an already-used idempotency key is not queued again.
+        """
+
+        self.queue._backend = self.queue.make_backend("inline")
+
+        self.assertTrue(self.queue.enqueue("flaky", idempotency_key="k", value="c"))
+        self.assertFalse(self.queue.enqueue("flaky", idempotency_key="k", value="c"))
+        self.assertEqual(self.calls, ["c"])
+        self.assertEqual(self.queue.metrics["deduplicated"], 1)
+
+    def test_unknown_task(self):
+        """
+        Test that enqueueing an unregistered task is an error.
+        """
+
+        self.assertRaises(KeyError, self.queue.enqueue, "nonexistent")
+
+    def test_thread_backend(self):
+        """
+        Test that the thread backend runs (and retries) jobs off the calling thread.
+        """
+
+        self.queue._backend = self.queue.make_backend("thread", workers=2)
+
+        self.queue.enqueue("flaky", value="d", failures=1)
+        self.assertTrue(self.done.wait(timeout=5))
+        self.assertEqual(self.calls, ["d", "d"])
+
+    def test_database_backend(self):
+        """
+        Test that the database backend persists jobs, deduplicates them, and records retries and
+        completion on the job row.
+        """
+
+        backend = self.queue.make_backend("database", workers=0)
+        self.queue._backend = backend
+
+        with app.app_context():
+            self.assertTrue(self.queue.enqueue("flaky", idempotency_key="e", value="e",
+                                               failures=1))
+            self.assertFalse(self.queue.enqueue("flaky", idempotency_key="e", value="e",
+                                                failures=1))
+
+            job = Job.query.one()
+            self.assertEqual((job.status, job.attempts), ("queued", 0))
+            self.assertEqual(job.payload, {"value": "e", "failures": 1})
+
+            # First attempt fails and is requeued
+            self.assertTrue(backend.work_once())
+            db.session.refresh(job)
+            self.assertEqual((job.status, job.attempts), ("queued", 1))
+            self.assertIn("try again", job.last_error)
+
+            # Second attempt succeeds; then the queue is empty
+            self.assertTrue(backend.work_once())
+            db.session.refresh(job)
+            self.assertEqual((job.status, job.attempts), ("done", 2))
+
+            self.assertFalse(backend.work_once())
+            self.assertEqual(self.calls, ["e", "e"])
+
+    def test_database_backend_reclaims(self):
+        """
+        Test that a job left running by a dead worker is run again once its lease runs out, and
+        failed once it has used up its attempts.
+        """
+
+        backend = self.queue.make_backend("database", workers=0)
+        self.queue._backend = backend
+        expired = db.func.now() - timedelta(seconds=1)
+
+        with app.app_context():
+            self.queue.enqueue("flaky", idempotency_key="r", value="r")
+            job = Job.query.one()
+
+            # A worker claimed it and died
+            job.status = "running"
+            job.attempts = 1
+            job.locked_until = db.func.now() + timedelta(minutes=5)
+            db.session.commit()
+            self.assertFalse(backend.work_once())
+
+            job.locked_until = expired
+            db.session.commit()
+            self.assertTrue(backend.work_once())
+            db.session.refresh(job)
+            self.assertEqual((job.status, job.attempts, job.locked_until), ("done", 2, None))
+            self.assertEqual(self.queue.metrics["flaky.reclaimed"], 1)
+
+            job.status = "running"
+            job.attempts = 3
+            job.locked_until = expired
+            db.session.commit()
+            self.assertTrue(backend.work_once())
+            db.session.refresh(job)
+            self.assertEqual((job.status, job.attempts), ("failed", 3))
+            self.assertEqual(self.calls, ["r"])
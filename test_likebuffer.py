@@ -0,0 +1,208 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Write-behind likes tests.
+"""
+
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+import likebuffer
+from archive import archive_messages
+from app import app, like_buffer, trending, CURR_USER_KEY
+from models import db, connect_db, User, Message, Like
+from testing import FakeClock
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_BACKEND'] = 'inline'
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class LikeBufferTestCase(TestCase):
+    """
+    Test buffering, coalescing and flushing of likes, and the pages that overlay pending ones.
+    """
+
+    def setUp(self):
+        """
+        Add an author with three messages, and a reader.
+        """
+
+        with app.app_context():
+            User.query.delete()
+
+            author = User(email="author@test.com", username="author", password="HASHED")
+            reader = User(email="reader@test.com", username="reader", password="HASHED")
+            db.session.add_all([author, reader])
+            db.session.flush()
+
+            messages = [Message(text=f"Warble {i}", user_id=author.id) for i in range(3)]
+            db.session.add_all(messages)
+            db.session.commit()
+
+            self.reader_id = reader.id
+            self.message_ids = [msg.id for msg in messages]
+
+        app.config['LIKE_BUFFER_ENABLED'] = True
+        like_buffer.interval = 60 * 60
+        trending.clear()
+        self.client = app.test_client()
+        return super().setUp()
+
+    def tearDown(self):
+        app.config['LIKE_BUFFER_ENABLED'] = False
+        like_buffer.clock = time.monotonic
+
+        with app.app_context():
+            like_buffer.flush()
+
+        return super().tearDown()
+
+    def liked_ids(self):
+        return set(db.session.scalars(db.select(Like.message_id)
+                                      .where(Like.user_id == self.reader_id)))
+
+    def test_coalesce_and_flush(self):
+        """
+        Test that toggles are coalesced per message, and written in one flush.
+        """
+
+        (msg0, msg1, msg2) = self.message_ids
+
+        with app.app_context():
+            db.session.add(Like(user_id=self.reader_id, message_id=msg2))
+            db.session.commit()
+
+            like_buffer.like(self.reader_id, msg0)
+            like_buffer.unlike(self.reader_id, msg0)
+            like_buffer.like(self.reader_id, msg0)
+            like_buffer.like(self.reader_id, msg1)
+            like_buffer.unlike(self.reader_id, msg1)
+            like_buffer.unlike(self.reader_id, msg2)
+
+            self.assertEqual(self.liked_ids(), {msg2})
+            self.assertEqual(like_buffer.overlay(self.reader_id, {msg2}), {msg0})
+
+            # msg1's like never reaches the table, so only two rows change
+            self.assertEqual(like_buffer.flush(), (1, 1))
+            self.assertEqual(self.liked_ids(), {msg0})
+            self.assertEqual(like_buffer.pending_for(self.reader_id), {})
+            self.assertEqual(like_buffer.flush(), (0, 0))
+
+    def test_deleted_message(self):
+        """
+        Test that a pending like of a message deleted before the flush is dropped.
+        """
+
+        (msg0, msg1, _) = self.message_ids
+
+        with app.app_context():
+            like_buffer.like(self.reader_id, msg0)
+            like_buffer.like(self.reader_id, msg1)
+
+            db.session.execute(db.delete(Message).where(Message.id == msg0))
+            db.session.commit()
+
+            self.assertEqual(like_buffer.flush(), (1, 0))
+            self.assertEqual(self.liked_ids(), {msg1})
+
+    def test_counts(self):
+        """
+        Test that a user's like count includes archived likes and their pending likes and unlikes.
+        """
+
+        (msg0, msg1, msg2) = self.message_ids
+
+        with app.app_context():
+            db.session.get(Message, msg2).timestamp = datetime(2020, 1, 1)
+            db.session.add(Like(user_id=self.reader_id, message_id=msg2))
+            db.session.add(Like(user_id=self.reader_id, message_id=msg1))
+            db.session.commit()
+            archive_messages(datetime(2021, 1, 1))
+
+            reader = db.session.get(User, self.reader_id)
+            self.assertEqual(reader.counts["likes"], 2)
+
+            # Liking what is already liked (here, archived) changes nothing
+            like_buffer.like(self.reader_id, msg2)
+            like_buffer.like(self.reader_id, msg0)
+            self.assertEqual(reader.counts["likes"], 3)
+
+            like_buffer.unlike(self.reader_id, msg1)
+            self.assertEqual(reader.counts["likes"], 2)
+
+            like_buffer.flush()
+            self.assertEqual(reader.counts["likes"], 2)
+
+    def test_views_read_own_writes(self):
+        """
+        Test that liking through the views is acknowledged without a write, shows up on the
+        user's own pages right away, and counts towards trending once flushed.
+        """
+
+        (msg0, msg1, _) = self.message_ids
+
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.reader_id
+
+                c.post(f"/users/add_like/{msg0}")
+                c.post(f"/users/add_like/{msg1}")
+                c.post(f"/users/remove_like/{msg1}")
+                resp = c.get(f"/users/{self.reader_id}/likes")
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("Warble 0", html)
+                self.assertNotIn("Warble 1", html)
+                self.assertEqual(self.liked_ids(), set())
+
+                resp = c.post("/users/add_like/999999")
+                self.assertEqual(resp.status_code, 404)
+
+            like_buffer.flush()
+            self.assertEqual(self.liked_ids(), {msg0})
+            self.assertEqual([msg_id for (msg_id, _) in trending.top()], [msg0])
+
+    def test_visible_while_flushing(self):
+        """
+        Test that events being flushed are still overlaid until the flush commits, and that likes
+        are dated on the database clock, as long ago as they happened.
+        """
+
+        (msg0, _, _) = self.message_ids
+        like_buffer.clock = FakeClock(1000.0)
+        insert_likes = likebuffer.insert_likes
+        seen = []
+
+        def insert_and_look(rows):
+            seen.append(like_buffer.overlay(self.reader_id, set()))
+            return insert_likes(rows)
+
+        with app.app_context():
+            like_buffer.like(self.reader_id, msg0)
+            like_buffer.clock.now += 60
+
+            with patch("likebuffer.insert_likes", insert_and_look):
+                like_buffer.flush()
+
+            self.assertEqual(seen, [{msg0}])
+            self.assertEqual(like_buffer.pending_for(self.reader_id), {})
+
+            db_now = db.session.scalar(db.select(db.func.localtimestamp()))
+            liked_at = db.session.scalar(db.select(Like.liked_at)
+                                         .where(Like.user_id == self.reader_id))
+            self.assertAlmostEqual((db_now - liked_at) / timedelta(seconds=1), 60, delta=5)
@@ -0,0 +1,138 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Maintenance command tests.
+"""
+
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from app import app
+from models import db, connect_db, User, Message, Follow, Like, MessageTag, Checkpoint
+import maintenance
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class MaintenanceTestCase(TestCase):
+    """
+    Test resumable batches, recomputing derived data, orphan checks and benchmark data.
+    """
+
+    def setUp(self):
+        """
+        Start from empty tables and no checkpoints.
+        """
+
+        with app.app_context():
+            User.query.delete()
+            Message.query.delete()
+            Checkpoint.query.delete()
+            db.session.commit()
+
+        return super().setUp()
+
+    def tearDown(self):
+        """
+        Clean up any fouled transaction.
+        """
+
+        with app.app_context():
+            db.session.rollback()
+
+        return super().tearDown()
+
+    def test_run_in_batches_resumes(self):
+        """
+        Test that an interrupted run resumes after its last completed batch.
+        """
+
+        with app.app_context():
+            maintenance.generate_data(users=7, messages_per_user=0, follows_per_user=0,
+                                      likes_per_user=0)
+            seen = []
+
+            def process(ids):
+                if len(seen) == 4:
+                    raise RuntimeError("Interrupted")
+
+                seen.extend(ids)
+
+            with self.assertRaises(RuntimeError):
+                maintenance.run_in_batches("test", User.id, process, batch_size=2)
+
+            db.session.rollback()
+            self.assertEqual(maintenance.get_checkpoint("test"), seen[-1])
+
+            lines = []
+            done = maintenance.run_in_batches("test", User.id, seen.extend, batch_size=2,
+                                              progress=lines.append)
+
+            self.assertEqual(done, 3)
+            self.assertEqual(seen, sorted(set(seen)))
+            self.assertEqual(len(seen), 7)
+            self.assertEqual(lines[-1], "test: 3/3")
+            self.assertEqual(maintenance.get_checkpoint("test"), 0)
+
+    def test_generate_data_and_recompute_tags(self):
+        """
+        Test that benchmark data is generated in batches, and tag indexes can be rebuilt.
+        """
+
+        with app.app_context():
+            lines = []
+            added = maintenance.generate_data(users=5, messages_per_user=3, follows_per_user=2,
+                                              likes_per_user=2, batch_size=2,
+                                              progress=lines.append)
+
+            self.assertEqual(added, 5)
+            self.assertEqual(lines, ["generate-data: 2/5 users",
+                                     "generate-data: 4/5 users",
+                                     "generate-data: 5/5 users"])
+            self.assertEqual(User.query.filter(User.username.like("bench%")).count(), 5)
+            self.assertEqual(Message.query.count(), 15)
+            self.assertEqual(MessageTag.query.count(), 15)
+            self.assertGreater(Follow.query.count(), 0)
+
+            # Running again adds nothing; the checkpoint was cleared, so --restart isn't needed
+            self.assertEqual(maintenance.get_checkpoint("generate-data"), 0)
+
+            MessageTag.query.delete()
+            db.session.commit()
+
+            self.assertEqual(maintenance.recompute("tags", batch_size=4), 15)
+            self.assertEqual(MessageTag.query.count(), 15)
+
+    def test_check_orphans(self):
+        """
+        Test that likes of missing messages are found once their foreign key is gone.
+        """
+
+        with app.app_context():
+            maintenance.generate_data(users=2, messages_per_user=1, follows_per_user=0,
+                                      likes_per_user=0)
+            self.assertEqual(set(maintenance.check_orphans().values()), {0})
+
+            user = User.query.first()
+
+            # check_orphans rolls back when it is done, undoing all of this
+            db.session.execute(text("ALTER TABLE likes DROP CONSTRAINT likes_message_id_fkey"))
+            db.session.add(Like(user_id=user.id, message_id=-1))
+            db.session.flush()
+
+            found = maintenance.check_orphans()
+            self.assertEqual(found["likes"], 1)
+            self.assertEqual(found["follows"], 0)
+
+            self.assertEqual(Like.query.count(), 0)
@@ -9,7 +9,8 @@ from unittest import TestCase
 from datetime import datetime
 
 from app import app
-from models import db, connect_db, User, Message, Follow
+from models import db, connect_db, User, Message, Follow, Like
+from tags import extract_tags, extract_mentions, linkify
 
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
 app.config['SQLALCHEMY_ECHO'] = False
@@ -122,3 +123,50 @@ class MessageModelTestCase(TestCase):
         with app.app_context():
             msg0 = db.session.get(Message, self.msg0_id)
             self.assertEqual(repr(msg0), f"<Message #{self.msg0_id}: User #{msg0.user.id}>")
+
+    def test_likes_by_many_users(self):
+        """
+        Test that one message can be liked by several users, and that each like is timestamped.
+        """
+
+        with app.app_context():
+            users = [User(email=f"liker{i}@test.com", username=f"liker{i}", password="HASHED")
+                     for i in range(2)]
+            db.session.add_all(users)
+            db.session.commit()
+
+            msg0 = db.session.get(Message, self.msg0_id)
+
+            for user in users:
+                user.likes.append(msg0)
+
+            db.session.commit()
+
+            likes = Like.query.filter_by(message_id=self.msg0_id).all()
+            self.assertEqual({like.user_id for like in likes}, {user.id for user in users})
+
+            for like in likes:
+                self.assertIsInstance(like.liked_at, datetime)
+
+    def test_extract_tags_and_mentions(self):
+        """
+        Test parsing of #hashtags and @mentions out of message text.
+        """
+
+        text = "Loving #Flask and #python3 with @testuser, @other. Not a#tag, not ##tag, a@b.com"
+
+        self.assertEqual(extract_tags(text), ["flask", "python3"])
+        self.assertEqual(extract_mentions(text), ["other", "testuser"])
+        self.assertEqual(extract_tags("no tags here"), [])
+
+    def test_linkify(self):
+        """
+        Test that linkify escapes message text and links tags and mentions.
+        """
+
+        with app.test_request_context():
+            html = linkify("<b>It's</b> #Fun, @testuser")
+
+        self.assertIn("&lt;b&gt;It&#39;s&lt;/b&gt;", html)
+        self.assertIn('<a href="/tags/fun">#Fun</a>', html)
+        self.assertIn('<a href="/users?q=testuser">@testuser</a>', html)
@@ -5,11 +5,17 @@
 Message view tests.
 """
 
+import re
+import threading
+from datetime import datetime, timedelta
 from unittest import TestCase
+from html import unescape
 from sqlalchemy import select
 
-from app import app, CURR_USER_KEY
-from models import db, connect_db, User, Message
+from app import app, CURR_USER_KEY, trending, broker, recent_cache, page_cache
+from models import (db, connect_db, User, Message, ArchivedMessage, ArchivedLike, Like, Follow,
+                    MessageTag, Mention)
+from archive import archive_messages
 
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
 app.config['SQLALCHEMY_ECHO'] = False
@@ -116,6 +122,28 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(msg.text, "Hello")
             self.assertEqual(msg.user.id, self.user_id)
 
+    def test_add_message_publishes(self):
+        """
+        For logged-in users:
+
+        Test that adding a message notifies subscribers to the author's topic.
+        """
+
+        subscription = broker.subscribe([self.user_id])
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                c.post("/messages/new", data={"text": "Hello"})
+
+                msg = db.session.scalars(select(Message)).one()
+                self.assertEqual(subscription.get(timeout=1), msg.id)
+
+        finally:
+            broker.unsubscribe(subscription)
+
     # ---------------------------------------------------------------------------------------------
 
     # TESTS FOR SHOWING MESSAGES ------------------------------------------------------------------
@@ -195,6 +223,60 @@ class MessageViewTestCase(TestCase):
                 self.assertIn('class="single-message"', html)
                 self.assertIn(msg1.text, html)
 
+    def test_view_deactivated_author(self):
+        """
+        Test that a message by a deactivated (deleted, but not yet purged) user is not shown, even
+        if an anonymous copy of the page was cached before the user was deactivated.
+        """
+
+        with app.app_context():
+            msg = Message(text="Soon gone", user_id=self.user_id)
+            db.session.add(msg)
+            db.session.commit()
+
+            with self.client as c:
+                self.assertEqual(c.get(f"/messages/{msg.id}").status_code, 200)
+
+                user = db.session.get(User, self.user_id)
+                user.is_active = False
+                db.session.commit()
+                page_cache.invalidate(f"user:{self.user_id}")
+
+                self.assertEqual(c.get(f"/messages/{msg.id}").status_code, 404)
+
+    def test_view_trending(self):
+        """
+        Test that liked messages show up on the trending page, and unliked ones drop out.
+        """
+
+        with app.app_context():
+            fan = User(email="fan@test.com", username="fan", password="HASHED")
+
+            msg0 = Message(text="Liked then unliked", user_id=self.user_id)
+            msg1 = Message(text="Still liked", user_id=self.user_id)
+            msg2 = Message(text="Never liked", user_id=self.user_id)
+
+            db.session.add_all([fan, msg0, msg1, msg2])
+            db.session.commit()
+
+            trending.clear()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = fan.id
+
+                c.post(f"/users/add_like/{msg0.id}")
+                c.post(f"/users/add_like/{msg1.id}")
+                c.post(f"/users/remove_like/{msg0.id}")
+
+                resp = c.get("/messages/trending")
+                html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Still liked", html)
+            self.assertNotIn("Liked then unliked", html)
+            self.assertNotIn("Never liked", html)
+
     # ---------------------------------------------------------------------------------------------
 
     # TESTS FOR DELETING MESSAGES -----------------------------------------------------------------
@@ -261,6 +343,142 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(len(msgs), init_num_msgs - 1)
             self.assertNotIn(msg0, msgs)
 
+    def test_archived_messages(self):
+        """
+        Test that old messages move to the archive with their like counts, and can still be
+        viewed, listed on the profile and deleted.
+        """
+
+        with app.app_context():
+            old = Message(text="Old warble", user_id=self.user_id, timestamp=datetime(2020, 1, 1))
+            new = Message(text="New warble", user_id=self.user_id)
+            db.session.add_all([old, new])
+            db.session.flush()
+
+            db.session.add(Like(user_id=self.user_id, message_id=old.id))
+            db.session.commit()
+            (old_id, new_id) = (old.id, new.id)
+
+            self.assertEqual(archive_messages(datetime(2021, 1, 1), batch_size=1), 1)
+
+            self.assertIsNone(db.session.get(Message, old_id))
+            self.assertIsNotNone(db.session.get(Message, new_id))
+            self.assertEqual(db.session.get(ArchivedMessage, old_id).like_count, 1)
+            self.assertEqual(Like.query.count(), 0)
+            self.assertEqual(ArchivedLike.query.one().message_id, old_id)
+
+            with self.client as c:
+                resp = c.get(f"/messages/{old_id}")
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("Old warble", html)
+                self.assertIn("Archived", html)
+
+                html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+                self.assertLess(html.index("New warble"), html.index("Old warble"))
+
+                self.assertEqual(c.get(f"/messages/{old_id + new_id}").status_code, 404)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                html = c.get(f"/users/{self.user_id}/likes").get_data(as_text=True)
+                self.assertIn("Old warble", html)
+                self.assertIn('"type": "like"', c.get("/users/export").get_data(as_text=True))
+
+                resp = c.post(f"/messages/{old_id}/delete")
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(ArchivedMessage.query.count(), 0)
+
+    def test_import_messages(self):
+        """
+        Test that a batch of messages is imported with its timestamps, tags and mentions, and
+        that an invalid batch is rejected as a whole.
+        """
+
+        with app.app_context():
+            with self.client as c:
+                resp = c.post("/api/messages/import", json={"messages": []})
+                self.assertEqual(resp.status_code, 401)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                resp = c.post("/api/messages/import", json={"messages": [
+                    {"text": "Fine"},
+                    {"text": "x" * 141},
+                    {"text": "Bad time", "timestamp": "yesterday"},
+                    {"text": "   "},
+                    {"text": "From the future", "timestamp": "2099-01-01T00:00:00"},
+                    {"text": "Slightly ahead", "timestamp": (datetime.utcnow() +
+                                                             timedelta(minutes=1)).isoformat()},
+                ]})
+                self.assertEqual(resp.status_code, 400)
+                self.assertEqual([error["index"] for error in resp.json["errors"]], [1, 2, 3, 4])
+                self.assertEqual(resp.json["errors"][3]["error"], "Timestamp is in the future.")
+                self.assertEqual(Message.query.count(), 0)
+
+                resp = c.post("/api/messages/import", json={"messages": [
+                    {"text": "Hello from 2019 #throwback @testuser",
+                     "timestamp": "2019-05-06T07:08:09"},
+                    {"text": "Also old", "timestamp": "2019-05-06T09:08:09+02:00"},
+                    {"text": "Undated"},
+                ]})
+                self.assertEqual(resp.status_code, 201)
+                self.assertEqual(resp.json, {"imported": 3})
+
+                self.assertEqual(c.post("/api/messages/import", json={"text": "Hi"}).status_code,
+                                 400)
+
+            msgs = {msg.text: msg for msg in Message.query.all()}
+            self.assertEqual(msgs["Hello from 2019 #throwback @testuser"].timestamp,
+                             datetime(2019, 5, 6, 7, 8, 9))
+            self.assertEqual(msgs["Also old"].timestamp, datetime(2019, 5, 6, 7, 8, 9))
+            self.assertGreater(msgs["Undated"].timestamp, datetime(2020, 1, 1))
+
+            msg_id = msgs["Hello from 2019 #throwback @testuser"].id
+            self.assertEqual(db.session.scalars(select(MessageTag.message_id)
+                                                .where(MessageTag.tag == "throwback")).all(),
+                             [msg_id])
+            self.assertEqual(db.session.scalars(select(Mention.message_id)
+                                                .where(Mention.user_id == self.user_id)).all(),
+                             [msg_id])
+
+    def test_profile_uses_recent_cache(self):
+        """
+        Test that profile views are served from the recent-messages cache, which follows new and
+        deleted messages.
+        """
+
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                c.post("/messages/new", data={"text": "First"})
+                hits = recent_cache.metrics["hits"]
+
+                c.get(f"/users/{self.user_id}")
+                self.assertIn("First", c.get(f"/users/{self.user_id}").get_data(as_text=True))
+                self.assertEqual(recent_cache.metrics["hits"], hits + 1)
+
+                c.post("/messages/new", data={"text": "Second"})
+                html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+                self.assertLess(html.index("Second"), html.index("First"))
+                self.assertEqual(recent_cache.metrics["hits"], hits + 2)
+
+                msg = Message.query.filter_by(text="Second").one()
+                c.post(f"/messages/{msg.id}/delete")
+                self.assertIsNone(recent_cache.get(self.user_id))
+
+                # A message deleted behind the cache's back is noticed on the next read
+                c.get(f"/users/{self.user_id}")
+                Message.query.filter_by(text="First").delete()
+                db.session.commit()
+                self.assertNotIn("First", c.get(f"/users/{self.user_id}").get_data(as_text=True))
+
     def test_delete_other_message(self):
         """
         For logged-in users:
@@ -302,3 +520,220 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(Message.query.count(), init_num_msgs)
 
     # ---------------------------------------------------------------------------------------------
+
+    # TESTS FOR TAG AND MENTION FEEDS ------------------------------------------------------------
+
+    def test_add_message_indexes_tags_and_mentions(self):
+        """
+        For logged-in users:
+
+        Test that posting a message indexes its hashtags and the users it mentions.
+        """
+
+        with app.app_context():
+            other = User(email="other@test.com", username="other", password="HASHED")
+            db.session.add(other)
+            db.session.commit()
+            other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "Hi @other and @nobody #Tag1 #tag2 #tag1"})
+
+            msg = db.session.scalars(select(Message)).one()
+            tags = db.session.scalars(select(MessageTag.tag)
+                                      .where(MessageTag.message_id == msg.id)).all()
+            mentions = db.session.scalars(select(Mention.user_id)
+                                          .where(Mention.message_id == msg.id)).all()
+
+        self.assertEqual(sorted(tags), ["tag1", "tag2"])
+        self.assertEqual(mentions, [other_id])
+
+    def test_tag_feed(self):
+        """
+        Test that a tag's feed lists only messages with that tag, newest first (by timestamp, so
+        imported messages go by when they were written), a page at a time.
+        """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            for text in ["First #news", "Second #NEWS", "Unrelated #sports", "Third #news"]:
+                c.post("/messages/new", data={"text": text})
+
+            c.post("/api/messages/import", json={"messages": [
+                {"text": "Imported #news", "timestamp": "2019-05-06T07:08:09"},
+            ]})
+
+            app.config['FEED_PER_PAGE'] = 2
+
+            try:
+                html = c.get("/tags/News").get_data(as_text=True)
+
+                self.assertIn("<h1 class=\"display-6\">#news</h1>", html)
+                self.assertLess(html.index("Third"), html.index("Second"))
+                self.assertNotIn("First", html)
+                self.assertNotIn("Unrelated", html)
+
+                next_url = re.search(r'href="([^"]*before=[^"]*)"', html).group(1)
+                html = c.get(unescape(next_url)).get_data(as_text=True)
+
+                self.assertLess(html.index("First"), html.index("Imported"))
+                self.assertNotIn("Second", html)
+                self.assertNotIn("Older warbles", html)
+
+                self.assertEqual(c.get("/tags/news?before=junk").status_code, 400)
+
+            finally:
+                app.config['FEED_PER_PAGE'] = 50
+
+    def test_mentions_feed(self):
+        """
+        Test that the mentions feed requires login and lists messages mentioning the user.
+        """
+
+        with self.client as c:
+            resp = c.get("/users/mentions")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/")
+
+        with app.app_context():
+            other = User(email="other@test.com", username="other", password="HASHED")
+            db.session.add(other)
+            db.session.commit()
+            other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+
+            c.post("/messages/new", data={"text": "Hello @testuser"})
+            c.post("/messages/new", data={"text": "Hello nobody"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            html = c.get("/users/mentions").get_data(as_text=True)
+
+        self.assertIn("Hello <a href=\"/users?q=testuser\">@testuser</a>", html)
+        self.assertNotIn("Hello nobody", html)
+
+    # ---------------------------------------------------------------------------------------------
+
+    # TESTS FOR LIVE TIMELINE UPDATES -------------------------------------------------------------
+
+    def add_followed_user(self):
+        """
+        Add a user that the test user follows, and return their ID.
+        """
+
+        with app.app_context():
+            followed = User(email="followed@test.com", username="followed", password="HASHED")
+            db.session.add(followed)
+            db.session.commit()
+
+            db.session.add(Follow(user_being_followed_id=followed.id,
+                                  user_following_id=self.user_id))
+            db.session.commit()
+
+            return followed.id
+
+    def test_timeline_since_logged_out(self):
+        """
+        Test that logged-out users can't poll or stream timeline updates.
+        """
+
+        with self.client as c:
+            self.assertEqual(c.get("/api/timeline").status_code, 401)
+            self.assertEqual(c.get("/api/timeline/stream").status_code, 401)
+
+    def test_timeline_since(self):
+        """
+        For logged-in users:
+
+        Test that polling with since_id returns only newer messages from followed users (and the
+        user themselves), oldest first.
+        """
+
+        followed_id = self.add_followed_user()
+
+        with app.app_context():
+            stranger = User(email="stranger@test.com", username="stranger", password="HASHED")
+            db.session.add(stranger)
+            db.session.commit()
+
+            old = Message(text="Old message", user_id=followed_id)
+            db.session.add(old)
+            db.session.commit()
+
+            msgs = [Message(text="Followed message", user_id=followed_id),
+                    Message(text="Own message", user_id=self.user_id),
+                    Message(text="Stranger message", user_id=stranger.id)]
+
+            db.session.add_all(msgs)
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                resp = c.get("/api/timeline", query_string={"since_id": old.id})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([msg["id"] for msg in resp.json["messages"]],
+                             [msgs[0].id, msgs[1].id])
+            self.assertIn("Followed message", resp.json["messages"][0]["html"])
+            self.assertEqual(resp.json["last_id"], msgs[1].id)
+
+    def test_timeline_stream(self):
+        """
+        For logged-in users:
+
+        Test that the event stream first catches up from Last-Event-ID, then pushes messages as
+        they are posted by followed users.
+        """
+
+        followed_id = self.add_followed_user()
+
+        with app.app_context():
+            missed = Message(text="Missed message", user_id=followed_id)
+            db.session.add(missed)
+            db.session.commit()
+            missed_id = missed.id
+
+        def post_message():
+            with app.app_context():
+                msg = Message(text="Live message", user_id=followed_id)
+                db.session.add(msg)
+                db.session.commit()
+                broker.publish(followed_id, msg.id)
+
+        app.config['TIMELINE_STREAM_SECONDS'] = 1
+        app.config['TIMELINE_HEARTBEAT_SECONDS'] = 0.1
+        timer = threading.Timer(0.3, post_message)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                resp = c.get("/api/timeline/stream", headers={"Last-Event-ID": missed_id - 1},
+                             buffered=False)
+                timer.start()
+                body = resp.get_data(as_text=True)
+
+        finally:
+            timer.join()
+            app.config['TIMELINE_STREAM_SECONDS'] = 5 * 60
+            app.config['TIMELINE_HEARTBEAT_SECONDS'] = 15
+
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertIn(f"id: {missed_id}\n", body)
+        self.assertIn("Live message", body)
+        self.assertLess(body.index("Missed message"), body.index("Live message"))
+        self.assertIn(": keepalive", body)
+
+    # ---------------------------------------------------------------------------------------------
@@ -0,0 +1,167 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Anonymous page cache tests.
+"""
+
+import time
+from unittest import TestCase
+
+from app import app, page_cache, CURR_USER_KEY
+from models import db, connect_db, User, Message
+from testing import FakeClock
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_BACKEND'] = 'inline'
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class PageCacheTestCase(TestCase):
+    """
+    Test serving, revalidating and invalidating cached anonymous pages.
+    """
+
+    def setUp(self):
+        """
+        Add a user with one message, and give the cache a clock the tests can move.
+        """
+
+        with app.app_context():
+            User.query.delete()
+
+            user = User(email="user@test.com", username="testuser", password="HASHED")
+            db.session.add(user)
+            db.session.flush()
+
+            msg = Message(text="First warble", user_id=user.id)
+            db.session.add(msg)
+            db.session.commit()
+
+            self.user_id = user.id
+            self.msg_id = msg.id
+
+        self.clock = FakeClock(1000.0)
+        page_cache.clock = self.clock
+        page_cache.clear()
+        self.client = app.test_client()
+        return super().setUp()
+
+    def tearDown(self):
+        page_cache.wait()
+        page_cache.clear()
+        page_cache.clock = time.monotonic
+        return super().tearDown()
+
+    def set_bio(self, bio):
+        """
+        Change the user's bio behind the cache's back (as another process would).
+        """
+
+        with app.app_context():
+            db.session.get(User, self.user_id).bio = bio
+            db.session.commit()
+
+    def test_anonymous_hits(self):
+        """
+        Test that anonymous views are cached, and logged-in ones are not.
+        """
+
+        with self.client as c:
+            for expected in ("miss", "hit", "hit"):
+                resp = c.get(f"/users/{self.user_id}")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers["X-Cache"], expected)
+                self.assertIn("First warble", resp.get_data(as_text=True))
+
+            self.assertEqual(c.get("/").headers["X-Cache"], "miss")
+            self.assertEqual(c.get("/").headers["X-Cache"], "hit")
+            self.assertEqual(c.get(f"/users/{self.user_id}?x=1").headers.get("X-Cache"), None)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertNotIn("X-Cache", resp.headers)
+            self.assertIn("Edit Profile", resp.get_data(as_text=True))
+
+    def test_stale_while_revalidate(self):
+        """
+        Test that an expired page is served stale while it is rendered again in the background,
+        and rendered in the request once it is too old even for that.
+        """
+
+        path = f"/users/{self.user_id}"
+
+        with self.client as c:
+            c.get(path)
+            self.set_bio("Updated bio")
+
+            self.clock.now += app.config['PAGE_CACHE_TTL']
+            resp = c.get(path)
+            self.assertEqual(resp.headers["X-Cache"], "stale")
+            self.assertNotIn("Updated bio", resp.get_data(as_text=True))
+
+            page_cache.wait()
+            resp = c.get(path)
+            self.assertEqual(resp.headers["X-Cache"], "hit")
+            self.assertIn("Updated bio", resp.get_data(as_text=True))
+
+            self.clock.now += app.config['PAGE_CACHE_TTL'] + app.config['PAGE_CACHE_STALE_SECONDS']
+            self.assertEqual(c.get(path).headers["X-Cache"], "miss")
+
+    def test_invalidation(self):
+        """
+        Test that writes drop the pages showing what they changed.
+        """
+
+        with self.client as c:
+            c.get(f"/users/{self.user_id}")
+            c.get(f"/messages/{self.msg_id}")
+            self.assertEqual(c.get(f"/messages/{self.msg_id}").headers["X-Cache"], "hit")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "Second warble"})
+            c.post(f"/messages/{self.msg_id}/delete")
+
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+
+            resp = c.get(f"/users/{self.user_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.headers["X-Cache"], "miss")
+            self.assertIn("Second warble", html)
+            self.assertNotIn("First warble", html)
+            self.assertEqual(c.get(f"/messages/{self.msg_id}").status_code, 404)
+
+    def test_gone_page_dropped(self):
+        """
+        Test that a background refresh of a page that no longer exists drops it.
+        """
+
+        path = f"/messages/{self.msg_id}"
+
+        with self.client as c:
+            c.get(path)
+
+            with app.app_context():
+                db.session.execute(db.delete(Message).where(Message.id == self.msg_id))
+                db.session.commit()
+
+            self.clock.now += app.config['PAGE_CACHE_TTL']
+            self.assertEqual(c.get(path).headers["X-Cache"], "stale")
+
+            page_cache.wait()
+            self.assertEqual(c.get(path).status_code, 404)
@@ -0,0 +1,218 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Tests for monthly partitioning of the messages table.
+"""
+
+from datetime import date, datetime
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from app import app
+from models import db, connect_db, User, Message, Like
+from partitioning import (is_partitioned, partition_messages, create_partitions, month_partitions,
+                          add_months, ReferencesPartitionedMessages)
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class MonthPartitionsTestCase(TestCase):
+    """
+    Test partition naming and bounds.
+    """
+
+    def test_add_months(self):
+        """
+        Test stepping across year boundaries.
+        """
+
+        self.assertEqual(add_months(date(2023, 11, 15), 1), date(2023, 12, 1))
+        self.assertEqual(add_months(date(2023, 11, 15), 3), date(2024, 2, 1))
+        self.assertEqual(add_months(date(2023, 1, 31), 0), date(2023, 1, 1))
+
+    def test_month_partitions(self):
+        """
+        Test that partitions cover whole months, end date included.
+        """
+
+        self.assertEqual(month_partitions(date(2023, 12, 20), date(2024, 1, 1)), [
+            ("messages_y2023m12", date(2023, 12, 1), date(2024, 1, 1)),
+            ("messages_y2024m01", date(2024, 1, 1), date(2024, 2, 1)),
+        ])
+
+
+class PartitionMessagesTestCase(TestCase):
+    """
+    Test converting messages to a partitioned table.
+
+    Postgres DDL is transactional, so each test converts the table and then rolls it all back.
+    """
+
+    def setUp(self):
+        """
+        Add a user with messages in two different months, one of them liked.
+        """
+
+        with app.app_context():
+            User.query.delete()
+            Message.query.delete()
+
+            user = User.signup(username="testuser",
+                               email="test@test.com",
+                               password="testuser",
+                               image_url=None,
+                               location=None)
+            db.session.flush()
+
+            old = Message(text="Old warble", user_id=user.id, timestamp=datetime(2022, 3, 4))
+            new = Message(text="New warble", user_id=user.id)
+            db.session.add_all([old, new])
+            db.session.flush()
+
+            db.session.add(Like(user_id=user.id, message_id=old.id))
+            db.session.commit()
+
+            self.user_id = user.id
+            self.old_id = old.id
+            self.new_id = new.id
+
+        return super().setUp()
+
+    def tearDown(self):
+        """
+        Clean up any fouled transaction.
+        """
+
+        with app.app_context():
+            db.session.rollback()
+
+        return super().tearDown()
+
+    def test_partition_messages(self):
+        """
+        Test that rows survive the conversion, land in month partitions, and deletes still
+        cascade to likes.
+        """
+
+        with app.app_context():
+            self.assertFalse(is_partitioned())
+
+            try:
+                partition_messages(months_ahead=2)
+                self.assertTrue(is_partitioned())
+
+                self.assertEqual(
+                    db.session.scalar(text(
+                        "SELECT tableoid::regclass::text FROM messages WHERE id = :id"),
+                        {"id": self.old_id}),
+                    "messages_y2022m03")
+
+                # New messages keep getting IDs from the same sequence
+                msg = Message(text="Newest warble", user_id=self.user_id)
+                db.session.add(msg)
+                db.session.flush()
+                self.assertGreater(msg.id, self.new_id)
+
+                # Partitions through two months from now exist; running again creates none
+                today = date.today()
+                self.assertEqual(create_partitions(today, add_months(today, 2)), [])
+
+                db.session.execute(text("DELETE FROM messages WHERE id = :id"),
+                                   {"id": self.old_id})
+                self.assertEqual(db.session.scalar(
+                    text("SELECT count(*) FROM likes WHERE message_id = :id"),
+                    {"id": self.old_id}), 0)
+
+                with self.assertRaises(ValueError):
+                    partition_messages()
+
+            finally:
+                db.session.rollback()
+
+            self.assertFalse(is_partitioned())
+
+    def test_create_partitions_from_default(self):
+        """
+        Test that creating a month partition moves that month's rows out of the default
+        partition, keeping their likes.
+        """
+
+        with app.app_context():
+            try:
+                partition_messages(months_ahead=1)
+
+                msg = Message(text="Future warble", user_id=self.user_id,
+                              timestamp=datetime(2099, 5, 6))
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Like(user_id=self.user_id, message_id=msg.id))
+                db.session.flush()
+
+                self.assertEqual(create_partitions(date(2099, 4, 1), date(2099, 5, 1)),
+                                 ["messages_y2099m04", "messages_y2099m05"])
+
+                self.assertEqual(
+                    db.session.scalar(text(
+                        "SELECT tableoid::regclass::text FROM messages WHERE id = :id"),
+                        {"id": msg.id}),
+                    "messages_y2099m05")
+                self.assertEqual(db.session.scalar(
+                    text("SELECT count(*) FROM likes WHERE message_id = :id"),
+                    {"id": msg.id}), 1)
+                self.assertEqual(db.session.scalar(text(
+                    "SELECT count(*) FROM pg_inherits "
+                    "WHERE inhrelid = to_regclass('messages_default')")), 1)
+
+            finally:
+                db.session.rollback()
+
+    def test_new_reference_refused(self):
+        """
+        Test that creating a table referencing messages.id is refused once it is partitioned.
+        """
+
+        table = db.Table("message_notes", db.metadata,
+                         db.Column("message_id", db.Integer, db.ForeignKey("messages.id")))
+
+        with app.app_context():
+            try:
+                partition_messages(months_ahead=1)
+
+                with self.assertRaises(ReferencesPartitionedMessages):
+                    db.metadata.create_all(db.session.connection(), tables=[table])
+
+            finally:
+                db.session.rollback()
+                db.metadata.remove(table)
+
+            self.assertFalse(is_partitioned())
+
+    def test_timeline_prunes_partitions(self):
+        """
+        Test that a timeline query with a time bound skips older partitions.
+        """
+
+        with app.app_context():
+            try:
+                partition_messages(months_ahead=1)
+
+                plan = "\n".join(db.session.scalars(text(
+                    "EXPLAIN SELECT * FROM messages "
+                    "WHERE user_id = :user_id AND timestamp >= now() - interval '7 days' "
+                    "ORDER BY timestamp DESC LIMIT 100"), {"user_id": self.user_id}))
+
+                self.assertNotIn("messages_y2022m03", plan)
+
+            finally:
+                db.session.rollback()
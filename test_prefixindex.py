@@ -0,0 +1,132 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Username prefix index and autocomplete tests.
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import select
+
+from app import app, username_index, CURR_USER_KEY
+from models import db, connect_db, User
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_BACKEND'] = 'inline'
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class PrefixIndexTestCase(TestCase):
+    """
+    Test prefix searches and in-place updates.
+    """
+
+    def setUp(self):
+        """
+        Add a few users (one of them deleted), and have the index rebuilt.
+        """
+
+        with app.app_context():
+            User.query.delete()
+
+            users = [User(email=f"{name}@test.com", username=name, password="HASHED")
+                     for name in ("alice", "Albert", "alfred", "bob", "ally")]
+            users[-1].is_active = False
+            db.session.add_all(users)
+            db.session.commit()
+
+            self.ids = {user.username: user.id for user in users}
+
+            username_index.load()
+
+        self.client = app.test_client()
+        return super().setUp()
+
+    def tearDown(self):
+        username_index.wait()
+        return super().tearDown()
+
+    def test_search(self):
+        """
+        Test that matches ignore case, are alphabetical, skip deleted users and stop at the limit.
+        """
+
+        with app.app_context():
+            self.assertEqual([name for (_, name) in username_index.search("AL")],
+                             ["Albert", "alfred", "alice"])
+            self.assertEqual(username_index.search("al", limit=1),
+                             [(self.ids["Albert"], "Albert")])
+            self.assertEqual(username_index.search("z"), [])
+
+    def test_updates(self):
+        """
+        Test adding, removing and renaming users in place.
+        """
+
+        with app.app_context():
+            username_index.search("a")
+            username_index.add(99, "alan")
+            username_index.remove(self.ids["alice"], "alice")
+            username_index.rename(self.ids["bob"], "bob", "alberto")
+
+            self.assertEqual([name for (_, name) in username_index.search("al")],
+                             ["alan", "Albert", "alberto", "alfred"])
+
+    def test_rebuild(self):
+        """
+        Test that a stale index is rebuilt in the background while searches use the old list, and
+        that changes made during a rebuild survive it.
+        """
+
+        with app.app_context():
+            db.session.add(User(email="alma@test.com", username="alma", password="HASHED"))
+            db.session.commit()
+
+            username_index.expire()
+            self.assertNotIn("alma", [name for (_, name) in username_index.search("al")])
+
+            username_index.wait()
+            self.assertIn("alma", [name for (_, name) in username_index.search("al")])
+
+            def select_during_build(*columns):
+                username_index.add(99, "alan")
+                username_index.remove(self.ids["alice"], "alice")
+                return select(*columns)
+
+            with patch("prefixindex.select", select_during_build):
+                username_index.load()
+
+            self.assertEqual([name for (_, name) in username_index.search("al")],
+                             ["alan", "Albert", "alfred", "alma"])
+
+    def test_autocomplete_view(self):
+        """
+        Test the endpoint, and that renames and deletions through the views show up right away.
+        """
+
+        with self.client as c:
+            resp = c.get("/api/users/autocomplete", query_string={"q": "ali"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json,
+                             {"users": [{"id": self.ids["alice"], "username": "alice"}]})
+            self.assertEqual(c.get("/api/users/autocomplete").json, {"users": []})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids["bob"]
+
+            c.post("/users/delete")
+
+            resp = c.get("/api/users/autocomplete", query_string={"q": "b"})
+            self.assertEqual(resp.json, {"users": []})
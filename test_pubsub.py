@@ -0,0 +1,52 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Publish/subscribe broker tests for Warbler.
+"""
+
+from unittest import TestCase
+
+from pubsub import Broker
+
+
+class BrokerTestCase(TestCase):
+    """
+    Test routing of events to subscribers.
+    """
+
+    def test_publish_to_topic_subscribers(self):
+        """
+        Test that subscribers only receive events for their own topics.
+        """
+
+        broker = Broker()
+        sub_a = broker.subscribe([1, 2])
+        sub_b = broker.subscribe([2, 3])
+
+        self.assertEqual(broker.publish(1, "one"), 1)
+        self.assertEqual(broker.publish(2, "two"), 2)
+        self.assertEqual(broker.publish(4, "four"), 0)
+
+        self.assertEqual(sub_a.get(timeout=0), "one")
+        self.assertEqual(sub_a.get(timeout=0), "two")
+        self.assertEqual(sub_b.get(timeout=0), "two")
+        self.assertIsNone(sub_b.get(timeout=0))
+
+        broker.unsubscribe(sub_a)
+        self.assertEqual(broker.publish(1, "one again"), 0)
+
+    def test_overflow(self):
+        """
+        Test that a full subscription drops events and is marked as overflowed.
+        """
+
+        broker = Broker(maxsize=2)
+        sub = broker.subscribe([1])
+
+        for event in range(3):
+            broker.publish(1, event)
+
+        self.assertTrue(sub.overflowed)
+        self.assertEqual([sub.get(timeout=0), sub.get(timeout=0), sub.get(timeout=0)],
+                         [0, 1, None])
@@ -0,0 +1,160 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Write quota (rate limit) tests.
+"""
+
+from unittest import TestCase
+
+from app import app, limiter, CURR_USER_KEY
+from models import db, connect_db, User, Message
+from ratelimit import DatabaseStore, MemoryStore
+from testing import FakeClock
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_BACKEND'] = 'inline'
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class MemoryStoreTestCase(TestCase):
+    """
+    Test the in-process token buckets.
+    """
+
+    def test_burst_and_refill(self):
+        """
+        Test that a bucket allows `burst` takes at once, then one per 1/rate seconds.
+        """
+
+        clock = FakeClock()
+        store = MemoryStore(clock=clock)
+
+        self.assertEqual([store.take("a", 3, 0.5) for _ in range(3)], [0, 0, 0])
+        self.assertEqual(store.take("a", 3, 0.5), 2)
+        self.assertEqual(store.take("b", 3, 0.5), 0)
+
+        clock.now = 1
+        self.assertEqual(store.take("a", 3, 0.5), 1)
+
+        clock.now = 2
+        self.assertEqual(store.take("a", 3, 0.5), 0)
+        self.assertEqual(store.take("a", 3, 0.5), 2)
+
+        clock.now = 100
+        self.assertEqual([store.take("a", 3, 0.5) for _ in range(4)][-2:], [0, 2])
+
+    def test_max_keys(self):
+        """
+        Test that the least recently used buckets are dropped (and start full again).
+        """
+
+        store = MemoryStore(max_keys=2, clock=FakeClock())
+
+        for key in ("a", "b", "c"):
+            store.take(key, 1, 0.1)
+
+        self.assertEqual(store.take("a", 1, 0.1), 0)
+        self.assertGreater(store.take("c", 1, 0.1), 0)
+
+
+class DatabaseStoreTestCase(TestCase):
+    """
+    Test the shared token buckets.
+    """
+
+    def test_take(self):
+        """
+        Test that the upsert hands out `burst` tokens, then refuses with a retry time.
+        """
+
+        with app.app_context():
+            store = DatabaseStore()
+            store.clear()
+
+            self.assertEqual([store.take("a", 2, 0.001) for _ in range(2)], [0, 0])
+
+            retry_after = store.take("a", 2, 0.001)
+            self.assertGreater(retry_after, 990)
+            self.assertLessEqual(retry_after, 1000)
+
+            self.assertEqual(store.take("b", 2, 0.001), 0)
+            store.clear()
+
+
+class RateLimitViewTestCase(TestCase):
+    """
+    Test that limited views answer 429 once over quota, before doing anything.
+    """
+
+    def setUp(self):
+        with app.app_context():
+            User.query.delete()
+
+            user = User(email="poster@test.com", username="poster", password="HASHED")
+            db.session.add(user)
+            db.session.commit()
+
+            self.user_id = user.id
+
+        self.limits = app.config['RATELIMITS']
+        app.config['RATELIMITS'] = {**self.limits, "messages": (2, 0.001)}
+        limiter.store.clear()
+
+        self.client = app.test_client()
+        return super().setUp()
+
+    def tearDown(self):
+        app.config['RATELIMITS'] = self.limits
+        limiter.store.clear()
+        return super().tearDown()
+
+    def test_post_limited(self):
+        """
+        Test that the third message in a row is refused, and not posted.
+        """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            statuses = [c.post("/messages/new", data={"text": f"Message {i}"}).status_code
+                        for i in range(3)]
+            self.assertEqual(statuses, [302, 302, 429])
+
+            resp = c.post("/messages/new", data={"text": "Again"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertGreater(int(resp.headers["Retry-After"]), 0)
+
+            # Only writes count
+            self.assertEqual(c.get("/messages/new").status_code, 200)
+
+        with app.app_context():
+            self.assertEqual(Message.query.filter_by(user_id=self.user_id).count(), 2)
+
+    def test_api_limited(self):
+        """
+        Test that API endpoints get a JSON 429.
+        """
+
+        app.config['RATELIMITS'] = {**self.limits, "imports": (1, 0.001)}
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            body = {"messages": [{"text": "Imported"}]}
+            self.assertEqual(c.post("/api/messages/import", json=body).status_code, 201)
+
+            resp = c.post("/api/messages/import", json=body)
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Too many requests", resp.json["error"])
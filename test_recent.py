@@ -0,0 +1,60 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Recent-messages cache tests.
+"""
+
+from unittest import TestCase
+
+from recent import RecentMessagesCache
+from testing import FakeClock
+
+
+class RecentMessagesCacheTestCase(TestCase):
+    """
+    Test the per-author ring buffers, LRU eviction, expiry and metrics.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = RecentMessagesCache(per_author=3, max_authors=2, ttl=60, clock=self.clock)
+
+    def test_ring_buffer(self):
+        """
+        Test that new messages go on the front and the oldest fall off the end.
+        """
+
+        self.assertIsNone(self.cache.get(1))
+
+        self.cache.put(1, [(30, 3), (20, 2), (10, 1), (5, 0)])
+        self.assertEqual(self.cache.get(1), [(30, 3), (20, 2), (10, 1)])
+
+        self.cache.add(1, 40, 4)
+        self.assertEqual(self.cache.get(1), [(40, 4), (30, 3), (20, 2)])
+
+        # Uncached authors stay uncached
+        self.cache.add(2, 50, 5)
+        self.assertIsNone(self.cache.get(2))
+
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1))
+
+        self.assertEqual(self.cache.metrics, {"hits": 2, "misses": 3, "invalidations": 1})
+
+    def test_lru_eviction_and_expiry(self):
+        """
+        Test that the least recently read author is evicted, and entries expire after the TTL.
+        """
+
+        self.cache.put(1, [(1, 1)])
+        self.cache.put(2, [(2, 2)])
+        self.cache.get(1)
+        self.cache.put(3, [(3, 3)])
+
+        self.assertEqual(self.cache.get(1), [(1, 1)])
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.metrics["evictions"], 1)
+
+        self.clock.now = 60
+        self.assertIsNone(self.cache.get(3))
@@ -0,0 +1,264 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Thumbnail cache and view tests for Warbler.
+"""
+
+import io
+import ipaddress
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+import app as warbler
+from app import app
+from models import db, connect_db, User
+from testing import FakeClock
+import thumbnails
+from thumbnails import DiskLRUCache, Thumbnailer, ThumbnailError, fetch_url, is_public_address
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+SOURCE_URL = "https://images.example.com/big.jpg"
+
+
+def make_jpeg(width=1280, height=853):
+    """
+    Make JPEG image bytes of the given dimensions.
+    """
+
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), "steelblue").save(out, "JPEG")
+    return out.getvalue()
+
+
+class StubFetcher:
+    """
+    Fetcher that serves canned images and records which URLs it was asked for.
+    """
+
+    def __init__(self, images):
+        self.images = images
+        self.fetched = []
+
+    def __call__(self, url):
+        self.fetched.append(url)
+
+        if url not in self.images:
+            raise ThumbnailError(f"Not found: {url}")
+
+        return self.images[url]
+
+
+class ThumbnailTestCase(TestCase):
+    """
+    Test the on-disk LRU cache, thumbnail generation and the thumbnail view.
+    """
+
+    def setUp(self):
+        """
+        Point the app's thumbnailer at a temporary cache directory and a stub fetcher.
+        """
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fetcher = StubFetcher({SOURCE_URL: make_jpeg()})
+        self.thumbnailer = Thumbnailer(DiskLRUCache(self.tmpdir.name, 10 * 1024 * 1024),
+                                       {"avatar": (48, 96), "header": (400,)},
+                                       self.fetcher)
+
+        self.orig_thumbnailer = warbler.thumbnailer
+        warbler.thumbnailer = self.thumbnailer
+
+        self.client = app.test_client()
+        return super().setUp()
+
+    def tearDown(self):
+        """
+        Restore the app's thumbnailer and remove the temporary cache.
+        """
+
+        warbler.thumbnailer = self.orig_thumbnailer
+        self.tmpdir.cleanup()
+        return super().tearDown()
+
+    def test_lru_eviction(self):
+        """
+        Test that the cache stays under its size limit by evicting least-recently-used entries.
+        """
+
+        cache = DiskLRUCache(os.path.join(self.tmpdir.name, "lru"), max_bytes=25)
+
+        cache.put("a", b"x" * 10, "bin")
+        cache.put("b", b"x" * 10, "bin")
+        cache.get("a")
+        cache.put("c", b"x" * 10, "bin")
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.total_bytes, 20)
+        self.assertEqual(len(os.listdir(cache.directory)), 2)
+
+        # A new cache over the same directory picks up the existing entries
+        reopened = DiskLRUCache(cache.directory, max_bytes=25)
+        self.assertIsNotNone(reopened.get("c"))
+        self.assertEqual(reopened.total_bytes, 20)
+
+    def test_fetch_once_for_all_sizes(self):
+        """
+        Test that a source image is fetched once, and every size is made from that fetch.
+        """
+
+        small = self.thumbnailer.get(SOURCE_URL, "avatar", 48)
+        large = self.thumbnailer.get(SOURCE_URL, "avatar", 96)
+
+        self.assertEqual(self.fetcher.fetched, [SOURCE_URL])
+
+        with Image.open(small) as image:
+            self.assertEqual(image.size, (48, 32))
+
+        with Image.open(large) as image:
+            self.assertEqual(image.size, (96, 64))
+
+    def test_thumbnail_view(self):
+        """
+        Test that the thumbnail view serves a resized image with long-lived cache headers, and
+        falls back to the source image for local or unfetchable images.
+        """
+
+        with app.app_context():
+            User.query.delete()
+
+            remote = User(email="remote@test.com", username="remote", password="HASHED",
+                          image_url=SOURCE_URL,
+                          header_image_url="https://images.example.com/missing.jpg")
+            local = User(email="local@test.com", username="local", password="HASHED")
+
+            db.session.add_all([remote, local])
+            db.session.commit()
+
+            with self.client as c:
+                html = c.get("/users").get_data(as_text=True)
+                self.assertIn(f"/users/{remote.id}/avatar/96?v=", html)
+                self.assertIn('src="/static/images/default-pic.png"', html)
+
+                resp = c.get(f"/users/{remote.id}/avatar/96")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.mimetype, "image/jpeg")
+                self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+                self.assertIn("immutable", resp.headers["Cache-Control"])
+
+                resp = c.get(f"/users/{remote.id}/header/400")
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(resp.location, "https://images.example.com/missing.jpg")
+
+                resp = c.get(f"/users/{local.id}/avatar/96")
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(resp.location, "/static/images/default-pic.png")
+
+                self.assertEqual(c.get(f"/users/{remote.id}/avatar/12").status_code, 404)
+
+
+class RedirectingHandler(BaseHTTPRequestHandler):
+    """
+    Redirects every request to the URL in the path (e.g. /http://10.0.0.1/).
+    """
+
+    def do_GET(self):
+        self.send_response(302)
+        self.send_header("Location", self.path[1:])
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTestCase(TestCase):
+    """
+    Test that the default fetcher only reaches public addresses, and that failures are cached.
+    """
+
+    def test_public_addresses(self):
+        """
+        Test which addresses count as public.
+        """
+
+        for address in ("127.0.0.1", "10.1.2.3", "192.168.0.1", "172.16.0.1", "169.254.169.254",
+                        "0.0.0.0", "100.64.0.1", "::1", "fe80::1", "fc00::1", "::ffff:127.0.0.1",
+                        "224.0.0.1"):
+            self.assertFalse(is_public_address(ipaddress.ip_address(address)), address)
+
+        for address in ("93.184.216.34", "2606:2800:220:1:248:1893:25c8:1946"):
+            self.assertTrue(is_public_address(ipaddress.ip_address(address)), address)
+
+    def test_internal_urls_refused(self):
+        """
+        Test that internal hosts are refused before connecting, and on every redirect hop.
+        """
+
+        for url in ("http://127.0.0.1:1/image.jpg", "http://localhost/image.jpg",
+                    "http://169.254.169.254/latest/meta-data/"):
+            with self.assertRaisesRegex(ThumbnailError, "non-public"):
+                fetch_url(url)
+
+        server = HTTPServer(("127.0.0.1", 0), RedirectingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        # Let the fetcher reach the (local) redirecting server, but nothing else non-public
+        loopback = ipaddress.ip_address("127.0.0.1")
+
+        def allowed(address):
+            return address == loopback or is_public_address(address)
+
+        try:
+            with patch.object(thumbnails, "is_public_address", allowed):
+                with self.assertRaisesRegex(ThumbnailError, "non-public"):
+                    fetch_url(f"{base}/http://10.0.0.1/image.jpg")
+
+                with self.assertRaisesRegex(ThumbnailError, "Refusing redirect"):
+                    fetch_url(f"{base}/ftp://10.0.0.1/image.jpg")
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_failures_cached(self):
+        """
+        Test that a failed source isn't fetched again until its failure expires, and that
+        per-source locks don't outlive the requests using them.
+        """
+
+        clock = FakeClock()
+        fetcher = StubFetcher({})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            thumbnailer = Thumbnailer(DiskLRUCache(tmpdir, 1024 * 1024), {"avatar": (48,)},
+                                      fetcher, failure_ttl=60, clock=clock)
+
+            for _ in range(3):
+                with self.assertRaises(ThumbnailError):
+                    thumbnailer.get(SOURCE_URL, "avatar", 48)
+
+            self.assertEqual(fetcher.fetched, [SOURCE_URL])
+            self.assertEqual(thumbnailer._locks, {})
+
+            clock.now = 60
+            fetcher.images[SOURCE_URL] = make_jpeg()
+            thumbnailer.get(SOURCE_URL, "avatar", 48)
+            self.assertEqual(fetcher.fetched, [SOURCE_URL, SOURCE_URL])
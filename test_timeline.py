@@ -0,0 +1,248 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Tests for merged (pull-model) and hybrid push/pull timeline assembly.
+"""
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app, home_timeline, recent_cache, CURR_USER_KEY
+from models import db, connect_db, User, Message, Follow, TimelineEntry
+from recent import RecentMessagesCache
+from timeline import load_recent_keys, merge_timeline, push_messages
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['JOBS_BACKEND'] = 'inline'
+
+connect_db(app)
+
+with app.app_context():
+    db.create_all()
+
+
+class MergeTimelineTestCase(TestCase):
+    """
+    Test the k-way merge over cached authors.
+    """
+
+    def test_merge_cached(self):
+        """
+        Test that cached authors' keys are merged newest first, up to the limit.
+        """
+
+        cache = RecentMessagesCache(per_author=3)
+        cache.put(1, [(9, 90), (5, 50), (1, 10)])
+        cache.put(2, [(8, 80), (7, 70)])
+        cache.put(3, [])
+
+        self.assertEqual(merge_timeline([1, 2, 3], cache, limit=4),
+                         [(9, 90, 1), (8, 80, 2), (7, 70, 2), (5, 50, 1)])
+
+
+class TimelineEngineTestCase(TestCase):
+    """
+    Test that the merge engine builds the same timelines as the SQL engine.
+    """
+
+    def setUp(self):
+        """
+        Add three authors with interleaved messages.
+        """
+
+        with app.app_context():
+            User.query.delete()
+            Message.query.delete()
+
+            authors = [User(email=f"author{i}@test.com", username=f"author{i}", password="HASHED")
+                       for i in range(3)]
+            db.session.add_all(authors)
+            db.session.flush()
+
+            start = datetime(2023, 1, 1)
+            db.session.add_all(Message(text=f"Message {i}",
+                                       user_id=authors[i % 3].id,
+                                       timestamp=start + timedelta(minutes=i * 7 % 40))
+                               for i in range(40))
+            db.session.commit()
+
+            self.author_ids = [author.id for author in authors]
+
+        recent_cache.clear()
+        return super().setUp()
+
+    def tearDown(self):
+        """
+        Go back to the default engine.
+        """
+
+        app.config['TIMELINE_ENGINE'] = "sql"
+        recent_cache.clear()
+        return super().tearDown()
+
+    def test_load_recent_keys(self):
+        """
+        Test that each author's newest keys are loaded in one query, newest first.
+        """
+
+        with app.app_context():
+            keys = load_recent_keys(self.author_ids + [-1], per_author=5)
+
+            self.assertEqual(keys[-1], [])
+
+            for author_id in self.author_ids:
+                expected = [(msg.timestamp, msg.id)
+                            for msg in (Message.query
+                                        .filter_by(user_id=author_id)
+                                        .order_by(Message.timestamp.desc(), Message.id.desc())
+                                        .limit(5))]
+                self.assertEqual(keys[author_id], expected)
+
+    def test_engines_agree(self):
+        """
+        Test that both engines return the same messages, cold and warm, and that the merge engine
+        notices messages deleted behind the cache's back.
+        """
+
+        with app.app_context():
+            sql = [msg.id for msg in home_timeline(self.author_ids, limit=10)]
+
+            app.config['TIMELINE_ENGINE'] = "merge"
+            cold = [msg.id for msg in home_timeline(self.author_ids, limit=10)]
+            warm = [msg.id for msg in home_timeline(self.author_ids, limit=10)]
+
+            self.assertEqual(cold, sql)
+            self.assertEqual(warm, sql)
+
+            db.session.delete(db.session.get(Message, sql[0]))
+            db.session.commit()
+
+            self.assertEqual([msg.id for msg in home_timeline(self.author_ids, limit=10)][:9],
+                             sql[1:])
+
+
+class HybridTimelineTestCase(TestCase):
+    """
+    Test pushing messages by authors with few followers and pulling those of popular ones.
+    """
+
+    def setUp(self):
+        """
+        Add a reader who follows a "quiet" author (one follower) and a "popular" one (two), with
+        a fan-out threshold of one follower.
+        """
+
+        with app.app_context():
+            User.query.delete()
+            Message.query.delete()
+
+            (reader, fan, quiet, popular) = users = [
+                User(email=f"{name}@test.com", username=name, password="HASHED")
+                for name in ("reader", "fan", "quiet", "popular")]
+            db.session.add_all(users)
+            db.session.flush()
+
+            db.session.add_all([
+                Follow(user_following_id=reader.id, user_being_followed_id=quiet.id),
+                Follow(user_following_id=reader.id, user_being_followed_id=popular.id),
+                Follow(user_following_id=fan.id, user_being_followed_id=popular.id),
+            ])
+            quiet.follower_count = 1
+            popular.follower_count = 2
+
+            start = datetime(2023, 1, 1)
+            db.session.add_all(Message(text=f"Message {i}",
+                                       user_id=(reader, quiet, popular)[i % 3].id,
+                                       timestamp=start + timedelta(minutes=i))
+                               for i in range(30))
+            db.session.commit()
+
+            (self.reader_id, self.fan_id, self.quiet_id, self.popular_id) = [
+                user.id for user in users]
+
+        app.config['TIMELINE_ENGINE'] = "hybrid"
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 1
+        recent_cache.clear()
+        self.client = app.test_client()
+        return super().setUp()
+
+    def tearDown(self):
+        """
+        Go back to the default engine and threshold.
+        """
+
+        app.config['TIMELINE_ENGINE'] = "sql"
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 10_000
+        recent_cache.clear()
+        return super().tearDown()
+
+    def entry_authors(self):
+        return {entry.author_id for entry in TimelineEntry.query.filter_by(user_id=self.reader_id)}
+
+    def test_push_messages(self):
+        """
+        Test that a message is written once per follower.
+        """
+
+        with app.app_context():
+            ids = [msg.id for msg in Message.query.filter_by(user_id=self.popular_id)]
+
+            self.assertEqual(push_messages(self.popular_id, ids[:2]), 4)
+            self.assertEqual(push_messages(self.popular_id, ids[:2]), 0)
+
+    def test_hybrid_matches_sql(self):
+        """
+        Test that the hybrid timeline (the quiet author's messages pushed, the popular author's
+        and the reader's own pulled) matches the SQL engine's.
+        """
+
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.reader_id
+
+                c.post(f"/users/stop_following/{self.quiet_id}")
+                c.post(f"/users/follow/{self.quiet_id}")
+
+            self.assertEqual(db.session.get(User, self.quiet_id).follower_count, 1)
+            self.assertEqual(self.entry_authors(), {self.quiet_id})
+
+            author_ids = [self.reader_id, self.quiet_id, self.popular_id]
+            hybrid = [msg.id for msg in home_timeline(author_ids, limit=20,
+                                                      user_id=self.reader_id)]
+
+            app.config['TIMELINE_ENGINE'] = "sql"
+            sql = [msg.id for msg in home_timeline(author_ids, limit=20)]
+
+            self.assertEqual(hybrid, sql)
+
+    def test_fan_out_on_post(self):
+        """
+        Test that new messages are pushed by the quiet author but not by the popular one.
+        """
+
+        with app.app_context():
+            for author_id in (self.quiet_id, self.popular_id):
+                with self.client as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = author_id
+
+                    c.post("/messages/new", data={"text": "Hello"})
+
+            pushed = TimelineEntry.query.join(Message, Message.id == TimelineEntry.message_id)
+            self.assertEqual([(entry.user_id, entry.author_id)
+                              for entry in pushed.filter(Message.text == "Hello")],
+                             [(self.reader_id, self.quiet_id)])
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.reader_id
+
+                resp = c.get("/")
+                self.assertEqual(resp.get_data(as_text=True).count("Hello"), 2)
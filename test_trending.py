@@ -0,0 +1,145 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Trending tracker tests for Warbler.
+"""
+
+from unittest import TestCase
+
+from trending import TrendingTracker
+from testing import FakeClock
+
+
+class TrendingTrackerTestCase(TestCase):
+    """
+    Test rolling-window, time-decayed like scoring.
+    """
+
+    def setUp(self):
+        """
+        Create a tracker with small, round numbers: 1h window, 10min buckets, 1h half-life.
+        """
+
+        self.clock = FakeClock(1_000_000)
+        self.tracker = TrendingTracker(window=3600, bucket=600, half_life=3600, refresh=60,
+                                       clock=self.clock)
+
+        return super().setUp()
+
+    def test_ranks_by_like_count(self):
+        """
+        Test that messages with more likes rank higher, and that unliked messages drop out.
+        """
+
+        for _ in range(3):
+            self.tracker.record_like(1)
+
+        self.tracker.record_like(2)
+        self.tracker.record_like(3)
+        self.tracker.record_like(3, -1)
+
+        self.assertEqual([msg_id for (msg_id, _) in self.tracker.top()], [1, 2])
+        self.assertEqual([msg_id for (msg_id, _) in self.tracker.top(limit=1)], [1])
+
+    def test_decay(self):
+        """
+        Test that older likes count for less than newer ones.
+        """
+
+        self.tracker.record_like(1)
+        self.tracker.record_like(1)
+
+        self.clock.now += 3000
+        self.tracker.record_like(2)
+        self.tracker.record_like(2)
+
+        [(first, first_score), (second, second_score)] = self.tracker.top()
+        self.assertEqual((first, second), (2, 1))
+        self.assertLess(second_score, first_score)
+
+    def test_window_and_refresh(self):
+        """
+        Test that the ranking is cached for `refresh` seconds, and that likes outside the window
+        are dropped.
+        """
+
+        self.tracker.record_like(1)
+        self.assertEqual(len(self.tracker.top()), 1)
+
+        # Cached ranking doesn't see the new like until the refresh interval has passed
+        self.tracker.record_like(2)
+        self.assertEqual(len(self.tracker.top()), 1)
+
+        self.clock.now += 60
+        self.assertEqual(len(self.tracker.top()), 2)
+
+        self.clock.now += 3600 + 600
+        self.assertEqual(self.tracker.top(), [])
+
+    def test_forget_message(self):
+        """
+        Test that a forgotten (deleted) message no longer trends.
+        """
+
+        self.tracker.record_like(1)
+        self.tracker.record_like(2)
+        self.tracker.top()
+
+        self.tracker.forget_message(1)
+        self.assertEqual([msg_id for (msg_id, _) in self.tracker.top()], [2])
+
+    def test_unlike_takes_back_its_like(self):
+        """
+        Test that an unlike cancels its like where it was counted, and is ignored once that like
+        is out of the window.
+        """
+
+        self.tracker.record_like(1)
+        self.tracker.record_like(2)
+        self.tracker.record_like(2)
+
+        self.clock.now += 1800
+        self.tracker.record_like(1, -1, age=1800)
+        self.tracker.record_like(2, -1, age=1800)
+        self.assertEqual([msg_id for (msg_id, _) in self.tracker.top()], [2])
+
+        # A like from before the window was never counted, so its unlike takes nothing away
+        self.tracker.record_like(2, -1, age=3600 + 600)
+        self.assertEqual([msg_id for (msg_id, _) in self.tracker.top()], [2])
+
+    def test_load(self):
+        """
+        Test that the buckets are seeded from the loader before the first ranking, and that likes
+        recorded before then are left to it.
+        """
+
+        bucket = self.clock.now - self.clock.now % 600
+        calls = []
+
+        def loader(now, window, bucket_seconds):
+            calls.append((now, window, bucket_seconds))
+            return [(bucket - 600, 1, 2), (bucket, 2, 1)]
+
+        tracker = TrendingTracker(window=3600, bucket=600, half_life=3600, refresh=60,
+                                  clock=self.clock, loader=loader, reload=300)
+        tracker.record_like(3)
+
+        self.assertEqual([msg_id for (msg_id, _) in tracker.top()], [1, 2])
+        self.assertEqual(calls, [(self.clock.now, 3600, 600)])
+
+        tracker.record_like(2, -1, age=10)
+        tracker.record_like(1, -1, age=600)
+        tracker.record_like(1, -1, age=600)
+        self.clock.now += 60
+        self.assertEqual(tracker.top(), [])
+
+        # Reseeded (taking in other processes' likes) once `reload` seconds have passed
+        self.clock.now += 240
+        self.assertEqual([msg_id for (msg_id, _) in tracker.top()], [1, 2])
+        self.assertEqual(len(calls), 2)
+
+        # Cleared trackers are seeded again on next use
+        tracker.clear()
+        self.assertEqual(len(tracker.top()), 2)
+        self.assertEqual(len(calls), 3)
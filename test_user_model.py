@@ -5,12 +5,15 @@
 User model tests for Warbler.
 """
 
+import threading
 from unittest import TestCase
+from unittest.mock import patch
 from sqlalchemy.exc import IntegrityError
 from flask_bcrypt import Bcrypt
 
 from app import app
-from models import db, connect_db, User, Message, Follow
+from models import db, connect_db, User, Message, Follow, FollowSuggestion
+from suggestions import refresh_suggestions, get_suggestions, start_refresher
 
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
 app.config['SQLALCHEMY_ECHO'] = False
@@ -238,3 +241,107 @@ class UserModelTestCase(TestCase):
 
             self.assertFalse(User.authenticate("nonexistent", "HASHED_PASSWORD1"))
             self.assertFalse(User.authenticate("testuser1", "NONEXISTENT"))
+
+            # Deleted (deactivated) accounts can't log in
+            user1.is_active = False
+            db.session.commit()
+            self.assertFalse(User.authenticate("testuser1", "HASHED_PASSWORD1"))
+
+    def test_follow_suggestions(self):
+        """
+        Test that suggestions are friends-of-friends ranked by overlap, excluding users that are
+        already followed (and the user themselves).
+        """
+
+        with app.app_context():
+            users = [User(email=f"fof{i}@test.com", username=f"fof{i}", password="HASHED")
+                     for i in range(5)]
+            db.session.add_all(users)
+            db.session.commit()
+
+            user0 = db.session.get(User, self.user0_id)
+            [u1, u2, u3, u4, u5] = users
+
+            # user0 follows u1 and u2; both follow u3, only u1 follows u4; u2 follows u5, which
+            # user0 already follows
+            user0.following.extend([u1, u2, u5])
+            u1.following.extend([u3, u4, user0])
+            u2.following.extend([u3, u5])
+            db.session.commit()
+
+            refresh_suggestions()
+            db.session.commit()
+
+            self.assertEqual(get_suggestions(self.user0_id), [u3, u4])
+            self.assertEqual(get_suggestions(self.user0_id, limit=1), [u3])
+
+            # Refreshing a subset of users leaves the other users' suggestions alone
+            u1.following.remove(u3)
+            u2.following.append(u4)
+            db.session.commit()
+
+            refresh_suggestions(user_ids=[u2.id])
+            db.session.commit()
+            self.assertEqual(get_suggestions(self.user0_id), [u3, u4])
+
+            refresh_suggestions(user_ids=[self.user0_id])
+            db.session.commit()
+            self.assertEqual(get_suggestions(self.user0_id), [u4, u3])
+
+    def test_suggestions_skip_inactive(self):
+        """
+        Test that deleted (deactivated) users are neither stored as suggestions nor shown.
+        """
+
+        with app.app_context():
+            users = [User(email=f"fof{i}@test.com", username=f"fof{i}", password="HASHED")
+                     for i in range(3)]
+            db.session.add_all(users)
+            db.session.commit()
+
+            user0 = db.session.get(User, self.user0_id)
+            [friend, gone, later] = users
+
+            user0.following.append(friend)
+            friend.following.extend([gone, later])
+            gone.is_active = False
+            db.session.commit()
+
+            refresh_suggestions()
+            db.session.commit()
+
+            self.assertEqual(db.session.scalars(
+                db.select(FollowSuggestion.suggested_user_id)
+                .where(FollowSuggestion.user_id == self.user0_id)).all(), [later.id])
+            self.assertEqual(get_suggestions(self.user0_id), [later])
+
+            later.is_active = False
+            db.session.commit()
+            self.assertEqual(get_suggestions(self.user0_id), [])
+
+    def test_suggestions_refresher_survives_errors(self):
+        """
+        Test that the background refresher logs a failed refresh and keeps going.
+        """
+
+        refreshed = threading.Event()
+        calls = []
+
+        def refresh(per_user):
+            calls.append(per_user)
+
+            if len(calls) == 1:
+                raise RuntimeError("database went away")
+
+            refreshed.set()
+
+            # Park the thread rather than keep refreshing the test database
+            threading.Event().wait()
+
+        with patch.object(app.logger, "exception") as log_exception:
+            with patch("suggestions.refresh_suggestions", refresh):
+                start_refresher(app, interval=0)
+                self.assertTrue(refreshed.wait(timeout=5))
+
+        self.assertEqual(len(calls), 2)
+        log_exception.assert_called_once_with("Refreshing follow suggestions failed")
@@ -5,11 +5,20 @@
 User view tests.
 """
 
+import csv
+import io
+import json
+import re
 from unittest import TestCase
+from unittest.mock import patch
+from datetime import datetime
+from html import unescape
 from flask_bcrypt import Bcrypt
 
 from app import app, CURR_USER_KEY
-from models import db, connect_db, User, Message, Follow, Like
+from models import (db, connect_db, User, Message, Follow, Like, FollowSuggestion, Mention,
+                    MessageTag, TimelineEntry)
+import purge
 
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warbler_test"
 app.config['SQLALCHEMY_ECHO'] = False
@@ -20,6 +29,9 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # Don't have WTForms use CSRF at all, since it's a pain to test
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs inside the request, so tests can check their results right away
+app.config['JOBS_BACKEND'] = 'inline'
+
 bcrypt = Bcrypt()
 
 connect_db(app)
@@ -117,6 +129,38 @@ class UserViewTestCase(TestCase):
             for username in ["testuser0", "testuser1", "testuser2"]:
                 self.assertNotIn(username, html)
 
+    def test_list_users_streamed(self):
+        """
+        Test that the users listing is streamed, and shows a message when no users match.
+        """
+
+        with self.client as c:
+            resp = c.get("/users", query_string={"q": "nobody"}, buffered=True)
+
+            self.assertNotIn("Content-Length", resp.headers)
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_flash_on_streamed_page_shown_once(self):
+        """
+        Test that a flashed message shown on a streamed page is not shown again on the next page.
+        """
+
+        with app.app_context():
+            msg = Message(text="My own warble", user_id=self.user0_id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            resp = c.post(f"/users/add_like/{msg_id}", follow_redirects=True, buffered=True)
+            self.assertIn("You cannot like your own messages!", resp.get_data(as_text=True))
+
+            resp = c.get("/users", buffered=True)
+            self.assertNotIn("You cannot like your own messages!", resp.get_data(as_text=True))
+
     def test_show_user_profile(self):
         """
         Test displaying of a user profile page.
@@ -219,6 +263,46 @@ class UserViewTestCase(TestCase):
             self.assertIn('<h4 id="sidebar-username">@testuser1</h4>', html_other)
             self.assertIn('<h1 class="display-6">Followers</h1>', html_other)
 
+    def test_show_followers_paginated(self):
+        """
+        Test that followers are listed newest first, a page at a time, with partial pages for
+        infinite scroll.
+        """
+
+        with app.app_context():
+            db.session.add_all([
+                Follow(user_following_id=self.user1_id, user_being_followed_id=self.user0_id,
+                       created_at=datetime(2023, 1, 1)),
+                Follow(user_following_id=self.user2_id, user_being_followed_id=self.user0_id,
+                       created_at=datetime(2023, 1, 3)),
+                Follow(user_following_id=self.user3_id, user_being_followed_id=self.user0_id,
+                       created_at=datetime(2023, 1, 2)),
+                Follow(user_following_id=self.user0_id, user_being_followed_id=self.user3_id),
+            ])
+            db.session.commit()
+
+        app.config['FOLLOWS_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user0_id
+
+                html = c.get(f"/users/{self.user0_id}/followers").get_data(as_text=True)
+                self.assertLess(html.index("@testuser2"), html.index("@testuser3"))
+                self.assertNotIn("@testuser1", html)
+                self.assertIn(f'action="/users/stop_following/{self.user3_id}"', html)
+                self.assertIn(f'action="/users/follow/{self.user2_id}"', html)
+
+                next_url = unescape(re.search(r'data-partial-url="([^"]+)"', html).group(1))
+                html = c.get(next_url).get_data(as_text=True)
+                self.assertIn("@testuser1", html)
+                self.assertNotIn("<html", html)
+                self.assertNotIn("data-partial-url", html)
+
+        finally:
+            app.config['FOLLOWS_PER_PAGE'] = 60
+
     def test_display_likes_logged_out(self):
         """
         Test that logged-out users will be redirected to homepage if they try to access any user's
@@ -260,6 +344,54 @@ class UserViewTestCase(TestCase):
             self.assertIn('<h4 id="sidebar-username">@testuser1</h4>', html_other)
             self.assertIn('<h1 class="display-6">Liked Warbles</h1>', html_other)
 
+    def test_display_likes_paginated(self):
+        """
+        For logged-in users:
+
+        Test that likes are listed most-recently-liked first, a page at a time.
+        """
+
+        with app.app_context():
+            msgs = [Message(text=f"Liked message {i}", user_id=self.user1_id) for i in range(3)]
+            db.session.add_all(msgs)
+            db.session.commit()
+
+            # Like in the order 1, 0, 2, with distinct like times
+            for (i, msg) in enumerate([msgs[1], msgs[0], msgs[2]]):
+                db.session.add(Like(user_id=self.user0_id,
+                                    message_id=msg.id,
+                                    liked_at=datetime(2023, 1, 1 + i)))
+
+            db.session.commit()
+
+            app.config['LIKES_PER_PAGE'] = 2
+
+            try:
+                with self.client as c:
+
+                    # 'Log in' as user 0
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.user0_id
+
+                    html = c.get(f"/users/{self.user0_id}/likes").get_data(as_text=True)
+
+                    self.assertLess(html.index("Liked message 2"), html.index("Liked message 0"))
+                    self.assertNotIn("Liked message 1", html)
+                    self.assertIn("Older likes", html)
+
+                    next_url = re.search(r'href="([^"]*before=[^"]*)"', html).group(1)
+                    html = c.get(unescape(next_url)).get_data(as_text=True)
+
+                    self.assertIn("Liked message 1", html)
+                    self.assertNotIn("Liked message 0", html)
+                    self.assertNotIn("Older likes", html)
+
+                    resp = c.get(f"/users/{self.user0_id}/likes", query_string={"before": "bad"})
+                    self.assertEqual(resp.status_code, 400)
+
+            finally:
+                app.config['LIKES_PER_PAGE'] = 50
+
     # ---------------------------------------------------------------------------------------------
 
     # TESTS FOR UPDATING USER PROFILE -------------------------------------------------------------
@@ -429,6 +561,65 @@ class UserViewTestCase(TestCase):
 
     # TESTS FOR DELETING A USER -------------------------------------------------------------------
 
+    def test_export_user_logged_out(self):
+        """
+        Test that logged-out users can't export data.
+        """
+
+        with self.client as c:
+            resp = c.get("/users/export", follow_redirects=True)
+
+            self.assertEqual(resp.request.path, "/")
+            self.assertIn("Access unauthorized.", resp.get_data(as_text=True))
+
+    def test_export_user(self):
+        """
+        Test that a user's messages, likes and follows are streamed as JSON Lines or CSV.
+        """
+
+        with app.app_context():
+            own = Message(text="My warble", user_id=self.user0_id)
+            other = Message(text="Their warble", user_id=self.user1_id)
+            db.session.add_all([own, other])
+            db.session.flush()
+
+            db.session.add_all([Like(user_id=self.user0_id, message_id=other.id),
+                                Follow(user_following_id=self.user0_id,
+                                       user_being_followed_id=self.user1_id),
+                                Follow(user_following_id=self.user2_id,
+                                       user_being_followed_id=self.user0_id)])
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user0_id
+
+                resp = c.get("/users/export")
+                self.assertNotIn("Content-Length", resp.headers)
+                self.assertEqual(resp.mimetype, "application/x-ndjson")
+                self.assertIn('filename="warbler-testuser0.jsonl"',
+                              resp.headers["Content-Disposition"])
+
+                records = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+                self.assertEqual([(r["type"], r["text"] or r["username"]) for r in records], [
+                    ("message", "My warble"),
+                    ("like", "Their warble"),
+                    ("following", "testuser1"),
+                    ("follower", "testuser2"),
+                ])
+                self.assertEqual(records[1]["id"], other.id)
+                self.assertEqual(records[1]["username"], "testuser1")
+
+                resp = c.get("/users/export?format=csv")
+                self.assertEqual(resp.mimetype, "text/csv")
+
+                rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+                self.assertEqual([row["type"] for row in rows],
+                                 ["message", "like", "following", "follower"])
+                self.assertEqual(rows[0]["text"], "My warble")
+
+                self.assertEqual(c.get("/users/export?format=xml").status_code, 400)
+
     def test_delete_user_logged_out(self):
         """
         Test that logged-out users will be redirected to homepage if they try to delete a user, and
@@ -473,6 +664,96 @@ class UserViewTestCase(TestCase):
             self.assertEqual(len(users), init_num_users - 1)
             self.assertNotIn(curr_user, users)
 
+    def test_delete_user_purges_data(self):
+        """
+        For logged-in users:
+
+        Test that deleting a user removes their messages, likes, follows, suggestions, mentions and
+        timeline entries (each in batches, not left to the cascade from the user row), and logs
+        them out.
+        """
+
+        with app.app_context():
+            user0 = db.session.get(User, self.user0_id)
+            user1 = db.session.get(User, self.user1_id)
+
+            own_msgs = [Message(text=f"Own message {i}", user_id=self.user0_id) for i in range(3)]
+            other_msg = Message(text="Other message", user_id=self.user1_id)
+            db.session.add_all(own_msgs + [other_msg])
+
+            user0.following.append(user1)
+            user1.following.append(user0)
+            user0.likes.append(other_msg)
+            user1.likes.append(own_msgs[0])
+            db.session.flush()
+
+            db.session.add_all([
+                FollowSuggestion(user_id=self.user0_id, suggested_user_id=self.user1_id, score=1),
+                FollowSuggestion(user_id=self.user1_id, suggested_user_id=self.user0_id, score=1),
+                Mention(user_id=self.user0_id, message_id=other_msg.id,
+                        timestamp=other_msg.timestamp),
+                Mention(user_id=self.user1_id, message_id=own_msgs[0].id,
+                        timestamp=own_msgs[0].timestamp),
+                MessageTag(tag="gone", message_id=own_msgs[0].id, timestamp=own_msgs[0].timestamp),
+                TimelineEntry(user_id=self.user0_id, message_id=other_msg.id,
+                              author_id=self.user1_id, timestamp=other_msg.timestamp),
+                TimelineEntry(user_id=self.user1_id, message_id=own_msgs[1].id,
+                              author_id=self.user0_id, timestamp=own_msgs[1].timestamp),
+            ])
+            db.session.commit()
+
+            app.config['USER_PURGE_BATCH_SIZE'] = 2
+            batched = []
+            real_delete_in_batches = purge.delete_in_batches
+
+            def delete_in_batches(table, *args):
+                batched.append(table.name)
+                return real_delete_in_batches(table, *args)
+
+            try:
+                with self.client as c, patch("purge.delete_in_batches", delete_in_batches):
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.user0_id
+
+                    c.post("/users/delete")
+
+                    with c.session_transaction() as sess:
+                        self.assertNotIn(CURR_USER_KEY, sess)
+
+            finally:
+                app.config['USER_PURGE_BATCH_SIZE'] = 1000
+
+            self.assertIsNone(db.session.get(User, self.user0_id))
+            self.assertEqual(Message.query.filter_by(user_id=self.user0_id).count(), 0)
+            self.assertEqual(Message.query.filter_by(user_id=self.user1_id).count(), 1)
+            self.assertEqual(Like.query.count(), 0)
+            self.assertEqual(Follow.query.count(), 0)
+
+            for model in (FollowSuggestion, Mention, MessageTag, TimelineEntry):
+                self.assertIn(model.__tablename__, batched)
+                self.assertEqual(model.query.count(), 0)
+
+    def test_deactivated_user(self):
+        """
+        Test that a deactivated user (deleted, but not yet purged) is logged out and hidden.
+        """
+
+        with app.app_context():
+            user0 = db.session.get(User, self.user0_id)
+            user0.is_active = False
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user0_id
+
+                resp = c.get("/messages/new")
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(resp.location, "/")
+
+                self.assertEqual(c.get(f"/users/{self.user0_id}").status_code, 404)
+                self.assertNotIn("testuser0", c.get("/users").get_data(as_text=True))
+
     # ---------------------------------------------------------------------------------------------
 
     # TESTS FOR ADDING/REMOVING LIKES AND FOLLOWING -----------------------------------------------
@@ -571,6 +852,34 @@ class UserViewTestCase(TestCase):
             self.assertIn(user0, user1.followers)
             self.assertEqual(Follow.query.count(), init_num_follows + 1)
 
+    def test_add_follow_discards_suggestion(self):
+        """
+        For logged-in users:
+
+        Test that the homepage shows stored follow suggestions, and that following a suggested
+        user removes them from the suggestions.
+        """
+
+        with app.app_context():
+            db.session.add(FollowSuggestion(user_id=self.user0_id,
+                                            suggested_user_id=self.user1_id,
+                                            score=1))
+            db.session.commit()
+
+            with self.client as c:
+
+                # 'Log in' as user 0
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user0_id
+
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("Who to follow", html)
+                self.assertIn("@testuser1", html)
+
+                c.post(f"/users/follow/{self.user1_id}")
+
+            self.assertEqual(FollowSuggestion.query.count(), 0)
+
     def test_stop_following_logged_out(self):
         """
         Test that logged-out users will be redirected to homepage if they try to remove a follow,
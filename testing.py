@@ -0,0 +1,18 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Helpers shared by the test modules.
+"""
+
+
+class FakeClock:
+    """
+    Clock that only moves when told to, for deterministic tests of time-based structures.
+    """
+
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
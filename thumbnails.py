@@ -0,0 +1,385 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Thumbnails of remote user images (avatars and header images).
+
+Each remote source image is fetched once and resized to every configured size for its kind; the
+variants are kept in a size-bounded, least-recently-used cache on disk. The fetcher is a plain
+callable (url -> bytes), so tests can swap in a stub and never touch the network.
+
+Source URLs are chosen by users, so the default fetcher only connects to public addresses: every
+connection (including each redirect hop) resolves the host itself, refuses private, loopback,
+link-local and other non-global addresses, and connects to the address it checked. Sources that
+can't be fetched are remembered for a while, so a dead URL doesn't tie up a worker on every view.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from PIL import Image
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_REDIRECTS = 3
+
+
+class ThumbnailError(Exception):
+    """
+    A source image could not be fetched or decoded.
+    """
+
+
+def is_remote(url):
+    """
+    Is `url` an absolute http(s) URL (as opposed to a local /static path)?
+    """
+
+    return bool(url) and urlparse(url).scheme in ("http", "https")
+
+
+def source_version(url):
+    """
+    Short hash of a source URL, used to bust browser caches when a user changes their image.
+    """
+
+    return hashlib.sha1(url.encode()).hexdigest()[:10]
+
+
+def is_public_address(address):
+    """
+    Is `address` (an ipaddress object) globally routable, i.e. not private, loopback,
+    link-local, reserved or multicast?
+    """
+
+    if getattr(address, "ipv4_mapped", None) is not None:
+        address = address.ipv4_mapped
+
+    return address.is_global and not address.is_multicast
+
+
+def connect_public(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """
+    Like socket.create_connection, but refuses hosts that resolve to any non-public address, and
+    connects to the addresses it checked (so the name can't be re-resolved to another one).
+    """
+
+    (host, port) = address
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+    for (*_, sockaddr) in infos:
+        if not is_public_address(ipaddress.ip_address(sockaddr[0].split("%")[0])):
+            raise OSError(f"Refusing to connect to non-public address {sockaddr[0]} ({host})")
+
+    error = OSError(f"Could not resolve {host}")
+
+    for (family, kind, proto, _, sockaddr) in infos:
+        sock = socket.socket(family, kind, proto)
+
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+
+            if source_address:
+                sock.bind(source_address)
+
+            sock.connect(sockaddr)
+            return sock
+
+        except OSError as exc:
+            sock.close()
+            error = exc
+
+    raise error
+
+
+class PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = connect_public
+
+
+class PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = connect_public
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req, context=self._context)
+
+
+class RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """
+    Follow at most MAX_REDIRECTS redirects, and only to http(s) URLs (each hop then goes through
+    the public-address check again).
+    """
+
+    max_redirections = MAX_REDIRECTS
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not is_remote(newurl):
+            raise urllib.error.HTTPError(newurl, code, f"Refusing redirect to {newurl}", headers,
+                                         fp)
+
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def public_opener():
+    """
+    A URL opener for http(s) URLs on public addresses only (no proxies, files or FTP).
+    """
+
+    opener = urllib.request.OpenerDirector()
+
+    for handler in (PublicHTTPHandler(), PublicHTTPSHandler(), RedirectHandler(),
+                    urllib.request.HTTPDefaultErrorHandler(),
+                    urllib.request.HTTPErrorProcessor(), urllib.request.UnknownHandler()):
+        opener.add_handler(handler)
+
+    return opener
+
+
+def fetch_url(url, timeout=5):
+    """
+    Default fetcher: download `url` (at most MAX_SOURCE_BYTES of it) from a public address.
+    """
+
+    if not is_remote(url):
+        raise ThumbnailError(f"Not a remote URL: {url}")
+
+    try:
+        with public_opener().open(url, timeout=timeout) as resp:
+            data = resp.read(MAX_SOURCE_BYTES + 1)
+
+    except (OSError, ValueError) as exc:
+        raise ThumbnailError(f"Could not fetch {url}: {exc}") from exc
+
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ThumbnailError(f"Source image too large: {url}")
+
+    return data
+
+
+class DiskLRUCache:
+    """
+    Files on disk, keyed by string, holding at most `max_bytes` in total.
+
+    Adding an entry evicts least-recently-used entries until the cache fits. The directory is
+    created (and any existing entries indexed, oldest first) on first use.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the path of the entry for `key`, or None.
+        """
+
+        with self._lock:
+            entries = self._load()
+
+            if key not in entries:
+                return None
+
+            entries.move_to_end(key)
+            return os.path.join(self.directory, entries[key][0])
+
+    def put(self, key, data, extension):
+        """
+        Store `data` for `key` (in a file with the given extension) and return its path.
+        """
+
+        filename = f"{key}.{extension}"
+        path = os.path.join(self.directory, filename)
+
+        with self._lock:
+            entries = self._load()
+
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+
+            if key in entries:
+                self.total_bytes -= entries.pop(key)[1]
+
+            entries[key] = (filename, len(data))
+            self.total_bytes += len(data)
+
+            while self.total_bytes > self.max_bytes and len(entries) > 1:
+                (_, (old_filename, size)) = entries.popitem(last=False)
+                self.total_bytes -= size
+
+                try:
+                    os.remove(os.path.join(self.directory, old_filename))
+                except FileNotFoundError:
+                    pass
+
+        return path
+
+    def _load(self):
+        if self._entries is None:
+            os.makedirs(self.directory, exist_ok=True)
+
+            files = [entry for entry in os.scandir(self.directory)
+                     if entry.is_file() and not entry.name.endswith(".tmp")]
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+
+            self._entries = OrderedDict()
+
+            for entry in files:
+                size = entry.stat().st_size
+                self._entries[entry.name.rsplit(".", 1)[0]] = (entry.name, size)
+                self.total_bytes += size
+
+        return self._entries
+
+
+class Thumbnailer:
+    """
+    Produces cached thumbnails of remote images, in the sizes configured for each kind of image.
+
+    `sizes` maps a kind (e.g. "avatar") to the sizes, in pixels, of the square boxes its
+    thumbnails are scaled down to fit. A source that fails is not tried again for
+    `failure_ttl` seconds (at most `max_failures` such sources are remembered).
+    """
+
+    def __init__(self, cache, sizes, fetcher=fetch_url, failure_ttl=300, max_failures=10_000,
+                 clock=time.monotonic):
+        self.cache = cache
+        self.sizes = sizes
+        self.fetcher = fetcher
+        self.failure_ttl = failure_ttl
+        self.max_failures = max_failures
+        self.clock = clock
+
+        self._failures = OrderedDict()
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(src, size):
+        return hashlib.sha256(f"{size}:{src}".encode()).hexdigest()
+
+    def get(self, src, kind, size):
+        """
+        Return the path of the `size` thumbnail of `src`, fetching and resizing it on a miss.
+
+        Raises ThumbnailError if the source can't be fetched or decoded.
+        """
+
+        key = self.cache_key(src, size)
+        path = self.cache.get(key)
+
+        if path is not None:
+            return path
+
+        self._check_failures(src)
+
+        # One fetch per source, even with concurrent requests for several of its sizes
+        lock = self._acquire_lock(src)
+
+        try:
+            with lock:
+                path = self.cache.get(key)
+
+                if path is None:
+                    self._check_failures(src)
+                    self._make_variants_or_remember(src, kind)
+                    path = self.cache.get(key)
+
+        finally:
+            self._release_lock(src)
+
+        if path is None:
+            raise ThumbnailError(f"Thumbnail cache too small to hold {src}")
+
+        return path
+
+    def _check_failures(self, src):
+        with self._locks_lock:
+            failed_at = self._failures.get(src)
+
+            if failed_at is not None and self.clock() - failed_at < self.failure_ttl:
+                raise ThumbnailError(f"Recently failed: {src}")
+
+            self._failures.pop(src, None)
+
+    def _make_variants_or_remember(self, src, kind):
+        try:
+            self._make_variants(src, kind)
+
+        except ThumbnailError:
+            with self._locks_lock:
+                self._failures[src] = self.clock()
+
+                while len(self._failures) > self.max_failures:
+                    self._failures.popitem(last=False)
+
+            raise
+
+    def _make_variants(self, src, kind):
+        data = self.fetcher(src)
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except (OSError, Image.DecompressionBombError) as exc:
+            raise ThumbnailError(f"Could not decode {src}: {exc}") from exc
+
+        has_alpha = image.mode in ("RGBA", "LA", "P")
+
+        for size in self.sizes[kind]:
+            variant = image.copy()
+            variant.thumbnail((size, size))
+
+            out = io.BytesIO()
+
+            if has_alpha:
+                variant.save(out, "PNG", optimize=True)
+                self.cache.put(self.cache_key(src, size), out.getvalue(), "png")
+            else:
+                variant.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+                self.cache.put(self.cache_key(src, size), out.getvalue(), "jpg")
+
+    def _acquire_lock(self, src):
+        """
+        The lock for `src`, shared by the requests currently working on it. Locks are counted,
+        and dropped once no request holds or waits on them, so there is only one per source in
+        progress.
+        """
+
+        with self._locks_lock:
+            entry = self._locks.setdefault(src, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _release_lock(self, src):
+        with self._locks_lock:
+            entry = self._locks[src]
+            entry[1] -= 1
+
+            if not entry[1]:
+                del self._locks[src]
@@ -0,0 +1,225 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Timeline assembly, pull and hybrid push/pull.
+
+Pull: every author's newest message keys, (timestamp, id) pairs sorted newest first, come from the
+recent-messages cache (see recent.py). Authors missing from the cache are loaded together in one
+query that reads at most `per_author` rows per author off the (user_id, timestamp) index. A heap
+merge of the k lists then stops after `limit` keys, so a warm timeline costs O(limit log k) rather
+than a sort of everything the followed authors ever posted.
+
+Hybrid: a message by an author with at most `max_followers` followers is pushed into each
+follower's timeline_entries when it is posted, so writes cost one row per follower. Messages by
+more popular authors aren't pushed (one post would write millions of rows); followers pull them at
+read time as above, and the two streams are merged. An author whose message was pushed and who has
+since become popular shows up in both streams; the merge drops the duplicates.
+"""
+
+import heapq
+from itertools import islice
+
+from sqlalchemy import delete, func, select, true, update
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.types import Integer
+
+from models import db, Follow, Message, TimelineEntry, User
+
+ENTRY_COLUMNS = ["user_id", "message_id", "author_id", "timestamp"]
+
+
+def load_recent_keys(author_ids, per_author):
+    """
+    Map each of `author_ids` to the (timestamp, id) keys of their newest `per_author` messages,
+    newest first, in a single query (a LATERAL index scan per author).
+    """
+
+    authors = (func.unnest(db.cast(list(author_ids), ARRAY(Integer)))
+               .table_valued("id")
+               .render_derived(name="authors"))
+    newest = (select(Message.timestamp, Message.id)
+              .where(Message.user_id == authors.c.id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(per_author)
+              .lateral())
+
+    keys = {author_id: [] for author_id in author_ids}
+    rows = db.session.execute(select(authors.c.id, newest.c.timestamp, newest.c.id)
+                              .select_from(authors)
+                              .join(newest, true())
+                              .order_by(authors.c.id,
+                                        newest.c.timestamp.desc(),
+                                        newest.c.id.desc()))
+
+    for (author_id, timestamp, message_id) in rows:
+        keys[author_id].append((timestamp, message_id))
+
+    return keys
+
+
+def merge_timeline(author_ids, cache, limit=100):
+    """
+    Return the `limit` newest (timestamp, message_id, author_id) entries across `author_ids`,
+    newest first, filling `cache` with any authors it was missing.
+    """
+
+    keys = {}
+    missing = []
+
+    for author_id in author_ids:
+        cached = cache.get(author_id)
+
+        if cached is None:
+            missing.append(author_id)
+        else:
+            keys[author_id] = cached
+
+    if missing:
+        for (author_id, author_keys) in load_recent_keys(missing, cache.per_author).items():
+            cache.put(author_id, author_keys)
+            keys[author_id] = author_keys
+
+    streams = [tagged(author_id, author_keys) for (author_id, author_keys) in keys.items()]
+    return list(islice(heapq.merge(*streams, reverse=True), limit))
+
+
+def tagged(author_id, keys):
+    """
+    Lazily turn an author's (timestamp, id) keys into merge entries.
+    """
+
+    for (timestamp, message_id) in keys:
+        yield (timestamp, message_id, author_id)
+
+
+###################################################################################################
+# Hybrid push/pull
+
+def recount_followers(user_ids):
+    """
+    Recount the given users' followers into their `follower_count`. Does not commit.
+    """
+
+    count = (select(func.count())
+             .where(Follow.user_being_followed_id == User.id)
+             .scalar_subquery())
+
+    db.session.execute(update(User)
+                       .where(User.id.in_(user_ids))
+                       .values(follower_count=count)
+                       .execution_options(synchronize_session=False))
+
+
+def push_messages(author_id, message_ids):
+    """
+    Push the author's messages into the timelines of all of their followers.
+
+    Returns the number of entries written (the write amplification). Does not commit.
+    """
+
+    rows = (select(Follow.user_following_id, Message.id, Message.user_id, Message.timestamp)
+            .select_from(Follow)
+            .join(Message, Message.user_id == Follow.user_being_followed_id)
+            .where(Follow.user_being_followed_id == author_id)
+            .where(Message.id.in_(message_ids)))
+
+    result = db.session.execute(insert(TimelineEntry)
+                                .from_select(ENTRY_COLUMNS, rows)
+                                .on_conflict_do_nothing())
+    return result.rowcount
+
+
+def fill_timelines(max_followers, per_author, user_ids=None, author_id=None):
+    """
+    Push the newest `per_author` messages of each followed author with at most `max_followers`
+    followers into their followers' timelines: those of `user_ids` only, and/or of `author_id`
+    only, if given (e.g. after a new follow).
+
+    Entries already there are left alone. Returns the number written. Does not commit.
+    """
+
+    newest = (select(Message.id, Message.user_id, Message.timestamp)
+              .where(Message.user_id == Follow.user_being_followed_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(per_author)
+              .lateral())
+
+    rows = (select(Follow.user_following_id, newest.c.id, newest.c.user_id, newest.c.timestamp)
+            .select_from(Follow)
+            .join(User, User.id == Follow.user_being_followed_id)
+            .join(newest, true())
+            .where(User.follower_count <= max_followers))
+
+    if user_ids is not None:
+        rows = rows.where(Follow.user_following_id.in_(user_ids))
+
+    if author_id is not None:
+        rows = rows.where(Follow.user_being_followed_id == author_id)
+
+    result = db.session.execute(insert(TimelineEntry)
+                                .from_select(ENTRY_COLUMNS, rows)
+                                .on_conflict_do_nothing())
+    return result.rowcount
+
+
+def rebuild_timelines(user_ids, max_followers, per_author):
+    """
+    Replace the given users' timeline entries with freshly pushed ones. Does not commit.
+    """
+
+    db.session.execute(delete(TimelineEntry).where(TimelineEntry.user_id.in_(user_ids)))
+    return fill_timelines(max_followers, per_author, user_ids=user_ids)
+
+
+def drop_author(user_id, author_id):
+    """
+    Remove an author's messages from a user's timeline (after an unfollow). Does not commit.
+    """
+
+    db.session.execute(delete(TimelineEntry)
+                       .where(TimelineEntry.user_id == user_id)
+                       .where(TimelineEntry.author_id == author_id))
+
+
+def pushed_entries(user_id, limit=100):
+    """
+    The user's `limit` newest pushed (timestamp, message_id, author_id) entries, newest first.
+    """
+
+    rows = db.session.execute(select(TimelineEntry.timestamp,
+                                     TimelineEntry.message_id,
+                                     TimelineEntry.author_id)
+                              .where(TimelineEntry.user_id == user_id)
+                              .order_by(TimelineEntry.timestamp.desc(),
+                                        TimelineEntry.message_id.desc())
+                              .limit(limit))
+
+    return [tuple(row) for row in rows]
+
+
+def hybrid_timeline(user_id, pulled_ids, cache, limit=100):
+    """
+    Return the `limit` newest (timestamp, message_id, author_id) entries of the user's timeline,
+    newest first: their pushed entries merged with the newest messages of `pulled_ids`.
+    """
+
+    merged = heapq.merge(pushed_entries(user_id, limit),
+                         merge_timeline(pulled_ids, cache, limit),
+                         reverse=True)
+
+    return list(islice(deduplicated(merged), limit))
+
+
+def deduplicated(entries):
+    """
+    Drop repeats of an entry from a sorted stream (where they are adjacent).
+    """
+
+    previous = None
+
+    for entry in entries:
+        if entry != previous:
+            yield entry
+
+        previous = entry
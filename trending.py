@@ -0,0 +1,203 @@
+# Ioana A Mititean
+# Unit 26: Warbler (Twitter Clone)
+
+"""
+Trending warbles: time-decayed like counts over a rolling window.
+
+Like/unlike events are recorded as they happen into fixed-width time buckets, so ranking never
+needs to aggregate the likes table. An unlike is recorded in the bucket of the like it takes back,
+so it cancels that like exactly, and not at all if the like is already out of the window. Buckets
+that fall out of the window are dropped, and the ranking itself is only recomputed every `refresh`
+seconds.
+
+The buckets are seeded from the likes table (see recent_like_counts) the first time the ranking is
+needed, so a restart doesn't empty the ranking, and seeded again every `reload` seconds. In
+between, each process only sees the likes it handles itself; the reload brings in the other
+processes' likes, so every process converges on the same ranking.
+"""
+
+import threading
+import time
+from collections import Counter, deque
+from datetime import timedelta
+
+from sqlalchemy import Float, func, select
+
+from models import db, Like
+
+
+class TrendingTracker:
+    """
+    Rolling-window aggregate of like events per message.
+
+    A message's score is the sum of its like deltas, each weighted by 0.5 ** (age / half_life),
+    where age is measured from the middle of the bucket the event landed in.
+    """
+
+    def __init__(self, window=24 * 60 * 60, bucket=5 * 60, half_life=6 * 60 * 60, refresh=60,
+                 clock=time.time, loader=None, reload=15 * 60):
+
+        self.window = window
+        self.bucket = bucket
+        self.half_life = half_life
+        self.refresh = refresh
+        self.clock = clock
+        self.loader = loader
+        self.reload = reload
+
+        self._buckets = deque()
+        self._ranking = []
+        self._ranked_at = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def record_like(self, message_id, delta=1, age=0):
+        """
+        Record a like (delta=1) or an unlike (delta=-1) of a message, for a like made `age` seconds
+        ago (an unlike takes back the like where it was counted).
+
+        Call this once the change is committed.
+        """
+
+        now = self.clock()
+
+        with self._lock:
+            # The load will read it from the likes table
+            if self.loader is not None and self._loaded_at is None:
+                return
+
+            counts = self._bucket_at(now - age, now)
+
+            if counts is not None:
+                counts[message_id] += delta
+
+            self._evict(now)
+
+    def _bucket_at(self, when, now):
+        """
+        The counts of the bucket holding time `when`, creating it if needed; None if that bucket
+        is out of the window.
+        """
+
+        start = when - when % self.bucket
+
+        if start + self.bucket <= now - self.window:
+            return None
+
+        for i in range(len(self._buckets) - 1, -1, -1):
+            if self._buckets[i][0] == start:
+                return self._buckets[i][1]
+
+            if self._buckets[i][0] < start:
+                self._buckets.insert(i + 1, (start, Counter()))
+                return self._buckets[i + 1][1]
+
+        self._buckets.appendleft((start, Counter()))
+        return self._buckets[0][1]
+
+    def load(self):
+        """
+        Replace all recorded events with the likes in the window, from `loader(now, window,
+        bucket)`: (bucket start, message ID, count) rows.
+        """
+
+        with self._lock:
+            now = self.clock()
+            buckets = {}
+
+            for (start, message_id, count) in self.loader(now, self.window, self.bucket):
+                buckets.setdefault(start, Counter())[message_id] = count
+
+            self._buckets = deque(sorted(buckets.items()))
+            self._ranked_at = None
+            self._loaded_at = now
+
+    def forget_message(self, message_id):
+        """
+        Drop all recorded events for a message (e.g. after it is deleted).
+        """
+
+        with self._lock:
+            for (_, counts) in self._buckets:
+                counts.pop(message_id, None)
+
+            self._ranking = [(msg_id, score) for (msg_id, score) in self._ranking
+                             if msg_id != message_id]
+
+    def top(self, limit=20):
+        """
+        Return up to `limit` (message_id, score) pairs, highest score first.
+
+        Uses the cached ranking unless it is older than `refresh` seconds, and reseeds the buckets
+        from the loader first if they were seeded more than `reload` seconds ago.
+        """
+
+        now = self.clock()
+
+        with self._lock:
+            seeded_at = self._loaded_at
+
+        if self.loader is not None and (seeded_at is None or now - seeded_at >= self.reload):
+            self.load()
+
+        with self._lock:
+            if self._ranked_at is None or now - self._ranked_at >= self.refresh:
+                self._evict(now)
+                self._ranking = self._rank(now)
+                self._ranked_at = now
+
+            return self._ranking[:limit]
+
+    def clear(self):
+        """
+        Forget all recorded events (to be seeded again on next use, if there is a loader).
+        """
+
+        with self._lock:
+            self._buckets.clear()
+            self._ranking = []
+            self._ranked_at = None
+            self._loaded_at = None
+
+    def _evict(self, now):
+        """
+        Drop buckets that ended before the start of the window.
+        """
+
+        while self._buckets and self._buckets[0][0] + self.bucket <= now - self.window:
+            self._buckets.popleft()
+
+    def _rank(self, now):
+        """
+        Compute the decayed score of every message with events in the window.
+        """
+
+        scores = Counter()
+
+        for (start, counts) in self._buckets:
+            age = now - (start + self.bucket / 2)
+            weight = 0.5 ** (max(age, 0) / self.half_life)
+
+            for (msg_id, count) in counts.items():
+                scores[msg_id] += count * weight
+
+        ranking = [(msg_id, score) for (msg_id, score) in scores.items() if score > 0]
+        ranking.sort(key=lambda pair: (-pair[1], -pair[0]))
+        return ranking
+
+
+def recent_like_counts(now, window, bucket):
+    """
+    Count the likes made in the last `window` seconds per `bucket`-second bucket and message:
+    (bucket start, message ID, count) rows, with bucket starts on the clock `now` is on.
+
+    Ages are measured on the database's clock, as liked_at is.
+    """
+
+    age = func.extract("epoch", func.localtimestamp() - Like.liked_at).cast(Float)
+    start = func.floor((now - age) / bucket) * bucket
+    since = func.localtimestamp() - timedelta(seconds=window)
+
+    return db.session.execute(select(start, Like.message_id, func.count())
+                              .where(Like.liked_at > since)
+                              .group_by(start, Like.message_id)).all()